@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Benchmark for the MVISION EPO event decode path
+# Compares the standard library (json) with orjson for decoding a /epo/v2/events page, flattening
+# the events and encoding them as NDJSON, reporting events/sec and bytes allocated per page.
+
+import os
+import sys
+import json
+import time
+import random
+import tracemalloc
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mvapi_epo_get_events import flatten
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def make_page(size):
+    """Build a JSON:API events page with attributes shaped like MVISION EPO threat events."""
+    data = []
+    for i in range(size):
+        data.append({
+            'id': '{0:08x}-0000-4000-8000-{1:012x}'.format(random.getrandbits(32), i),
+            'type': 'MVEvents',
+            'links': {'self': 'https://api.mvision.mcafee.com/epo/v2/events/{0}'.format(i)},
+            'attributes': {
+                'timestamp': '2021-08-18T10:{0:02d}:{1:02d}.000Z'.format(i // 60 % 60, i % 60),
+                'autoguid': '{0:032x}'.format(random.getrandbits(128)),
+                'detectedutc': str(1629280000000 + i),
+                'receivedutc': str(1629280000500 + i),
+                'agentguid': '{0:032x}'.format(random.getrandbits(128)),
+                'analyzer': 'ENDP_AM_1070',
+                'analyzername': 'McAfee Endpoint Security',
+                'analyzerversion': '10.7.0',
+                'analyzerhostname': 'host-{0}'.format(i % 500),
+                'analyzeripv4': '10.0.{0}.{1}'.format(i // 256 % 256, i % 256),
+                'analyzermac': '00:50:56:{0:02x}:{1:02x}:{2:02x}'.format(i % 256, i // 256 % 256, 7),
+                'analyzerdetectionmethod': 'On-Access Scan',
+                'sourcehostname': None,
+                'sourceipv4': '10.1.0.{0}'.format(i % 256),
+                'sourceprocessname': 'C:\\Windows\\System32\\cmd.exe',
+                'targethostname': 'host-{0}'.format(i % 500),
+                'targetusername': 'CORP\\user{0}'.format(i % 1000),
+                'targetfilename': 'C:\\Users\\user{0}\\Downloads\\invoice_{1}.exe'.format(i % 1000, i),
+                'threatcategory': 'av.detect',
+                'threateventid': 1278,
+                'threatseverity': '2',
+                'threatname': 'GenericRXAA-FA!{0:012X}'.format(random.getrandbits(48)),
+                'threattype': 'trojan',
+                'threatactiontaken': 'IDS_ALERT_ACT_TAK_DEL',
+                'threathandled': True
+            }
+        })
+    return json.dumps({'data': data, 'links': {'next': None}, 'meta': {'totalResourceCount': size}}).encode()
+
+
+def stdlib_path(content):
+    events = [flatten(event) for event in json.loads(content)['data']]
+    return ''.join(json.dumps(event) + '\n' for event in events).encode()
+
+
+def orjson_path(content):
+    events = [flatten(event) for event in orjson.loads(content)['data']]
+    return b''.join(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE) for event in events)
+
+
+def run(name, func, content, events, pages):
+    start = time.perf_counter()
+    for _ in range(pages):
+        func(content)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{0:<8} {1:>12,.0f} events/s {2:>10.2f} ms/page {3:>12,} bytes peak/page'
+          .format(name, events * pages / elapsed, elapsed / pages * 1000, peak))
+
+
+if __name__ == '__main__':
+    usage = """python bench/bench_events_decode.py [-E <EVENTS PER PAGE>] [-P <PAGES>]"""
+    title = 'MVISION API - EPO Events decode benchmark'
+    parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('--events', '-E',
+                        required=False, type=int,
+                        default=1000, help='Events per page (default: 1000)')
+
+    parser.add_argument('--pages', '-P',
+                        required=False, type=int,
+                        default=50, help='Pages decoded per path (default: 50)')
+
+    args = parser.parse_args()
+
+    content = make_page(args.events)
+    print('Page: {0} events, {1:,} bytes'.format(args.events, len(content)))
+
+    run('json', stdlib_path, content, args.events, args.pages)
+    if orjson is not None:
+        run('orjson', orjson_path, content, args.events, args.pages)
+    else:
+        print('orjson is not installed, skipping the fast path.')
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# Per-invocation wall time of short mvapi commands against the offline mock server
+# Compares the mvapi_* scripts, `mvapi --local` and `mvapi` handing the command to a warm `mvapi serve`
+# worker, e.g. for SOAR playbooks that run one lookup per alert.
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import Dataset, MockServer, ioc_hash
+
+# mvapi command, the script it runs and the arguments of both
+COMMANDS = [
+    ('ioc search', 'mvapi_insights_search.py', ['-H', ioc_hash(0), '--no-cache']),
+    ('device', 'mvapi_epo_get_device.py', ['-H', 'host-00001']),
+    ('campaigns', 'mvapi_insights_label.py', ['-L', 'Ransomware'])
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def measure(cmd, env, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError('{0} failed with exit code {1}:\n{2}'
+                               .format(' '.join(cmd), proc.returncode, proc.stderr.decode(errors='replace')))
+    return times
+
+
+def wait_for(fname, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(fname)
+            return True
+        except OSError:
+            time.sleep(0.05)
+        finally:
+            conn.close()
+    return False
+
+
+def main(args):
+    server = MockServer(dataset=Dataset(events=100, devices=100, iocs=100, campaigns=args.campaigns),
+                        latency=args.latency).start()
+    mvapi = [sys.executable, os.path.join(REPO_DIR, 'mvapi.py')]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   MVAPI_CONFIG=os.path.join(tmp, 'config.ini'),
+                   MVAPI_BASE_URL=server.url,
+                   MVAPI_IAM_URL=server.url + '/iam/v1.1/token',
+                   MVAPI_TOKEN_CACHE=os.path.join(tmp, 'tokens.json'),
+                   MVAPI_IOC_CACHE=os.path.join(tmp, 'iocs.sqlite'),
+                   MVAPI_DEVICE_INDEX=os.path.join(tmp, 'devices.sqlite'),
+                   MVAPI_CAMPAIGN_STORE=os.path.join(tmp, 'campaigns.sqlite'),
+                   MVAPI_SOCKET=os.path.join(tmp, 'mvapi.sock'))
+        env.pop('MVAPI_LOCAL', None)
+
+        # fills the token cache and the campaign store, every mode then starts from the same state
+        for command, script, arguments in COMMANDS:
+            measure(mvapi + ['--local'] + command.split() + arguments, env, 1)
+
+        results = []
+        for command, script, arguments in COMMANDS:
+            results.append((command, 'script', measure([sys.executable, script] + arguments, env, args.runs)))
+            results.append((command, 'mvapi --local',
+                            measure(mvapi + ['--local'] + command.split() + arguments, env, args.runs)))
+
+        serve = subprocess.Popen(mvapi + ['serve', '--workers', str(args.workers)], env=env, cwd=REPO_DIR,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_for(env['MVAPI_SOCKET']):
+                print('mvapi serve did not start.', file=sys.stderr)
+                return 1
+            for command, script, arguments in COMMANDS:
+                # the first command of a worker opens its connection and loads the token
+                measure(mvapi + command.split() + arguments, env, args.workers)
+                results.append((command, 'mvapi (serve)', measure(mvapi + command.split() + arguments, env, args.runs)))
+        finally:
+            subprocess.run(mvapi + ['stop'], env=env, stderr=subprocess.DEVNULL)
+            serve.wait(timeout=10)
+
+    server.stop()
+
+    print('{0:<14} {1:<15} {2:>9} {3:>9} {4:>9}'.format('command', 'mode', 'mean ms', 'p50 ms', 'p95 ms'))
+    for command, mode, times in results:
+        print('{0:<14} {1:<15} {2:>9.1f} {3:>9.1f} {4:>9.1f}'.format(
+            command, mode, 1000 * sum(times) / len(times), 1000 * percentile(times, 50), 1000 * percentile(times, 95)))
+    return 0
+
+
+if __name__ == '__main__':
+    usage = """python bench/bench_startup.py [--runs <N>] [--workers <N>] [--campaigns <N>] [--latency <SECONDS>]"""
+    title = 'MVISION API - start-up benchmark'
+    parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('--runs', '-n',
+                        required=False, type=int,
+                        default=20, help='Invocations per command and mode (default: 20)')
+
+    parser.add_argument('--workers',
+                        required=False, type=int,
+                        default=2, help='Workers of mvapi serve (default: 2)')
+
+    parser.add_argument('--campaigns',
+                        required=False, type=int,
+                        default=1000, help='Number of Insights campaigns (default: 1000)')
+
+    parser.add_argument('--latency',
+                        required=False, type=float,
+                        default=0.005, help='Mean response latency of the mock server in seconds (default: 0.005)')
+
+    sys.exit(main(parser.parse_args()))
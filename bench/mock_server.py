@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# Offline stand-in for the MVISION API used for testing and benchmarking the mvapi_* scripts
+# Emulates the IAM token endpoint and the EPO / Insights endpoints the scripts call, with a generated
+# dataset and configurable latency, page size and 429 injection. Point the scripts at it with
+# MVAPI_BASE_URL=http://127.0.0.1:<port> and MVAPI_IAM_URL=http://127.0.0.1:<port>/iam/v1.1/token.
+
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+
+from argparse import ArgumentParser, RawTextHelpFormatter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+CAMPAIGN_LABELS = ['Ransomware', 'APT', 'Banking Trojan', 'Phishing', 'Botnet', 'Cryptominer', 'Wiper']
+OS_PLATFORMS = ['Server', 'Workstation']
+
+
+def ioc_hash(index, type='md5'):
+    return getattr(hashlib, type)('mvapi-ioc-{0}'.format(index).encode()).hexdigest()
+
+
+class Dataset():
+    """Deterministic tenant data: events, devices, tags, tag groups, IOCs and campaigns."""
+    def __init__(self, events=10000, devices=5000, iocs=5000, campaigns=500, seed=1):
+        rnd = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        fmt = '%Y-%m-%dT%H:%M:%S.%f'
+
+        # timestamps spread over the last 6 days with a few events sharing a millisecond
+        start = now - timedelta(days=6)
+        step = (now - start) / max(events, 1)
+        self.events = []
+        for i in range(events):
+            timestamp = (start + step * (i - i % 3)).strftime(fmt)[:-3] + 'Z'
+            self.events.append({
+                'id': '{0:08x}-0000-4000-8000-{1:012x}'.format(rnd.getrandbits(32), i),
+                'type': 'MVEvents',
+                'links': {'self': '/epo/v2/events/{0}'.format(i)},
+                'attributes': {
+                    'timestamp': timestamp,
+                    'autoguid': '{0:032x}'.format(rnd.getrandbits(128)),
+                    'agentguid': '{0:032x}'.format(rnd.getrandbits(128)),
+                    'analyzername': 'McAfee Endpoint Security',
+                    'analyzerhostname': 'host-{0:05d}'.format(rnd.randrange(max(devices, 1))),
+                    'analyzerdetectionmethod': 'On-Access Scan',
+                    'targetfilename': 'C:\\Users\\user{0}\\Downloads\\file_{1}.exe'.format(rnd.randrange(1000), i),
+                    'targethash': ioc_hash(rnd.randrange(iocs * 2)),
+                    'threatname': 'GenericRXAA-FA!{0:012X}'.format(rnd.getrandbits(48)),
+                    'threatseverity': str(rnd.randrange(1, 6)),
+                    'threatactiontaken': 'IDS_ALERT_ACT_TAK_DEL'
+                }
+            })
+
+        self.tag_groups = [{'id': str(i + 1), 'type': 'tagGroups', 'attributes': {'groupName': name}}
+                           for i, name in enumerate(['Default', 'Servers', 'Workstations'])]
+        self.tags = {}
+        for i, name in enumerate(['Server', 'Workstation', 'Quarantine', 'VIP']):
+            self.add_tag({'name': name, 'tagGroupId': 1 + i % 3})
+
+        self.devices = []
+        self.device_ids = {}
+        for i in range(devices):
+            device = {
+                'id': str(1000 + i),
+                'type': 'devices',
+                'links': {'self': '/epo/v2/devices/{0}'.format(1000 + i)},
+                'attributes': {
+                    'name': 'host-{0:05d}'.format(i),
+                    'computerName': 'HOST-{0:05d}'.format(i),
+                    'domainName': 'CORP',
+                    'ipAddress': '10.{0}.{1}.{2}'.format(i // 65536 % 256, i // 256 % 256, i % 256),
+                    'osPlatform': OS_PLATFORMS[i % 2],
+                    'osType': 'Windows Server 2019' if i % 2 == 0 else 'Windows 10',
+                    'agentGuid': '{0:032x}'.format(rnd.getrandbits(128)),
+                    'agentVersion': '5.7.{0}'.format(rnd.randrange(10)),
+                    'tags': 'Server' if i % 2 == 0 else 'Workstation',
+                    'lastUpdate': (now - timedelta(seconds=rnd.randrange(86400 * 7))).strftime(fmt)[:-3] + 'Z'
+                }
+            }
+            self.devices.append(device)
+            self.device_ids[device['id']] = device
+        self.assigned = set()
+
+        # every second known hash has an IOC record, the others are unknown to Insights;
+        # every tenth record also belongs to a second campaign
+        self.iocs = {}
+        self.campaign_iocs = {}
+        for i in range(0, iocs * 2, 2):
+            ids = [str(i % max(campaigns, 1) + 1)]
+            if i % 10 == 0 and campaigns > 1:
+                ids.append(str((i + 1) % campaigns + 1))
+            for type in ('md5', 'sha1', 'sha256'):
+                value = ioc_hash(i, type)
+                self.iocs[value] = {
+                    'id': str(len(self.iocs) + 1),
+                    'type': 'iocs',
+                    'attributes': {
+                        'type': type,
+                        'value': value,
+                        'coverage': {'dat_version': {'min': 4000 + i % 500}},
+                        'category': 'Malware',
+                        'threat': {'severity': rnd.randrange(1, 6)},
+                        'prevalence': rnd.choice(['low', 'medium', 'high']),
+                        'campaigns': [{'id': id} for id in ids]
+                    }
+                }
+                for id in ids:
+                    self.campaign_iocs.setdefault(id, []).append(self.iocs[value])
+
+        self.campaigns = []
+        for i in range(campaigns):
+            self.campaigns.append({
+                'id': str(i + 1),
+                'type': 'campaigns',
+                'attributes': {
+                    'name': 'Campaign {0}'.format(i + 1),
+                    'threat_level_id': rnd.randrange(1, 4),
+                    'description': 'Generated campaign {0}'.format(i + 1),
+                    'created_on': (now - timedelta(days=campaigns - i)).strftime('%Y-%m-%d %H:%M:%S'),
+                    'prevalence': rnd.choice(['low', 'medium', 'high']),
+                    'categories': rnd.sample(CAMPAIGN_LABELS, rnd.randrange(1, 4))
+                }
+            })
+
+        self.lock = threading.Lock()
+
+    def add_tag(self, attributes):
+        tag = {'id': str(len(self.tags) + 1), 'type': 'tags', 'attributes': attributes}
+        self.tags[attributes['name']] = tag
+        return tag
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    routes = [
+        ('POST', r'/iam/v1\.1/token$', 'token'),
+        ('GET', r'/epo/v2/events$', 'events'),
+        ('GET', r'/epo/v2/devices$', 'devices'),
+        ('POST', r'/epo/v2/devices/(\w+)/relationships/assignedTags$', 'assign_tag'),
+        ('DELETE', r'/epo/v2/devices/(\w+)/relationships/assignedTags$', 'unassign_tag'),
+        ('GET', r'/epo/v2/tags$', 'tags'),
+        ('POST', r'/epo/v2/tags$', 'create_tag'),
+        ('GET', r'/epo/v2/tagGroups$', 'tag_groups'),
+        ('GET', r'/insights/v2/iocs$', 'iocs'),
+        ('GET', r'/insights/v2/campaigns$', 'campaigns')
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        self.params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        server = self.server
+        server.count(url.path)
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.latency * 0.2)))
+
+        if server.error_rate and random.random() < server.error_rate:
+            return self.reply(429, {'errors': [{'title': 'Too Many Requests'}]}, {'Retry-After': '1'})
+
+        for route_method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if match and route_method == method:
+                if name != 'token' and not server.authorized(self.headers.get('Authorization')):
+                    return self.reply(401, {'errors': [{'title': 'Unauthorized'}]})
+                status, body = getattr(self, name)(url.path, *match.groups())
+                return self.reply(status, body)
+
+        self.reply(404, {'errors': [{'title': 'Not Found'}]})
+
+    def reply(self, status, body=None, headers=None):
+        content = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.api+json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def page(self, path, items, limit_key='page[limit]', offset_key='page[offset]'):
+        """Slice items by limit/offset and add links.next while more items follow."""
+        limit = min(int(self.params.get(limit_key) or self.server.page_size), self.server.page_size)
+        offset = int(self.params.get(offset_key) or 0)
+        document = {'data': items[offset:offset + limit], 'links': {}, 'meta': {'totalResourceCount': len(items)}}
+        if offset + limit < len(items):
+            params = dict(self.params, **{limit_key: limit, offset_key: offset + limit})
+            document['links']['next'] = '{0}?{1}'.format(path, urlencode(params))
+        return document
+
+    def token(self, path):
+        return 200, {'access_token': self.server.issue_token(), 'token_type': 'Bearer', 'expires_in': 3600}
+
+    def events(self, path):
+        events = self.server.dataset.events
+        bounds = [('GE', lambda a, b: a >= b), ('GT', lambda a, b: a > b), ('LT', lambda a, b: a < b),
+                  ('LE', lambda a, b: a <= b)]
+        for operator, compare in bounds:
+            value = self.params.get('filter[timestamp][{0}]'.format(operator))
+            if value:
+                events = [event for event in events if compare(event['attributes']['timestamp'], value)]
+        return 200, self.page(path, events)
+
+    def devices(self, path):
+        devices = self.server.dataset.devices
+        if self.params.get('filter[name][eq]'):
+            name = self.params['filter[name][eq]'].lower()
+            devices = [device for device in devices if device['attributes']['name'] == name]
+        elif self.params.get('filter[name][in]'):
+            names = set(name.lower() for name in self.params['filter[name][in]'].split(','))
+            devices = [device for device in devices if device['attributes']['name'] in names]
+        if self.params.get('filter[lastUpdate][GT]'):
+            since = self.params['filter[lastUpdate][GT]']
+            devices = [device for device in devices if device['attributes']['lastUpdate'] > since]
+
+        if self.params.get('fields[devices]'):
+            fields = self.params['fields[devices]'].split(',')
+            devices = [dict(device, attributes={field: device['attributes'].get(field) for field in fields})
+                       for device in devices]
+        return 200, self.page(path, devices)
+
+    def set_tag(self, device_id, assign):
+        dataset = self.server.dataset
+        if device_id not in dataset.device_ids:
+            return 404, {'errors': [{'title': 'Device not found'}]}
+
+        with dataset.lock:
+            for tag in json.loads(self.body or b'{}').get('data', []):
+                key = (device_id, str(tag['id']))
+                if assign and key in dataset.assigned:
+                    return 409, {'errors': [{'title': 'Tag already assigned'}]}
+                if not assign and key not in dataset.assigned:
+                    return 404, {'errors': [{'title': 'Tag not assigned'}]}
+                if assign:
+                    dataset.assigned.add(key)
+                else:
+                    dataset.assigned.discard(key)
+        return 204, None
+
+    def assign_tag(self, path, device_id):
+        return self.set_tag(device_id, True)
+
+    def unassign_tag(self, path, device_id):
+        return self.set_tag(device_id, False)
+
+    def tags(self, path):
+        tags = list(self.server.dataset.tags.values())
+        if self.params.get('filter[name][eq]'):
+            tags = [tag for tag in tags if tag['attributes']['name'] == self.params['filter[name][eq]']]
+        return 200, self.page(path, tags)
+
+    def create_tag(self, path):
+        attributes = json.loads(self.body or b'{}').get('data', {}).get('attributes', {})
+        dataset = self.server.dataset
+        with dataset.lock:
+            if attributes.get('name') in dataset.tags:
+                return 409, {'errors': [{'title': 'Tag already exists'}]}
+            return 201, {'data': dataset.add_tag(attributes)}
+
+    def tag_groups(self, path):
+        return 200, {'data': self.server.dataset.tag_groups}
+
+    def iocs(self, path):
+        iocs = self.server.dataset.iocs
+        if self.params.get('filter[campaign_id]'):
+            return 200, self.page(path, self.server.dataset.campaign_iocs.get(self.params['filter[campaign_id]'], []),
+                                  'limit', 'offset')
+        if self.params.get('filter[value][in]'):
+            values = self.params['filter[value][in]'].lower().split(',')
+        else:
+            values = [self.params.get('filter[value]', '').lower()]
+        type = self.params.get('filter[type][eq]')
+        data = [iocs[value] for value in values if value in iocs and (not type or iocs[value]['attributes']['type'] == type)]
+        return 200, {'data': data}
+
+    def campaigns(self, path):
+        campaigns = self.server.dataset.campaigns
+        if self.params.get('sort') == '-created_on':
+            campaigns = campaigns[::-1]
+        return 200, self.page(path, campaigns, 'limit', 'offset')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), dataset=None, latency=0.0, page_size=1000, error_rate=0.0,
+                 verbose=False):
+        super().__init__(address, MockHandler)
+        self.dataset = dataset or Dataset()
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.tokens = set()
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def issue_token(self):
+        token = '{0:032x}'.format(random.getrandbits(128))
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def authorized(self, header):
+        return bool(header) and header.startswith('Bearer ') and header[len('Bearer '):] in self.tokens
+
+    def count(self, path):
+        # /epo/v2/devices/<id>/relationships/assignedTags is counted as one endpoint
+        path = re.sub(r'/devices/\w+/', '/devices/{id}/', path)
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    usage = """python bench/mock_server.py [-p <PORT>] [--events <N>] [--devices <N>] [--iocs <N>] [--campaigns <N>]
+       [--latency <SECONDS>] [--page-size <N>] [--error-rate <0..1>]"""
+    title = 'MVISION API - offline mock server'
+    parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('--port', '-p',
+                        required=False, type=int,
+                        default=8080, help='Port to listen on (default: 8080)')
+
+    parser.add_argument('--events',
+                        required=False, type=int,
+                        default=10000, help='Number of EPO events (default: 10000)')
+
+    parser.add_argument('--devices',
+                        required=False, type=int,
+                        default=5000, help='Number of EPO devices (default: 5000)')
+
+    parser.add_argument('--iocs',
+                        required=False, type=int,
+                        default=5000, help='Number of known Insights IOCs per hash type (default: 5000)')
+
+    parser.add_argument('--campaigns',
+                        required=False, type=int,
+                        default=500, help='Number of Insights campaigns (default: 500)')
+
+    parser.add_argument('--latency',
+                        required=False, type=float,
+                        default=0.0, help='Mean response latency in seconds (default: 0)')
+
+    parser.add_argument('--page-size',
+                        required=False, type=int,
+                        default=1000, help='Largest page the server returns (default: 1000)')
+
+    parser.add_argument('--error-rate',
+                        required=False, type=float,
+                        default=0.0, help='Share of requests answered with 429 (default: 0)')
+
+    parser.add_argument('--verbose', '-v',
+                        action='store_true',
+                        help='Log every request')
+
+    args = parser.parse_args()
+
+    dataset = Dataset(events=args.events, devices=args.devices, iocs=args.iocs, campaigns=args.campaigns)
+    server = MockServer(('127.0.0.1', args.port), dataset, latency=args.latency, page_size=args.page_size,
+                        error_rate=args.error_rate, verbose=args.verbose)
+    print('Mock MVISION API listening on {0}'.format(server.url))
+    print('export MVAPI_BASE_URL={0} MVAPI_IAM_URL={0}/iam/v1.1/token'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of the mvapi_* scripts against the offline mock server
+# Every workload runs in its own process so peak RSS is measured per script. Reports throughput,
+# p50/p99 request latency as seen by the client (including retries) and peak RSS, and can compare
+# a run against a saved baseline to catch performance regressions offline.
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser, Namespace, RawTextHelpFormatter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import Dataset, MockServer, ioc_hash
+
+WORKLOADS = ['events', 'events_backfill', 'events_enrich', 'device_export', 'device_sync', 'assign_tag', 'add_tag',
+             'insights_search', 'insights_label', 'insights_export']
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def timed(latencies):
+    """Record the latency of every request sent by the sync and asyncio clients."""
+    import mvapi_client
+
+    send = mvapi_client.ScheduledAdapter.send
+    request = mvapi_client.AsyncMVAPIClient.request
+
+    def timed_send(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def timed_request(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await request(self, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    mvapi_client.ScheduledAdapter.send = timed_send
+    mvapi_client.AsyncMVAPIClient.request = timed_request
+
+
+def run_workload(name, tmp, size):
+    """Run one workload in this process and return the number of items it processed."""
+    if name in ('events', 'events_backfill', 'events_enrich'):
+        import mvapi_epo_get_events
+        api = mvapi_epo_get_events.MVAPI()
+        # keep the checkpoint out of the repository and start from the default 7 day window
+        api.checkpoint = mvapi_epo_get_events.Checkpoint(os.path.join(tmp, name + '.cache.log'))
+        if name == 'events_enrich':
+            from mvapi_enrich import Enricher
+            from mvapi_insights_search import MVAPI as InsightsAPI
+            api.enricher = Enricher(InsightsAPI(use_cache=False))
+        pages = api.iter_backfill_pages(slices=8, workers=4) if name == 'events_backfill' else None
+        return api.stream_events(os.devnull, pages=pages)
+
+    if name in ('device_export', 'device_sync'):
+        import mvapi_epo_get_device
+        mvapi_epo_get_device.args = Namespace(host=None)
+        api = mvapi_epo_get_device.MVAPI()
+        if name == 'device_sync':
+            api.sync_index(full=True)
+            return size['devices']
+        return api.export_devices(os.devnull, 'ndjson')
+
+    if name == 'assign_tag':
+        import mvapi_epo_assign_tag
+        hosts = os.path.join(tmp, 'hosts.txt')
+        with open(hosts, 'w') as fh:
+            fh.write(''.join('host-{0:05d}\n'.format(i) for i in range(size['devices'])))
+        mvapi_epo_assign_tag.args = Namespace(host=None, file=hosts, tag='Quarantine', type='assign',
+                                              batch_size=100, workers=16, no_index=True)
+        summary = mvapi_epo_assign_tag.MVAPI().bulk_tag(hosts)
+        return sum(len(hosts) for hosts in summary.values())
+
+    if name == 'add_tag':
+        import mvapi_epo_add_tag
+        mvapi_epo_add_tag.args = Namespace(tag=None, group='Default', criteria=None, dry_run=False, matches=None,
+                                           manifest=None, workers=8, tenants=None)
+        api = mvapi_epo_add_tag.MVISIONAPI()
+        api.connect()
+        count = 100
+        for i in range(count):
+            api.tagname = 'bench-{0}-{1}'.format(os.getpid(), i)
+            api.create_tag(api.get_tag_groups())
+        return count
+
+    if name == 'insights_search':
+        import mvapi_insights_search
+        hashes = os.path.join(tmp, 'hashes.txt')
+        with open(hashes, 'w') as fh:
+            fh.write(''.join(ioc_hash(i) + '\n' for i in range(size['iocs'])))
+        api = mvapi_insights_search.MVAPI(use_cache=False)
+        api.search_bulk(hashes, os.devnull, batch_size=50, workers=8)
+        return size['iocs']
+
+    if name == 'insights_label':
+        import mvapi_insights_label
+        mvapi_insights_label.MVAPI().get_campaigns('Ransomware OR APT', refresh=True)
+        return size['campaigns']
+
+    if name == 'insights_export':
+        import mvapi_insights_label
+        counts = mvapi_insights_label.MVAPI().export_iocs('Ransomware OR APT', os.devnull, 'csv', refresh=True)
+        return counts['written'] + counts['duplicates']
+
+    raise ValueError('Unknown workload {0}'.format(name))
+
+
+def worker(name, tmp, size, unlimited):
+    import mvapi_ratelimit
+
+    if unlimited:
+        # measure the scripts themselves instead of the production request rates
+        mvapi_ratelimit.scheduler = mvapi_ratelimit.Scheduler({family: (1e6, 1e6, 64, 1e6)
+                                                               for family in mvapi_ratelimit.LIMITS})
+    logging.disable(logging.INFO)
+
+    latencies = []
+    timed(latencies)
+
+    start = time.perf_counter()
+    items = run_workload(name, tmp, size)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'workload': name,
+        'items': items,
+        'seconds': elapsed,
+        'items_per_sec': items / elapsed if elapsed else 0.0,
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'retries': mvapi_ratelimit.scheduler.retries,
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024 if sys.platform == 'darwin'
+                                                                             else 1024.0)
+    }
+
+
+def main(args):
+    size = {'events': args.events, 'devices': args.devices, 'iocs': args.iocs, 'campaigns': args.campaigns}
+    workloads = args.workloads.split(',') if args.workloads else WORKLOADS
+
+    dataset = Dataset(**size)
+    server = MockServer(dataset=dataset, latency=args.latency, page_size=args.page_size,
+                        error_rate=args.error_rate).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   MVAPI_CONFIG=os.path.join(tmp, 'config.ini'),
+                   MVAPI_BASE_URL=server.url,
+                   MVAPI_IAM_URL=server.url + '/iam/v1.1/token',
+                   MVAPI_TOKEN_CACHE=os.path.join(tmp, 'tokens.json'),
+                   MVAPI_IOC_CACHE=os.path.join(tmp, 'iocs.sqlite'),
+                   MVAPI_DEVICE_INDEX=os.path.join(tmp, 'devices.sqlite'),
+                   MVAPI_CAMPAIGN_STORE=os.path.join(tmp, 'campaigns.sqlite'))
+
+        for name in workloads:
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker', name, '--tmp', tmp,
+                   '--events', str(args.events), '--devices', str(args.devices), '--iocs', str(args.iocs),
+                   '--campaigns', str(args.campaigns)]
+            if args.unlimited:
+                cmd.append('--unlimited')
+
+            proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode != 0 or not proc.stdout.strip():
+                print('{0}: failed with exit code {1}'.format(name, proc.returncode), file=sys.stderr)
+                results.append({'workload': name, 'error': proc.returncode})
+                continue
+            results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{0:<16} {1:>8} {2:>8} {3:>12} {4:>9} {5:>9} {6:>9} {7:>8} {8:>9}'
+              .format('workload', 'items', 'seconds', 'items/s', 'requests', 'p50 ms', 'p99 ms', 'retries', 'RSS MB'))
+        for result in results:
+            if 'error' in result:
+                print('{0:<16} failed'.format(result['workload']))
+                continue
+            print('{workload:<16} {items:>8} {seconds:>8.2f} {items_per_sec:>12,.0f} {requests:>9} {p50_ms:>9.2f} '
+                  '{p99_ms:>9.2f} {retries:>8} {peak_rss_mb:>9.1f}'.format(**result))
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    failed = any('error' in result for result in results)
+    if args.baseline:
+        failed = compare(results, args.baseline, args.tolerance) or failed
+    return 1 if failed else 0
+
+
+def compare(results, baseline, tolerance):
+    """Flag workloads whose throughput dropped or peak RSS grew by more than tolerance."""
+    with open(baseline, 'r') as fh:
+        previous = {result['workload']: result for result in json.load(fh) if 'error' not in result}
+
+    regressed = False
+    for result in results:
+        before = previous.get(result['workload'])
+        if 'error' in result or before is None:
+            continue
+        if result['items_per_sec'] < before['items_per_sec'] * (1 - tolerance):
+            print('REGRESSION {0}: {1:,.0f} items/s, baseline {2:,.0f} items/s'
+                  .format(result['workload'], result['items_per_sec'], before['items_per_sec']))
+            regressed = True
+        if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+            print('REGRESSION {0}: peak RSS {1:.1f} MB, baseline {2:.1f} MB'
+                  .format(result['workload'], result['peak_rss_mb'], before['peak_rss_mb']))
+            regressed = True
+    return regressed
+
+
+if __name__ == '__main__':
+    usage = """python bench/run_bench.py [-w <WORKLOAD,...>] [--events <N>] [--devices <N>] [--iocs <N>] [--campaigns <N>]
+       [--latency <SECONDS>] [--page-size <N>] [--error-rate <0..1>] [--unlimited]
+       [--json] [--save <FILE>] [--baseline <FILE> [--tolerance <SHARE>]]
+
+WORKLOADS: {0}""".format(', '.join(WORKLOADS))
+    title = 'MVISION API - end-to-end benchmark'
+    parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
+
+    parser.add_argument('--workloads', '-w',
+                        required=False, type=str,
+                        default=None, help='Comma separated workloads to run (default: all)')
+
+    parser.add_argument('--events',
+                        required=False, type=int,
+                        default=20000, help='Number of EPO events (default: 20000)')
+
+    parser.add_argument('--devices',
+                        required=False, type=int,
+                        default=5000, help='Number of EPO devices (default: 5000)')
+
+    parser.add_argument('--iocs',
+                        required=False, type=int,
+                        default=2000, help='Number of hashes searched in Insights (default: 2000)')
+
+    parser.add_argument('--campaigns',
+                        required=False, type=int,
+                        default=1000, help='Number of Insights campaigns (default: 1000)')
+
+    parser.add_argument('--latency',
+                        required=False, type=float,
+                        default=0.005, help='Mean response latency of the mock server in seconds (default: 0.005)')
+
+    parser.add_argument('--page-size',
+                        required=False, type=int,
+                        default=1000, help='Largest page the mock server returns (default: 1000)')
+
+    parser.add_argument('--error-rate',
+                        required=False, type=float,
+                        default=0.0, help='Share of requests answered with 429 (default: 0)')
+
+    parser.add_argument('--unlimited',
+                        action='store_true',
+                        help='Lift the client side rate limits to measure the scripts alone')
+
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='Print the results as JSON')
+
+    parser.add_argument('--save',
+                        required=False, type=str,
+                        default=None, help='Save the results as a baseline file')
+
+    parser.add_argument('--baseline',
+                        required=False, type=str,
+                        default=None, help='Compare against a saved baseline and exit 1 on regressions')
+
+    parser.add_argument('--tolerance',
+                        required=False, type=float,
+                        default=0.2, help='Allowed throughput drop or RSS growth against the baseline (default: 0.2)')
+
+    parser.add_argument('--worker',
+                        required=False, type=str,
+                        default=None, help='Internal: run a single workload in this process')
+
+    parser.add_argument('--tmp',
+                        required=False, type=str,
+                        default=None, help='Internal: working directory of the worker')
+
+    args = parser.parse_args()
+
+    if args.worker:
+        size = {'events': args.events, 'devices': args.devices, 'iocs': args.iocs, 'campaigns': args.campaigns}
+        print(json.dumps(worker(args.worker, args.tmp, size, args.unlimited)))
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# Single entry point for the mvapi_* scripts
+# `mvapi <command> [options]` runs the script of the command in this process and only imports what the command
+# needs. `mvapi serve` keeps warm worker processes behind a UNIX socket: later invocations hand their stdin,
+# stdout and stderr to a worker, which runs the command with modules, keep-alive connections and tokens loaded.
+
+import os
+import sys
+import json
+import socket
+
+COMMANDS = {
+    'events': 'mvapi_epo_get_events',
+    'device': 'mvapi_epo_get_device',
+    'tag add': 'mvapi_epo_add_tag',
+    'tag assign': 'mvapi_epo_assign_tag',
+    'ioc search': 'mvapi_insights_search',
+    'campaigns': 'mvapi_insights_label'
+}
+
+SOCKET_FNAME = os.environ.get('MVAPI_SOCKET', os.path.join(os.path.expanduser('~'), '.mvapi', 'mvapi.sock'))
+
+# environment variables that only steer this entry point and may differ between client and server
+LOCAL_ENV = ('MVAPI_SOCKET', 'MVAPI_LOCAL')
+
+USAGE = """usage: mvapi [--local] <command> [options]      (mvapi <command> -h lists the options of a command)
+       mvapi serve [--workers <N>] [--max-requests <N>]
+       mvapi stop
+
+commands:
+  events        MVISION EPO threat events (mvapi_epo_get_events.py)
+  device        MVISION EPO device details and exports (mvapi_epo_get_device.py)
+  tag add       create MVISION EPO tags (mvapi_epo_add_tag.py)
+  tag assign    assign or unassign MVISION EPO tags (mvapi_epo_assign_tag.py)
+  ioc search    search hashes in MVISION Insights (mvapi_insights_search.py)
+  campaigns     MVISION Insights campaigns by label (mvapi_insights_label.py)
+  serve         keep warm workers on {0}, commands run in them while it is up
+  stop          stop the running server
+
+--local or MVAPI_LOCAL=1 runs the command in this process even if a server is up.""".format(SOCKET_FNAME)
+
+
+def resolve(argv):
+    """Split argv into the script module of the command and the script arguments."""
+    for words in (2, 1):
+        module = COMMANDS.get(' '.join(argv[:words]))
+        if module and len(argv) >= words:
+            return module, argv[words:]
+    return None, argv
+
+
+def exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def run_local(module, args):
+    """Run the script as __main__ in this process and return its exit code."""
+    import runpy
+    import traceback
+
+    sys.argv = [module + '.py'] + list(args)
+    try:
+        runpy.run_module(module, run_name='__main__', alter_sys=True)
+    except SystemExit as exit:
+        return exit_code(exit.code)
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def stdio_fds():
+    # a caller without stdin/stdout/stderr (closed descriptors) passes /dev/null instead
+    fds = []
+    for fd in (0, 1, 2):
+        try:
+            os.fstat(fd)
+            fds.append(fd)
+        except OSError:
+            fds.append(os.open(os.devnull, os.O_RDWR))
+    return fds
+
+
+def run_remote(argv):
+    """Run the command in a warm worker of `mvapi serve`. Returns the exit code, None if no server can run it."""
+    if os.environ.get('MVAPI_LOCAL') or not os.path.exists(SOCKET_FNAME):
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(SOCKET_FNAME)
+        request = {
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': {key: value for key, value in os.environ.items()
+                    if key.startswith('MVAPI_') and key not in LOCAL_ENV}
+        }
+        socket.send_fds(conn, [json.dumps(request).encode() + b'\n'], stdio_fds())
+        reader = conn.makefile('rb')
+    except OSError:
+        conn.close()
+        return None
+
+    interrupted = False
+    while True:
+        try:
+            line = reader.readline()
+            break
+        except KeyboardInterrupt:
+            if interrupted:
+                return 130
+            # the worker gets the SIGINT, e.g. to stop --follow cleanly; a second Ctrl-C gives up
+            conn.sendall(b'INT\n')
+            interrupted = True
+
+    conn.close()
+    if not line:
+        print('mvapi server closed the connection.', file=sys.stderr)
+        return 1
+
+    response = json.loads(line)
+    if 'fallback' in response:
+        return None
+    return response['exit']
+
+
+class Worker():
+    """Runs one command at a time with the caller's stdio; sessions stay open between commands."""
+    def __init__(self, listener, max_requests=1000):
+        import signal
+
+        import mvapi_client
+        # one keep-alive pool and token per tenant and scope for every command of this worker
+        mvapi_client.sessions = {}
+
+        self.listener = listener
+        self.max_requests = max_requests
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def run(self):
+        for _ in range(self.max_requests):
+            conn, _ = self.listener.accept()
+            with conn:
+                try:
+                    self.handle(conn)
+                except OSError:
+                    # the caller went away
+                    continue
+
+    @staticmethod
+    def receive(conn):
+        data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+        while data and not data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data) if data else {}, fds
+
+    @staticmethod
+    def mismatch(env):
+        ours = {key: value for key, value in os.environ.items() if key.startswith('MVAPI_') and key not in LOCAL_ENV}
+        return sorted(key for key in set(env) | set(ours) if env.get(key) != ours.get(key))
+
+    def handle(self, conn):
+        import signal
+        import logging
+        import threading
+
+        import mvapi_config
+
+        request, fds = self.receive(conn)
+        if request.get('command') == 'stop':
+            os.kill(os.getppid(), signal.SIGTERM)
+            conn.sendall(b'{"exit": 0}\n')
+            return
+
+        module, args = resolve(request.get('argv', []))
+        # the config and caches of this worker were loaded for its own environment
+        if module is None or len(fds) != 3 or self.mismatch(request.get('env', {})):
+            for fd in fds:
+                os.close(fd)
+            conn.sendall(b'{"fallback": true}\n')
+            return
+
+        done = threading.Event()
+
+        def watch():
+            # forwards a Ctrl-C of the caller; a caller that disappears stops the command as well
+            while not done.is_set():
+                try:
+                    data = conn.recv(16)
+                except OSError:
+                    data = b''
+                if done.is_set():
+                    return
+                os.kill(os.getpid(), signal.SIGINT)
+                if not data:
+                    return
+
+        saved = [os.dup(fd) for fd in (0, 1, 2)]
+        stdin = sys.stdin
+        logger = logging.getLogger('logs')
+        level, handlers = logger.level, list(logger.handlers)
+        cwd = os.getcwd()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, client_fd in zip((0, 1, 2), fds):
+            os.dup2(client_fd, fd)
+            os.close(client_fd)
+        # no input buffered by an earlier command
+        sys.stdin = open(0, 'r', closefd=False)
+
+        # profiles edited in config.ini since the last command
+        mvapi_config.reload()
+
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            os.chdir(request.get('cwd') or cwd)
+            code = run_local(module, args)
+        finally:
+            done.set()
+            for stream in (sys.stdout, sys.stderr):
+                try:
+                    stream.flush()
+                except (OSError, ValueError):
+                    pass
+            sys.stdin = stdin
+            for fd, saved_fd in zip((0, 1, 2), saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            os.chdir(cwd)
+            logger.setLevel(level)
+            logger.handlers = handlers
+            # e.g. --follow installs its own handlers
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        conn.sendall(json.dumps({'exit': code}).encode() + b'\n')
+
+
+def preload():
+    """Import everything the commands need once, before the workers are forked."""
+    import importlib
+
+    import mvapi_client
+    mvapi_client.load_aiohttp()
+    for module in COMMANDS.values():
+        importlib.import_module(module)
+
+
+def serve(workers=4, max_requests=1000):
+    import signal
+    import logging
+
+    # not on the root logger, the 'logs' logger of the commands would print every line twice
+    logger = logging.getLogger('mvapi.serve')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s;%(levelname)s;%(message)s'))
+    logger.addHandler(handler)
+
+    if os.path.exists(SOCKET_FNAME):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(SOCKET_FNAME)
+            logger.error('An mvapi server is already listening on {0}.'.format(SOCKET_FNAME))
+            return 1
+        except OSError:
+            os.unlink(SOCKET_FNAME)
+        finally:
+            probe.close()
+
+    preload()
+
+    os.makedirs(os.path.dirname(SOCKET_FNAME) or '.', mode=0o700, exist_ok=True)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(SOCKET_FNAME)
+    os.chmod(SOCKET_FNAME, 0o600)
+    listener.listen(128)
+
+    children = set()
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                Worker(listener, max_requests).run()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                code = 1
+            os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+    logger.info('Serving {0} workers on {1}.'.format(workers, SOCKET_FNAME))
+
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            children.discard(pid)
+            # workers are replaced after max_requests commands or a crash
+            if not stopping:
+                spawn()
+    finally:
+        listener.close()
+        try:
+            os.unlink(SOCKET_FNAME)
+        except OSError:
+            pass
+    logger.info('mvapi server stopped.')
+    return 0
+
+
+def stop_server():
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(SOCKET_FNAME)
+        conn.sendall(json.dumps({'command': 'stop'}).encode() + b'\n')
+        conn.recv(64)
+    except OSError:
+        print('No mvapi server is listening on {0}.'.format(SOCKET_FNAME), file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+def main(argv):
+    if not argv or argv[0] in ('-h', '--help'):
+        print(USAGE)
+        return 0 if argv else 2
+
+    if argv[0] == 'serve':
+        from argparse import ArgumentParser
+
+        parser = ArgumentParser(prog='mvapi serve', description='MVISION API - warm worker server')
+        parser.add_argument('--workers', '-W',
+                            required=False, type=int,
+                            default=4, help='Worker processes, i.e. commands run at the same time (default: 4)')
+        parser.add_argument('--max-requests',
+                            required=False, type=int,
+                            default=1000, help='Commands per worker before it is replaced (default: 1000)')
+        args = parser.parse_args(argv[1:])
+        return serve(args.workers, args.max_requests)
+
+    if argv[0] == 'stop':
+        return stop_server()
+
+    local = argv[0] == '--local'
+    if local:
+        argv = argv[1:]
+
+    module, args = resolve(argv)
+    if module is None:
+        print(USAGE, file=sys.stderr)
+        return 2
+
+    if not local:
+        code = run_remote(argv)
+        if code is not None:
+            return code
+    return run_local(module, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+# Local SQLite snapshot of MVISION Insights campaigns
+# Keeps an inverted index from label to campaign ids so label queries are answered without a download,
+# and a content hash per campaign so a sync only writes and reports new and changed campaigns.
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+STORE_FNAME = os.environ.get('MVAPI_CAMPAIGN_STORE',
+                             os.path.join(os.path.expanduser('~'), '.mvapi', 'campaigns.sqlite'))
+
+# Snapshot older than this is downloaded again
+MAX_AGE = 3600
+# Incremental syncs only see new campaigns; edits of older ones and removals are picked up by a full sync
+FULL_SYNC_AGE = 24 * 3600
+
+
+class CampaignStore():
+    def __init__(self, fname=STORE_FNAME):
+        os.makedirs(os.path.dirname(fname) or '.', mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(fname, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS campaigns (id TEXT PRIMARY KEY, created_on TEXT, campaign TEXT, '
+                        'hash TEXT)')
+        if 'hash' not in [row[1] for row in self.db.execute('PRAGMA table_info(campaigns)')]:
+            # snapshots written by older versions
+            self.db.execute('ALTER TABLE campaigns ADD COLUMN hash TEXT')
+        self.db.execute('CREATE TABLE IF NOT EXISTS labels (label TEXT, campaign_id TEXT, '
+                        'PRIMARY KEY (label, campaign_id)) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        self.removed = 0
+
+    def age(self, key='fetched_at'):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return time.time() - float(row[0]) if row else float('inf')
+
+    @staticmethod
+    def digest(campaign):
+        return hashlib.sha1(json.dumps(campaign['attributes'], sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def encode(campaign):
+        return json.dumps(campaign, separators=(',', ':'))
+
+    def watermark(self):
+        return self.db.execute('SELECT MAX(created_on) FROM campaigns').fetchone()[0]
+
+    def merge(self, pages, full=False):
+        """
+        Write new and changed campaigns and return them as (status, campaign) tuples, status being 'new'
+        or 'changed'. Without full, pages are expected newest first: the download stops at the first page
+        that brings nothing new and holds no campaign newer than the newest stored one. A full sync
+        reads every page and drops the campaigns that are gone from the catalogue.
+        """
+        hashes = dict(self.db.execute('SELECT id, hash FROM campaigns'))
+        watermark = self.watermark()
+        seen = set()
+        changes = []
+        self.removed = 0
+
+        with self.db:
+            for page in pages:
+                rows = []
+                labels = []
+                for campaign in page:
+                    id = str(campaign['id'])
+                    digest = self.digest(campaign)
+                    seen.add(id)
+                    if hashes.get(id) == digest:
+                        continue
+                    changes.append(('changed' if id in hashes else 'new', campaign))
+                    rows.append((id, campaign['attributes'].get('created_on'), self.encode(campaign), digest))
+                    labels.extend((label, id) for label in campaign['attributes'].get('categories') or [])
+
+                if rows:
+                    self.db.executemany('INSERT OR REPLACE INTO campaigns VALUES (?, ?, ?, ?)', rows)
+                    self.db.executemany('DELETE FROM labels WHERE campaign_id = ?', [(row[0],) for row in rows])
+                    self.db.executemany('INSERT OR IGNORE INTO labels VALUES (?, ?)', labels)
+
+                created = [campaign['attributes'].get('created_on') or '' for campaign in page]
+                newest_first = created == sorted(created, reverse=True)
+                if not full and not rows and newest_first and watermark and created and created[0] <= watermark:
+                    break
+
+            if full:
+                removed = [(id,) for id in hashes if id not in seen]
+                self.db.executemany('DELETE FROM campaigns WHERE id = ?', removed)
+                self.db.executemany('DELETE FROM labels WHERE campaign_id = ?', removed)
+                self.removed = len(removed)
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('full_sync_at', ?)", (str(time.time()),))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fetched_at', ?)", (str(time.time()),))
+        return changes
+
+    @staticmethod
+    def parse(expression):
+        """Parse 'A AND B OR C' into [['A', 'B'], ['C']]; AND binds tighter than OR."""
+        return [[label.strip() for label in group.split(' AND ')] for group in expression.split(' OR ')]
+
+    def ids(self, label):
+        return set(row[0] for row in self.db.execute('SELECT campaign_id FROM labels WHERE label = ?', (label,)))
+
+    def query(self, expression, within=None):
+        """Return the campaigns matching a label expression, oldest first, optionally only those with ids in within."""
+        matches = set()
+        for group in self.parse(expression):
+            ids = self.ids(group[0])
+            for label in group[1:]:
+                ids &= self.ids(label)
+            matches |= ids
+        if within is not None:
+            matches &= set(within)
+
+        campaigns = [json.loads(row[0]) for row in
+                     self.db.execute('SELECT campaign FROM campaigns WHERE id IN (SELECT value FROM json_each(?)) '
+                                     'ORDER BY created_on', (json.dumps(sorted(matches)),))]
+        return campaigns
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,278 @@
+# Shared MVISION API client core for the mvapi_* scripts
+# Provides logging, IAM authentication, a pooled keep-alive session and JSON:API pagination, plus an
+# asyncio client (aiohttp) for workloads with many concurrent lookups over a few connections.
+
+import sys
+import time
+import logging
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from mvapi_config import ConfigError, Profile, load
+from mvapi_json import loads
+from mvapi_metrics import metrics, start as start_metrics
+from mvapi_ratelimit import family, for_profile, scheduler
+from mvapi_token_cache import AuthError, TokenCache, authenticate
+
+# set to a dict by `mvapi serve`: a warm worker keeps one session, i.e. one keep-alive pool and token,
+# per tenant and scope for all the commands it runs
+sessions = None
+
+# aiohttp takes longer to import than everything else together, so only the asyncio client imports it
+aiohttp = None
+_aiohttp_loaded = False
+
+
+def load_aiohttp():
+    """Import aiohttp on first use and return it, or None if it is not installed."""
+    global aiohttp, _aiohttp_loaded
+    if not _aiohttp_loaded:
+        try:
+            import aiohttp as module
+        except ImportError:
+            module = None
+        aiohttp = module
+        _aiohttp_loaded = True
+    return aiohttp
+
+
+class MVAPIError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__('{0} - {1}'.format(status_code, text))
+        self.status_code = status_code
+        self.text = text
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """
+    Transport adapter that sends every request through the rate-limit scheduler and retries
+    429, 5xx and connection errors with Retry-After or jittered exponential backoff.
+    """
+    def __init__(self, *args, **kwargs):
+        self.scheduler = kwargs.pop('scheduler', scheduler)
+        self.pool_size = kwargs.get('pool_maxsize')
+        self.logger = logging.getLogger('logs')
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        name = family(request.url)
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        attempt = 0
+        while True:
+            self.scheduler.acquire(name)
+            res = None
+            error = None
+            status = 0
+            headers = {}
+            received = 0
+            start = time.perf_counter()
+            try:
+                res = super().send(request, **kwargs)
+                status, headers = res.status_code, res.headers
+                if not kwargs.get('stream'):
+                    # read here instead of in the session so the latency includes the body
+                    received = len(res.content)
+            except requests.ConnectionError as exc:
+                error = exc
+            finally:
+                self.scheduler.release(name, status, headers)
+                metrics.request(name, request.method, request.url, status, time.perf_counter() - start, sent, received)
+
+            if not self.scheduler.should_retry(request.method, request.url, status, attempt):
+                if error is not None:
+                    raise error
+                return res
+
+            metrics.retry(name, request.url, status)
+            delay = self.scheduler.backoff(name, status, headers, attempt)
+            self.logger.warning('HTTP {0} from {1} {2}. Retry {3} in {4:.1f}s.'
+                                .format(status or 'connection error', request.method, request.url.split('?')[0],
+                                        attempt + 1, delay))
+            if res is not None:
+                res.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+class MVAPIClient():
+    # IAM scope requested by the script, set by every subclass
+    scope = ''
+
+    def __init__(self, api_key='', client_id='', client_token='', base_url=None, level='DEBUG', pool_size=10,
+                 profile=None):
+        self.logging(level)
+        # metrics endpoint, snapshots and cProfile as configured in the environment, see mvapi_metrics
+        start_metrics()
+
+        # explicit arguments win over the profile (see mvapi_config)
+        try:
+            self.profile = profile if isinstance(profile, Profile) else load(profile)
+        except ConfigError as error:
+            self.logger.error(str(error))
+            sys.exit()
+
+        self.base_url = base_url or self.profile.base_url
+        self.iam_url = self.profile.iam_url
+        self.scheduler = for_profile(self.profile.name, self.profile.rates)
+        if sessions is None:
+            self.session = requests.Session()
+        else:
+            self.session = sessions.setdefault((self.profile.name, self.base_url, self.scope), requests.Session())
+        self.pool(pool_size)
+
+        self.api_key = api_key or self.profile.api_key
+        self.credentials = (client_id or self.profile.client_id, client_token or self.profile.client_token)
+        self.authenticated = False
+
+    def logging(self, level='DEBUG'):
+        self.logger = logging.getLogger('logs')
+        self.logger.setLevel(level)
+        if not self.logger.handlers:
+            handler = logging.StreamHandler()
+            formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
+            handler.setFormatter(formatter)
+            self.logger.addHandler(handler)
+
+    def pool(self, size):
+        """Keep up to size keep-alive connections per host, e.g. one per worker thread."""
+        current = self.session.adapters.get('https://')
+        if isinstance(current, ScheduledAdapter) and current.scheduler is self.scheduler and current.pool_size == size:
+            # a reused session keeps its open connections
+            return
+        adapter = ScheduledAdapter(pool_connections=4, pool_maxsize=size, scheduler=self.scheduler)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def auth(self, auth):
+        try:
+            authenticate(self.session, self.api_key, auth, self.scope, iam_url=self.iam_url)
+        except AuthError as error:
+            self.logger.error('Could not authenticate to get the IAM token: {0} - {1}'
+                              .format(error.status_code, error.text))
+            sys.exit()
+        else:
+            self.logger.info('Successful authenticated.')
+
+    def connect(self):
+        """Authenticate on first use, so runs answered from local caches never contact IAM."""
+        if not self.authenticated:
+            self.auth(self.credentials)
+            self.authenticated = True
+
+    def renew_token(self):
+        """Swap in a new token shortly before the cached one expires, for long running processes."""
+        token = TokenCache().get_token(self.session, self.api_key, self.credentials, self.scope,
+                                       iam_url=self.iam_url)
+        self.session.headers['Authorization'] = 'Bearer ' + token
+
+    def refresh_token(self):
+        stale = self.session.headers['Authorization'][len('Bearer '):]
+        token = TokenCache().get_token(self.session, self.api_key, self.credentials, self.scope, stale=stale,
+                                       iam_url=self.iam_url)
+        self.session.headers['Authorization'] = 'Bearer ' + token
+
+    def paginate(self, path, params=None):
+        """Yield every JSON:API document of a collection, following links.next until the last page."""
+        self.connect()
+        res = self.session.get(self.base_url + path, params=params)
+        while True:
+            if not res.ok:
+                raise MVAPIError(res.status_code, res.text)
+
+            with metrics.stage('decode'):
+                res = loads(res.content)
+            yield res
+
+            if res.get('links') and res['links'].get('next'):
+                res = self.session.get(self.base_url + res['links']['next'])
+            else:
+                break
+
+    def async_client(self, limit=100):
+        if load_aiohttp() is None:
+            raise MVAPIError(0, 'The asyncio client requires the aiohttp package.')
+        self.connect()
+        return AsyncMVAPIClient(self, limit)
+
+
+class AsyncMVAPIClient():
+    """
+    asyncio transport sharing the token of a MVAPIClient. All requests go through one aiohttp
+    connector, so thousands of concurrent calls reuse at most `limit` keep-alive connections.
+    """
+    def __init__(self, client, limit=100):
+        self.client = client
+        self.limit = limit
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def request(self, method, url, params=None, data=None):
+        """
+        Send a request through the rate-limit scheduler and return (status, decoded body).
+        429/5xx are retried with backoff, a 401 refreshes the token and retries once.
+        """
+        # already loaded by the running event loop, imported here to keep it out of the CLI start-up
+        import asyncio
+
+        if not url.startswith('http'):
+            url = self.client.base_url + url
+        if params:
+            params = {key: str(value) for key, value in params.items()}
+
+        scheduler = self.client.scheduler
+        name = family(url)
+        refreshed = False
+        attempt = 0
+        while True:
+            await scheduler.acquire_async(name)
+            error = None
+            status = 0
+            headers = {}
+            content = b''
+            start = time.perf_counter()
+            try:
+                async with self.session.request(method, url, params=params, data=data,
+                                                headers=dict(self.client.session.headers)) as res:
+                    status, headers = res.status, res.headers
+                    content = await res.read()
+            except aiohttp.ClientConnectionError as exc:
+                error = exc
+            finally:
+                scheduler.release(name, status, headers)
+                metrics.request(name, method, url, status, time.perf_counter() - start,
+                                len(data) if isinstance(data, (bytes, str)) else 0, len(content))
+
+            if status == 401 and not refreshed:
+                # file lock and IAM round trip, kept off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.client.refresh_token)
+                refreshed = True
+                continue
+
+            if scheduler.should_retry(method, url, status, attempt):
+                metrics.retry(name, url, status)
+                await asyncio.sleep(scheduler.backoff(name, status, headers, attempt))
+                attempt += 1
+                continue
+            if error is not None:
+                raise error
+
+            try:
+                body = loads(content) if content else None
+            except ValueError:
+                body = content.decode(errors='replace')
+            return status, body
+
+    async def get_json(self, path, params=None):
+        status, body = await self.request('GET', path, params=params)
+        if status >= 400:
+            raise MVAPIError(status, body)
+        return body
@@ -0,0 +1,188 @@
+# Configuration for the mvapi_* scripts
+# Credentials and endpoints are read from environment variables, a config file with one section per
+# tenant profile and the built-in defaults, in this order. Every profile is loaded once per process.
+
+import os
+import time
+import socket
+import threading
+import configparser
+
+from urllib.parse import urlparse
+
+CONFIG_FNAME = os.environ.get('MVAPI_CONFIG', os.path.join(os.path.expanduser('~'), '.mvapi', 'config.ini'))
+DEFAULT_PROFILE = 'default'
+
+API_URL = 'https://api.mvision.mcafee.com'
+IAM_URL = 'https://iam.mcafee-cloud.com/iam/v1.1/token'
+
+# API host per region, extended by the [regions] section of the config file
+REGIONS = {
+    'default': API_URL,
+    'local': 'http://127.0.0.1:8080'
+}
+
+# environment variables overriding the keys of the selected profile
+ENV = {
+    'api_key': 'MVAPI_API_KEY',
+    'client_id': 'MVAPI_CLIENT_ID',
+    'client_token': 'MVAPI_CLIENT_TOKEN',
+    'region': 'MVAPI_REGION'
+}
+
+_parser = None
+_mtime = None
+_profiles = {}
+_closest = {}
+_lock = threading.Lock()
+
+
+# endpoint families with configurable request rates, see mvapi_ratelimit
+RATE_FAMILIES = ('iam', 'epo', 'insights')
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Profile():
+    def __init__(self, name, api_key='', client_id='', client_token='', base_url=API_URL, iam_url=IAM_URL,
+                 rates=None):
+        self.name = name
+        self.api_key = api_key
+        self.client_id = client_id
+        self.client_token = client_token
+        self.base_url = base_url.rstrip('/')
+        self.iam_url = iam_url
+        # {family: (rate, max_rate)} requests per second, None keeps the default of mvapi_ratelimit
+        self.rates = rates or {}
+
+    def path(self, fname):
+        """Location of a tenant specific local file; profiles other than default get their own directory."""
+        if self.name == DEFAULT_PROFILE:
+            return fname
+        return os.path.join(os.path.dirname(fname), 'profiles', self.name, os.path.basename(fname))
+
+
+def mtime():
+    try:
+        return os.stat(CONFIG_FNAME).st_mtime_ns
+    except OSError:
+        return None
+
+
+def config():
+    global _parser, _mtime
+    if _parser is None:
+        _mtime = mtime()
+        _parser = configparser.ConfigParser()
+        try:
+            _parser.read(CONFIG_FNAME)
+        except configparser.Error as error:
+            raise ConfigError('Could not read {0}: {1}'.format(CONFIG_FNAME, str(error)))
+    return _parser
+
+
+def reload():
+    """Forget the loaded profiles if the config file changed, e.g. between the commands of a warm worker."""
+    global _parser
+    with _lock:
+        if _parser is not None and mtime() != _mtime:
+            _parser = None
+            _profiles.clear()
+
+
+def profiles():
+    """Names of all tenant profiles in the config file."""
+    names = [name for name in config().sections() if name != 'regions']
+    return names or [DEFAULT_PROFILE]
+
+
+def regions():
+    parser = config()
+    return dict(REGIONS, **(dict(parser.items('regions', raw=True)) if parser.has_section('regions') else {}))
+
+
+def closest(urls, timeout=2):
+    """Return the API host with the fastest TCP connect, measured once per process."""
+    key = tuple(sorted(urls))
+    if key not in _closest:
+        timings = {}
+        for url in key:
+            parsed = urlparse(url)
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+            start = time.monotonic()
+            try:
+                socket.create_connection((parsed.hostname, port), timeout=timeout).close()
+            except OSError:
+                continue
+            timings[url] = time.monotonic() - start
+
+        if not timings:
+            raise ConfigError('None of the regional API hosts is reachable: {0}'.format(', '.join(key)))
+        _closest[key] = min(timings, key=timings.get)
+    return _closest[key]
+
+
+def region_url(region):
+    hosts = regions()
+    if region == 'auto':
+        return closest([url for name, url in hosts.items() if name != 'local'])
+    if region not in hosts:
+        raise ConfigError('Unknown region {0}. Known regions: {1}'.format(region, ', '.join(sorted(hosts))))
+    return hosts[region]
+
+
+def rates(name, section):
+    """<family>_rate and <family>_max_rate of a profile, MVAPI_<FAMILY>_RATE / _MAX_RATE apply to every profile."""
+    result = {}
+    for family in RATE_FAMILIES:
+        values = []
+        for key in (family + '_rate', family + '_max_rate'):
+            value = os.environ.get('MVAPI_' + key.upper()) or section.get(key)
+            try:
+                value = float(value) if value else None
+            except ValueError:
+                raise ConfigError('Invalid {0} of profile {1}: {2}'.format(key, name, value))
+            if value is not None and value <= 0:
+                raise ConfigError('{0} of profile {1} has to be positive.'.format(key, name))
+            values.append(value)
+        if any(values):
+            result[family] = tuple(values)
+    return result
+
+
+def load(name=None):
+    """
+    Return the profile name (default: $MVAPI_PROFILE or 'default'). MVAPI_API_KEY, MVAPI_CLIENT_ID,
+    MVAPI_CLIENT_TOKEN and MVAPI_REGION override the profile selected through the environment,
+    MVAPI_BASE_URL and MVAPI_IAM_URL override the endpoints of every profile (e.g. a mock server).
+    """
+    selected = os.environ.get('MVAPI_PROFILE') or DEFAULT_PROFILE
+    name = name or selected
+
+    with _lock:
+        if name in _profiles:
+            return _profiles[name]
+
+        parser = config()
+        if parser.has_section(name):
+            section = dict(parser.items(name, raw=True))
+        elif name == DEFAULT_PROFILE:
+            section = dict(parser.defaults())
+        else:
+            raise ConfigError('Profile {0} not found in {1}.'.format(name, CONFIG_FNAME))
+
+        if name == selected:
+            for key, variable in ENV.items():
+                if os.environ.get(variable):
+                    section[key] = os.environ[variable]
+
+        base_url = os.environ.get('MVAPI_BASE_URL') or section.get('base_url') \
+            or region_url(section.get('region', 'default'))
+        iam_url = os.environ.get('MVAPI_IAM_URL') or section.get('iam_url') or IAM_URL
+
+        profile = Profile(name, section.get('api_key', ''), section.get('client_id', ''),
+                          section.get('client_token', ''), base_url, iam_url, rates(name, section))
+        _profiles[name] = profile
+        return profile
@@ -0,0 +1,194 @@
+# Local SQLite index of MVISION EPO devices
+# Maps device names to ids and attributes so hostname lookups do not need a /epo/v2/devices query.
+
+import os
+import json
+import time
+import marshal
+import sqlite3
+import threading
+
+INDEX_FNAME = os.environ.get('MVAPI_DEVICE_INDEX',
+                             os.path.join(os.path.expanduser('~'), '.mvapi', 'devices.sqlite'))
+
+# Index older than this is refreshed incrementally in the background
+MAX_AGE = 3600
+
+
+class DeviceIndex():
+    def __init__(self, fname=INDEX_FNAME):
+        self.fname = fname
+        self.thread = None
+
+        os.makedirs(os.path.dirname(fname) or '.', mode=0o700, exist_ok=True)
+        self.db = self.connect()
+        self.db.execute('CREATE TABLE IF NOT EXISTS devices ('
+                        'id TEXT PRIMARY KEY, name TEXT, attributes TEXT, sync_id INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS devices_name ON devices (name)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+
+    def connect(self):
+        db = sqlite3.connect(self.fname, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    @staticmethod
+    def get_meta(db, key, default=None):
+        row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    @staticmethod
+    def set_meta(db, key, value):
+        db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    @staticmethod
+    def upsert(db, devices, sync_id=0):
+        """Insert or update JSON:API device records, returns the newest lastUpdate seen."""
+        newest = None
+        rows = []
+        for device in devices:
+            attributes = device.get('attributes', {})
+            rows.append((str(device['id']), attributes.get('name', '').lower(), json.dumps(attributes), sync_id))
+            if attributes.get('lastUpdate') and (newest is None or attributes['lastUpdate'] > newest):
+                newest = attributes['lastUpdate']
+        db.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?)', rows)
+        DeviceIndex.touch(db)
+        return newest
+
+    @staticmethod
+    def touch(db):
+        # bumped on every change, invalidates the column cache
+        db.execute("INSERT INTO meta VALUES ('version', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+    def add(self, devices):
+        self.upsert(self.db, devices)
+        self.db.commit()
+
+    def lookup(self, name):
+        """Return the ids of all indexed devices with this name (case insensitive)."""
+        return [row[0] for row in self.db.execute('SELECT id FROM devices WHERE name = ?', (name.lower(),))]
+
+    def get(self, name):
+        return [dict(json.loads(row[1]), id=row[0]) for row in
+                self.db.execute('SELECT id, attributes FROM devices WHERE name = ?', (name.lower(),))]
+
+    def keys(self, sample=1000):
+        """Attribute names of the first indexed devices."""
+        return set(row[0] for row in self.db.execute(
+            'SELECT DISTINCT j.key FROM (SELECT attributes FROM devices LIMIT ?) d, json_each(d.attributes) j',
+            (sample,)))
+
+    def columns(self, keys):
+        """
+        Read the index column by column: device ids, names and one list of values per attribute key.
+        Columns are kept in a marshal file next to the index until the index changes, so repeated
+        reads skip the JSON extraction.
+        """
+        version = str(self.get_meta(self.db, 'version', 0))
+        cache = None
+        try:
+            with open(self.fname + '.columns', 'rb') as fh:
+                cache = marshal.loads(fh.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        if not cache or cache['version'] != version:
+            cache = {'version': version, 'ids': None, 'names': None, 'columns': {}}
+
+        missing = [key for key in keys if key not in cache['columns']]
+        if missing or cache['ids'] is None:
+            select = ''.join(', json_extract(attributes, ?)' for _ in missing)
+            rows = self.db.execute("SELECT id, json_extract(attributes, '$.name'){0} FROM devices ORDER BY rowid"
+                                   .format(select), ['$."{0}"'.format(key) for key in missing]).fetchall()
+            columns = list(zip(*rows)) or [()] * (len(missing) + 2)
+            cache['ids'] = list(columns[0])
+            cache['names'] = list(columns[1])
+            cache['columns'].update((key, list(columns[i + 2])) for i, key in enumerate(missing))
+
+            tmp_fname = self.fname + '.columns.tmp'
+            with open(tmp_fname, 'wb') as fh:
+                marshal.dump(cache, fh)
+            os.replace(tmp_fname, self.fname + '.columns')
+
+        return cache['ids'], cache['names'], {key: cache['columns'][key] for key in keys}
+
+    def age(self):
+        return time.time() - float(self.get_meta(self.db, 'synced_at', 0))
+
+    def sync(self, session, base_url, full=False, logger=None):
+        """
+        Page through /epo/v2/devices and store every device. An incremental sync only requests
+        devices with a lastUpdate newer than the last sync; a full sync also drops devices that
+        no longer exist. Runs on its own connection so it can be used from a background thread.
+        """
+        db = self.connect()
+        try:
+            since = self.get_meta(db, 'last_update')
+            full = full or since is None
+            sync_id = int(self.get_meta(db, 'sync_id', 0)) + 1
+
+            params = {'page[limit]': 1000}
+            if not full:
+                params['filter[lastUpdate][GT]'] = since
+
+            count = 0
+            newest = since
+            started = time.time()
+
+            res = session.get(base_url + '/epo/v2/devices', params=params)
+            while True:
+                if not res.ok:
+                    raise Exception('Error in device index sync. {0} - {1}'.format(res.status_code, res.text))
+
+                res = res.json()
+                last = self.upsert(db, res['data'], sync_id)
+                if last and (newest is None or last > newest):
+                    newest = last
+                count += len(res['data'])
+                db.commit()
+
+                if logger:
+                    logger.debug('Device index sync: {0} devices stored.'.format(count))
+
+                if res.get('links') and res['links'].get('next'):
+                    res = session.get(base_url + res['links']['next'])
+                else:
+                    break
+
+            if full:
+                db.execute('DELETE FROM devices WHERE sync_id < ?', (sync_id,))
+                self.touch(db)
+            if newest:
+                self.set_meta(db, 'last_update', newest)
+            self.set_meta(db, 'sync_id', sync_id)
+            self.set_meta(db, 'synced_at', started)
+            db.commit()
+
+            if logger:
+                logger.info('Device index {0} sync finished. {1} devices updated.'
+                            .format('full' if full else 'incremental', count))
+            return count
+        finally:
+            db.close()
+
+    def refresh_in_background(self, session, base_url, max_age=MAX_AGE, logger=None):
+        """Start an incremental sync in a daemon thread if the index is older than max_age."""
+        if self.age() < max_age or (self.thread and self.thread.is_alive()):
+            return None
+
+        def run():
+            try:
+                self.sync(session, base_url, logger=logger)
+            except Exception as error:
+                if logger:
+                    logger.error(str(error))
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def close(self, wait=True):
+        if wait and self.thread:
+            self.thread.join()
+        self.db.close()
@@ -0,0 +1,171 @@
+# Enrichment of MVISION EPO events with MVISION Insights IOC verdicts
+# Hashes found in the events are looked up once per sliding window: concurrent lookups of the same hash share
+# one request, verdicts are memoized in process and in the local IOC cache, and every page is released after
+# at most max_delay seconds, with the lookups still running marked as pending.
+
+import time
+import logging
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from mvapi_insights_search import HASH_TYPES
+from mvapi_metrics import metrics
+
+HASH_FIELDS = ('targethash', 'sourceprocesshash')
+
+
+def verdict(record):
+    """Reduce a lookup record of mvapi_insights_search to the fields added to an event."""
+    if 'error' in record:
+        return {'status': 'error', 'error': record['error']}
+    if not record['found']:
+        return {'status': 'not_found'}
+
+    attributes = record['ioc'].get('attributes', {})
+    return {
+        'status': 'found',
+        'threat': attributes.get('threat'),
+        'prevalence': attributes.get('prevalence'),
+        'campaigns': [campaign.get('id') for campaign in attributes.get('campaigns') or []]
+    }
+
+
+class Enricher():
+    """
+    Join pages of EPO events with Insights verdicts for the hashes in HASH_FIELDS. Lookups for a page
+    start as soon as it arrives and run while the next page is fetched; verdicts are added to every
+    event as event['insights'][field]. The last `window` verdicts are kept in memory.
+    """
+    def __init__(self, insights, fields=HASH_FIELDS, window=10000, batch_size=10, workers=8, max_delay=2.0):
+        self.insights = insights
+        self.fields = fields
+        self.window = window
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_delay = max_delay
+
+        self.memo = OrderedDict()
+        self.pending = {}
+        # error verdicts of the last `window` failed hashes, reported until the hash is looked up again
+        self.errors = OrderedDict()
+        self.lookups = 0
+        self.logger = logging.getLogger('logs')
+
+    def hashes(self, event):
+        for field in self.fields:
+            value = event.get(field)
+            if not value:
+                continue
+            value = value.lower()
+            if len(value) in HASH_TYPES and all(c in '0123456789abcdef' for c in value):
+                yield field, value
+
+    def remember(self, value, result):
+        self.memo[value] = result
+        self.memo.move_to_end(value)
+        while len(self.memo) > self.window:
+            self.memo.popitem(last=False)
+
+    def lookup(self, value):
+        if value in self.memo:
+            self.memo.move_to_end(value)
+            return self.memo[value]
+
+        cache = self.insights.cache
+        cached = cache.get(value) if cache is not None and not self.insights.refresh else None
+        if cached:
+            result = verdict({'found': cached[0], 'ioc': cached[1]})
+            self.remember(value, result)
+            return result
+        return None
+
+    def submit(self, pool, page):
+        """Start the lookups for every hash of the page that is neither memoized nor already in flight."""
+        batches = {}
+        for event in page:
+            for field, value in self.hashes(event):
+                if value in self.pending or self.lookup(value) is not None:
+                    continue
+                type = HASH_TYPES[len(value)]
+                batch = batches.setdefault(type, [])
+                batch.append(value)
+                self.pending[value] = None
+                self.errors.pop(value, None)
+                if len(batch) >= self.batch_size:
+                    self.start(pool, type, batches.pop(type))
+
+        for type, batch in batches.items():
+            self.start(pool, type, batch)
+
+    def start(self, pool, type, values):
+        self.insights.connect()
+        future = pool.submit(self.insights.search_batch, type, values)
+        self.lookups += 1
+        for value in values:
+            self.pending[value] = future
+
+    def harvest(self):
+        """Move the verdicts of finished lookups into the memo and the IOC cache."""
+        done = {future for future in self.pending.values() if future.done()}
+        for future in done:
+            for record in future.result():
+                value = record['hash']
+                del self.pending[value]
+                result = verdict(record)
+                if result['status'] == 'error':
+                    # not memoized, the next page with this hash tries again
+                    self.errors[value] = result
+                    while len(self.errors) > self.window:
+                        self.errors.popitem(last=False)
+                    continue
+                self.remember(value, result)
+                if self.insights.cache is not None:
+                    self.insights.cache.put(value, record['type'], record.get('ioc'))
+
+    def annotate(self, page):
+        for event in page:
+            insights = {}
+            for field, value in self.hashes(event):
+                result = self.lookup(value) or self.errors.get(value)
+                insights[field] = dict(result, hash=value) if result else {'status': 'pending', 'hash': value}
+            if insights:
+                event['insights'] = insights
+        return page
+
+    def release(self, page, arrived):
+        futures = {self.pending[value] for event in page for field, value in self.hashes(event)
+                   if value in self.pending}
+        if futures:
+            with metrics.stage('enrich_wait'):
+                wait(futures, timeout=max(0.0, arrived + self.max_delay - time.monotonic()))
+        self.harvest()
+        metrics.set('mvapi_queue_depth', len(self.pending), queue='enrich')
+        return self.annotate(page)
+
+    def enrich(self, pages):
+        """Yield every page of pages with Insights verdicts, keeping one page of lookahead."""
+        self.insights.pool(self.workers)
+        if self.insights.authenticated:
+            # long running follow mode: swap in a new token before the current one expires
+            self.insights.renew_token()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            previous = None
+            for page in pages:
+                self.submit(pool, page)
+                if previous is not None:
+                    yield self.release(*previous)
+                previous = (page, time.monotonic())
+
+            if previous is not None:
+                yield self.release(*previous)
+            self.harvest()
+
+    def stats(self):
+        cache = self.insights.cache.stats() if self.insights.cache is not None else 'No IOC cache'
+        return 'Insights lookups: {0}, memoized hashes: {1}. {2}'.format(self.lookups, len(self.memo), cache)
+
+    def close(self):
+        self.logger.info(self.stats())
+        if self.insights.cache is not None:
+            self.insights.cache.close()
@@ -2,88 +2,102 @@
 # Script to add new MVISION EPO tags
 
 import sys
-import requests
 import json
 import logging
+import threading
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from mvapi_client import MVAPIClient
+from mvapi_config import profiles
+from mvapi_device_index import INDEX_FNAME, MAX_AGE, DeviceIndex
+from mvapi_tag_criteria import CriteriaError, dry_run, parse, where_clause
 
-class MVISIONAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
+DEFAULT_CRITERIA = '( where ( eq EPOComputerProperties.OSPlatform "Server" ) )'
+DEFAULT_NOTES = 'Default tag for systems identified as a Server'
 
-        self.api_key = ''
-        client_id = ''
-        client_token = ''
+# manifest outcomes that fail a run
+FAILURES = ('missing_group', 'invalid', 'error')
 
-        auth = (client_id, client_token)
 
-        self.logging()
-        self.auth(auth)
+def read_manifest(fname):
+    """
+    Read a YAML or JSON tag manifest:
+      group: Default              # tag group of tags without their own
+      groups: [Servers]           # tag groups that have to exist
+      tags:
+        - name: Server
+          group: Servers
+          criteria: ( where ( eq EPOComputerProperties.OSPlatform "Server" ) )
+          notes: Systems identified as a Server
+          executeOnAsci: true
+    """
+    with open(fname, 'r') as fh:
+        content = fh.read()
 
-        self.tagname = args.tag
-        self.taggroup = args.group
+    if fname.endswith(('.yaml', '.yml')):
+        # PyYAML is only imported for YAML manifests
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('YAML manifests require the PyYAML package.')
+        manifest = yaml.safe_load(content)
+    else:
+        manifest = json.loads(content)
 
-    def logging(self):
-        self.logger = logging.getLogger('logs')
-        self.logger.setLevel('DEBUG')
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('tags'), list):
+        raise ValueError('Manifest needs a list of tags.')
+    for tag in manifest['tags']:
+        if not isinstance(tag, dict) or not tag.get('name'):
+            raise ValueError('Every tag in the manifest needs a name: {0}'.format(tag))
+    return manifest
 
-    def auth(self, auth):
-        iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
 
-        headers = {
-            'x-api-key': self.api_key,
-            'Content-Type': 'application/vnd.api+json'
-        }
+class MVISIONAPI(MVAPIClient):
+    scope = 'epo.taggroup.r epo.tags.w'
 
-        payload = {
-            "grant_type": "client_credentials",
-            "scope": "epo.taggroup.r epo.tags.w"
-        }
-
-        res = self.session.post(iam_url, headers=headers, auth=auth, data=payload)
+    def __init__(self, profile=None):
+        # authentication is deferred so a --dry-run only reads the local device index
+        super().__init__(profile=profile)
 
-        if res.status_code != 200:
-            self.logger.error("Could not authenticate to get the IAM token: {0} - {1}".format(res.status_code, res.text))
+        self.tagname = args.tag
+        self.taggroup = args.group
+        self.criteria = args.criteria or DEFAULT_CRITERIA
+        try:
+            self.where_clause = where_clause(parse(self.criteria))
+        except CriteriaError as error:
+            self.logger.error('Invalid tag criteria. {0}'.format(str(error)))
             sys.exit()
-        else:
-            self.logger.info('Successful authenticated.')
-            access_token = res.json()['access_token']
-            headers['Authorization'] = 'Bearer ' + access_token
-            self.session.headers = headers
 
-    def get_tag_groups(self):
-        res = self.session.get(self.base_url + '/epo/v2/tagGroups')
+        # tag group name -> id, downloaded once per run
+        self.groups = None
 
-        if res.ok:
-            if len(res.json()['data']) > 1 and self.taggroup is None:
-                self.logger.error('Multiple Tag Groups identified. Please provide a Tag Group to create new tags.')
+    def tag_groups(self):
+        if self.groups is None:
+            res = self.session.get(self.base_url + '/epo/v2/tagGroups')
+            if not res.ok:
+                self.logger.error('Error in get_tag_groups. HTTP {0} - {1}'.format(str(res.status_code), res.text))
                 sys.exit()
+            self.groups = {group['attributes']['groupName']: group['id'] for group in res.json()['data']}
+        return self.groups
 
-            check = 0
-            for group in res.json()['data']:
-                check += 1
-                if group['attributes']['groupName'] == self.taggroup:
-                    self.logger.info('Successful identified corresponding Tag Group. Group Id: {0}'
-                                     .format(group['id']))
-                    return group['id']
-
-                if check == len(res.json()['data']):
-                    self.logger.error('Could not find corresponding Tag Group.')
-                    sys.exit()
+    def get_tag_groups(self):
+        groups = self.tag_groups()
+        if len(groups) > 1 and self.taggroup is None:
+            self.logger.error('Multiple Tag Groups identified. Please provide a Tag Group to create new tags.')
+            sys.exit()
 
-        else:
-            self.logger.error('Error in get_tag_groups. HTTP {0} - {1}'.format(str(res.status_code), res.text))
+        if self.taggroup not in groups:
+            self.logger.error('Could not find corresponding Tag Group.')
             sys.exit()
 
-    def create_tag(self, taggroup_id):
+        self.logger.info('Successful identified corresponding Tag Group. Group Id: {0}'.format(groups[self.taggroup]))
+        return groups[self.taggroup]
+
+    @staticmethod
+    def tag_payload(name, taggroup_id, criteria, where, notes=DEFAULT_NOTES, execute_on_asci=True):
         now = datetime.astimezone(datetime.now())
         tz = str(now).split('.')[1][-6:]
         dtime = datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + tz
@@ -93,12 +107,12 @@ class MVISIONAPI():
                 "type": "tags",
                 "attributes": {
                     "uniqueKey": "",
-                    "name": self.tagname,
+                    "name": name,
                     "family": "EPO",
-                    "notes": "Default tag for systems identified as a Server",
-                    "criteria": "( where ( eq EPOComputerProperties.OSPlatform \"Server\" ) )",
-                    "whereClause": "where ( [EPOComputerProperties].[OSPlatform] = 'Server' )",
-                    "executeOnAsci": "true",
+                    "notes": notes,
+                    "criteria": criteria,
+                    "whereClause": where,
+                    "executeOnAsci": str(execute_on_asci).lower(),
                     "createdBy": "mvapi",
                     "createdOn": dtime,
                     "modifiedBy": "mvapi",
@@ -107,6 +121,16 @@ class MVISIONAPI():
                 }
             }
         }
+        return payload
+
+    def post_tag(self, payload):
+        try:
+            return self.session.post(self.base_url + '/epo/v2/tags', data=json.dumps(payload))
+        except Exception as error:
+            return error
+
+    def create_tag(self, taggroup_id):
+        payload = self.tag_payload(self.tagname, taggroup_id, self.criteria, self.where_clause)
 
         res = self.session.post(self.base_url + '/epo/v2/tags', data=json.dumps(payload))
         if res.ok:
@@ -118,24 +142,220 @@ class MVISIONAPI():
             self.logger.error('Could not create tag. HTTP {0} - {1}'.format(str(res.status_code), res.text))
             sys.exit()
 
+    def apply_manifest(self, fname, workers=8):
+        """
+        Create every tag of a manifest. Group names are resolved from one tagGroups download, the
+        creates run concurrently and a 409 (tag already exists) counts as done, so a manifest can be
+        applied again and again. Returns a summary of tag names per outcome.
+        """
+        try:
+            manifest = read_manifest(fname)
+        except (OSError, ValueError) as error:
+            self.logger.error('Could not read manifest {0}. {1}'.format(fname, str(error)))
+            sys.exit()
+
+        summary = {'created': [], 'exists': [], 'missing_group': [], 'invalid': [], 'error': []}
+
+        groups = self.tag_groups()
+        for group in manifest.get('groups') or []:
+            if group not in groups:
+                self.logger.error('Tag Group {0} does not exist in MVISION EPO.'.format(group))
+
+        jobs = []
+        for tag in manifest['tags']:
+            group = tag.get('group', manifest.get('group'))
+            if group is None and len(groups) == 1:
+                group = next(iter(groups))
+            if group not in groups:
+                self.logger.error('Could not find Tag Group {0} for tag {1}.'.format(group, tag['name']))
+                summary['missing_group'].append(tag['name'])
+                continue
+
+            criteria = tag.get('criteria', DEFAULT_CRITERIA)
+            try:
+                where = where_clause(parse(criteria))
+            except CriteriaError as error:
+                self.logger.error('Invalid criteria for tag {0}. {1}'.format(tag['name'], str(error)))
+                summary['invalid'].append(tag['name'])
+                continue
+
+            jobs.append((tag['name'], self.tag_payload(tag['name'], groups[group], criteria, where,
+                                                       tag.get('notes', ''), tag.get('executeOnAsci', True))))
+
+        self.pool(workers + 1)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for (name, _), res in zip(jobs, pool.map(lambda job: self.post_tag(job[1]), jobs)):
+                if isinstance(res, Exception):
+                    self.logger.error('Could not create tag {0}. {1}'.format(name, str(res)))
+                    summary['error'].append(name)
+                elif res.ok:
+                    summary['created'].append(name)
+                elif res.status_code == 409:
+                    summary['exists'].append(name)
+                else:
+                    self.logger.error('Could not create tag {0}. HTTP {1} - {2}'.format(name, res.status_code, res.text))
+                    summary['error'].append(name)
+
+        self.logger.info('Manifest {0} applied. Created: {1}, already existing: {2}, missing tag group: {3}, '
+                         'invalid criteria: {4}, errors: {5}.'
+                         .format(fname, len(summary['created']), len(summary['exists']), len(summary['missing_group']),
+                                 len(summary['invalid']), len(summary['error'])))
+        return summary
+
+    def preview_manifest(self, fname):
+        try:
+            manifest = read_manifest(fname)
+        except (OSError, ValueError) as error:
+            self.logger.error('Could not read manifest {0}. {1}'.format(fname, str(error)))
+            sys.exit()
+
+        for tag in manifest['tags']:
+            self.logger.info('Tag {0}:'.format(tag['name']))
+            self.preview(tag.get('criteria', DEFAULT_CRITERIA))
+
+    def preview(self, criteria=None, output=None):
+        """Evaluate the tag criteria against the local device index and report the matching devices."""
+        criteria = criteria or self.criteria
+        index = DeviceIndex(self.profile.path(INDEX_FNAME))
+        try:
+            matches, total, keys = dry_run(index, criteria)
+        except CriteriaError as error:
+            self.logger.error('Could not evaluate the tag criteria. {0}'.format(str(error)))
+            return None
+        finally:
+            age = index.age()
+            index.close()
+
+        if total == 0:
+            self.logger.warning('Device index is empty. Run mvapi_epo_get_device.py --sync-index to preview tag matches.')
+            return None
+        if age > MAX_AGE:
+            self.logger.warning('Device index was not synced within the last {0} minutes, results may be outdated.'
+                                .format(MAX_AGE // 60))
+
+        self.logger.info('Tag criteria {0} matches {1} of {2} indexed devices.'.format(criteria, len(matches), total))
+        names = [name for _, name in matches]
+        if names:
+            self.logger.info('Matching devices: {0}{1}'.format(', '.join(names[:20]),
+                                                             ' (+{0} more)'.format(len(names) - 20)
+                                                             if len(names) > 20 else ''))
+        if output:
+            with open(output, 'w') as fh:
+                fh.write(''.join('{0},{1}\n'.format(did, name) for did, name in matches))
+        return matches
+
     def main(self):
+        if args.manifest:
+            if args.dry_run:
+                self.preview_manifest(args.manifest)
+                return
+            self.connect()
+            return self.apply_manifest(args.manifest, args.workers)
+
+        matches = self.preview(output=args.matches)
+        if args.dry_run:
+            if matches is None:
+                sys.exit(1)
+            return
+
+        self.connect()
         taggroup_id = self.get_tag_groups()
         self.create_tag(taggroup_id)
 
 
+def apply_tenants(tenants):
+    """
+    Run the manifest for several tenant profiles in parallel and log one combined outcome. A tenant
+    that fails (sys.exit) only ends its own thread. Returns the names of the failed tenants.
+    """
+    logger = logging.getLogger('logs')
+    summaries = {}
+    errors = set()
+
+    def run(tenant):
+        try:
+            summaries[tenant] = MVISIONAPI(tenant).main()
+        except SystemExit:
+            # the error was logged by the tenant
+            errors.add(tenant)
+        except Exception as error:
+            logger.error('Error in add_tag for tenant {0}. Error: {1}'.format(tenant, str(error)))
+            errors.add(tenant)
+
+    threads = [threading.Thread(target=run, args=(tenant,)) for tenant in tenants]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    failed = []
+    for tenant in tenants:
+        summary = summaries.get(tenant)
+        if tenant in errors:
+            logger.error('Tenant {0}: failed.'.format(tenant))
+        elif summary is not None:
+            logger.info('Tenant {0}: created: {1}, already existing: {2}, missing tag group: {3}, '
+                        'invalid criteria: {4}, errors: {5}.'
+                        .format(tenant, len(summary['created']), len(summary['exists']),
+                                len(summary['missing_group']), len(summary['invalid']), len(summary['error'])))
+        if tenant in errors or (summary and any(summary[outcome] for outcome in FAILURES)):
+            failed.append(tenant)
+
+    logger.info('Manifest {0} done for {1} of {2} tenants.{3}'
+                .format(args.manifest, len(tenants) - len(failed), len(tenants),
+                        ' Failed: {0}.'.format(', '.join(failed)) if failed else ''))
+    return failed
+
+
 if __name__ == '__main__':
-    usage = """python mvapi_epo_add_tag.py -T <TAG NAME> -G <TAG GROUP>"""
+    usage = """python mvapi_epo_add_tag.py -T <TAG NAME> -G <TAG GROUP> [-C <CRITERIA>] [--dry-run] [--matches <FILE>]
+       python mvapi_epo_add_tag.py -M <MANIFEST (YAML | JSON)> [-W <WORKERS>] [--dry-run] [--tenants <PROFILE,PROFILE | all>]"""
     title = 'MVISION API - EPO Tag Assignment'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
-    parser.add_argument('--tag', '-T',
-                        required=True, type=str,
-                        help='MVISION EPO Tag Name')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--tag', '-T',
+                       type=str,
+                       help='MVISION EPO Tag Name')
+
+    group.add_argument('--manifest', '-M',
+                       type=str,
+                       help='YAML or JSON manifest with the tags to create')
 
     parser.add_argument('--group', '-G',
                         required=False, type=str,
                         default=None, help='MVISION EPO Tag Group')
 
+    parser.add_argument('--criteria', '-C',
+                        required=False, type=str,
+                        default=None, help='Tag criteria (default: {0})'.format(DEFAULT_CRITERIA))
+
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='Only report the devices of the local device index matching the criteria')
+
+    parser.add_argument('--matches',
+                        required=False, type=str,
+                        default=None, help='Write the matching devices as id,name lines to a file')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
+
+    parser.add_argument('--workers', '-W',
+                        required=False, type=int,
+                        default=8, help='Concurrent tag creates for --manifest (default: 8)')
+
+    parser.add_argument('--tenants',
+                        required=False, type=str,
+                        default=None, help='Apply the manifest to several tenant profiles in parallel (comma separated or all)')
+
     args = parser.parse_args()
 
-    MVISIONAPI().main()
+    if args.tenants:
+        if not args.manifest or args.profile:
+            parser.error('--tenants needs --manifest and cannot be combined with --profile')
+        tenants = profiles() if args.tenants == 'all' else [name.strip() for name in args.tenants.split(',')]
+        sys.exit(1 if apply_tenants(tenants) else None)
+    else:
+        MVISIONAPI(args.profile).main()
@@ -2,64 +2,41 @@
 # Script to assign and unassign tags to system in MVISION EPO
 
 import sys
-import requests
+import csv
 import json
 import logging
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 
+from mvapi_client import MVAPIClient
+from mvapi_device_index import INDEX_FNAME, DeviceIndex
 
-class MVAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
+
+class MVAPI(MVAPIClient):
+    scope = 'epo.tags.w epo.device.r epo.tags.r epo.device.w'
+
+    def __init__(self, profile=None):
+        super().__init__(profile=profile)
+        self.connect()
 
         self.host = args.host
+        self.file = args.file
         self.tag = args.tag
         self.type = args.type
-
-        self.api_key = ''
-        client_id = ''
-        client_token = ''
-
-        auth = (client_id, client_token)
-
-        self.logging()
-        self.auth(auth)
-
-    def logging(self):
-        self.logger = logging.getLogger('logs')
-        self.logger.setLevel('DEBUG')
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
-
-    def auth(self, auth):
-        iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
-
-        headers = {
-            'x-api-key': self.api_key,
-            'Content-Type': 'application/vnd.api+json'
-        }
-
-        payload = {
-            "grant_type": "client_credentials",
-            "scope": "epo.tags.w epo.device.r epo.tags.r epo.device.w"
-        }
-
-        res = self.session.post(iam_url, headers=headers, auth=auth, data=payload)
-
-        if res.status_code != 200:
-            self.logger.error("Could not authenticate to get the IAM token: {0} - {1}".format(res.status_code, res.text))
-            sys.exit()
-        else:
-            self.logger.info('Successful authenticated.')
-            access_token = res.json()['access_token']
-            headers['Authorization'] = 'Bearer ' + access_token
-            self.session.headers = headers
+        self.batch_size = args.batch_size
+        # cleared once a response shows that the tenant ignores filter[name][in]
+        self.in_filter = True
+        self.workers = args.workers
+        self.index = None if args.no_index else DeviceIndex(self.profile.path(INDEX_FNAME))
 
     def get_ids(self, type, query):
+        if type == 'devices' and self.index:
+            ids = self.index.lookup(query)
+            if len(ids) == 1:
+                self.logger.info('Identified device in device index. deviceID for {0} is {1}.'.format(query, ids[0]))
+                return ids[0]
+
         param = {
             'filter[name][eq]': query
         }
@@ -78,6 +55,8 @@ class MVAPI():
                 sys.exit()
             else:
                 id = res.json()['data'][0]['id']
+                if type == 'devices' and self.index:
+                    self.index.add(res.json()['data'])
                 self.logger.info('Identified {0} in MVISION EPO. {0}ID for {1} is {2}.'.format(type[:-1], query, id))
 
                 return id
@@ -85,7 +64,7 @@ class MVAPI():
             self.logger.error('Error in get_ids. {0} - {1}'.format(res.status_code, res.text))
             sys.exit()
 
-    def assign_tag(self, did, tid):
+    def set_tag(self, did, tid):
         payload = {
           "data": [
             {
@@ -101,18 +80,178 @@ class MVAPI():
         else:
             res = self.session.delete(self.base_url + '/epo/v2/devices/{0}/relationships/assignedTags'.format(did),
                                       data=json.dumps(payload))
+        return res
+
+    def assign_tag(self, did, tid):
+        res = self.set_tag(did, tid)
 
         if res.ok:
             self.logger.info('Successfully {0} Tag {1} to System {2}.'.format(self.type + 'ed', self.tag, self.host))
         else:
             if res.status_code == 409:
                 self.logger.error('Conflict - Tag already {0} to system. {1} - {2}'.format(self.type, res.status_code, res.text))
-            if res.status_code == 404:
+            elif res.status_code == 404:
                 self.logger.error('Conflict - Tag already {0} from system. {1} - {2}'.format(self.type, res.status_code, res.text))
             else:
                 self.logger.error('Conflict: Error in assign_tag. {0} - {1}.'.format(res.status_code, res.text))
 
+    def read_hosts(self, source):
+        """Read hostnames from a plain list or a CSV file with a host/name column ('-' for stdin)."""
+        fh = sys.stdin if source == '-' else open(source, 'r', newline='')
+        try:
+            lines = [line for line in fh if line.strip()]
+        finally:
+            if fh is not sys.stdin:
+                fh.close()
+
+        if not lines:
+            return []
+
+        column = 0
+        header = next(csv.reader(lines[:1]))
+        names = [name.strip().lower() for name in header]
+        for name in ('host', 'hostname', 'name'):
+            if name in names:
+                column = names.index(name)
+                lines = lines[1:]
+                break
+
+        hosts = []
+        seen = set()
+        for row in csv.reader(lines):
+            if len(row) > column and row[column].strip() and row[column].strip() not in seen:
+                seen.add(row[column].strip())
+                hosts.append(row[column].strip())
+        return hosts
+
+    def resolve_devices(self, hosts):
+        """
+        Resolve hostnames to device ids with one filter[name][in] query per batch, following
+        links.next. A tenant that ignores filter[name][in] answers with devices outside the batch;
+        the batch is then resolved host by host with filter[name][eq] and so are all later batches.
+        Returns a dict hostname -> list of matching device records.
+        """
+        if len(hosts) > 1 and self.in_filter:
+            matches = self.match_devices(hosts, {'filter[name][in]': ','.join(hosts), 'page[limit]': len(hosts)})
+            if matches is not None:
+                return matches
+            if self.in_filter:
+                self.in_filter = False
+                self.logger.warning('The tenant ignores filter[name][in], resolving hosts one by one.')
+
+        matches = {}
+        for host in hosts:
+            matches.update(self.match_devices([host], {'filter[name][eq]': host}, strict=False))
+        return matches
+
+    def match_devices(self, hosts, param, strict=True):
+        """Devices per host for a filtered query; with strict, None as soon as a device outside hosts shows up."""
+        matches = {host: [] for host in hosts}
+        lookup = {host.lower(): host for host in hosts}
+
+        for res in self.paginate('/epo/v2/devices', param):
+            for device in res['data']:
+                host = lookup.get(device['attributes']['name'].lower())
+                if host is not None:
+                    matches[host].append(device)
+                elif strict:
+                    return None
+        return matches
+
+    def bulk_tag(self, source):
+        """
+        Assign or unassign the tag on every host read from source. The tag is resolved once,
+        devices are resolved in batches and the relationship calls run on a bounded thread pool.
+        """
+        hosts = self.read_hosts(source)
+        self.logger.info('Read {0} hosts from {1}.'.format(len(hosts), source))
+
+        tid = self.get_ids('tags', self.tag)
+        self.pool(self.workers + 1)
+
+        summary = {'success': [], 'conflict': [], 'missing': [], 'not_found': [], 'ambiguous': [], 'error': []}
+
+        # hosts with exactly one indexed device are resolved locally, only the rest go to the API
+        devices = []
+        misses = []
+        if self.index:
+            self.index.refresh_in_background(self.session, self.base_url, logger=self.logger)
+            for host in hosts:
+                ids = self.index.lookup(host)
+                if len(ids) == 1:
+                    devices.append((host, ids[0]))
+                else:
+                    misses.append(host)
+            self.logger.info('Resolved {0} hosts from the device index.'.format(len(devices)))
+        else:
+            misses = hosts
+
+        batches = [misses[i:i + self.batch_size] for i in range(0, len(misses), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for batch, result in zip(batches, pool.map(self.try_resolve, batches)):
+                if isinstance(result, Exception):
+                    self.logger.error('Error in resolve_devices. {0}'.format(str(result)))
+                    summary['error'].extend(batch)
+                    continue
+
+                for host, records in result.items():
+                    if len(records) == 0:
+                        summary['not_found'].append(host)
+                    elif len(records) > 1:
+                        summary['ambiguous'].append(host)
+                    else:
+                        devices.append((host, records[0]['id']))
+
+                    if self.index and records:
+                        self.index.add(records)
+
+            self.logger.info('Resolved {0} of {1} hosts to device ids.'.format(len(devices), len(hosts)))
+
+            for (host, did), res in zip(devices, pool.map(lambda device: self.try_set_tag(device[1], tid), devices)):
+                if isinstance(res, Exception):
+                    self.logger.error('Error in bulk_tag for {0}. {1}'.format(host, str(res)))
+                    summary['error'].append(host)
+                elif res.ok:
+                    summary['success'].append(host)
+                elif res.status_code == 409:
+                    summary['conflict'].append(host)
+                elif res.status_code == 404:
+                    summary['missing'].append(host)
+                else:
+                    self.logger.error('Error in bulk_tag for {0}. {1} - {2}'.format(host, res.status_code, res.text))
+                    summary['error'].append(host)
+
+        self.logger.info('Bulk {0} of Tag {1} finished. Success: {2}, 409 Conflict: {3}, 404 Not Found: {4}, '
+                         'unknown hosts: {5}, ambiguous hosts: {6}, errors: {7}.'
+                         .format(self.type, self.tag, len(summary['success']), len(summary['conflict']),
+                                 len(summary['missing']), len(summary['not_found']), len(summary['ambiguous']),
+                                 len(summary['error'])))
+        for key in ('not_found', 'ambiguous', 'error'):
+            # joining large host lists is skipped unless DEBUG is on
+            if summary[key] and self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('{0}: {1}'.format(key, ', '.join(summary[key])))
+
+        if self.index:
+            self.index.close()
+        return summary
+
+    def try_resolve(self, hosts):
+        try:
+            return self.resolve_devices(hosts)
+        except Exception as error:
+            return error
+
+    def try_set_tag(self, did, tid):
+        try:
+            return self.set_tag(did, tid)
+        except Exception as error:
+            return error
+
     def main(self):
+        if self.file:
+            self.bulk_tag(self.file)
+            return
+
         did = self.get_ids('devices', self.host)
         tid = self.get_ids('tags', self.tag)
 
@@ -120,13 +259,19 @@ class MVAPI():
 
 
 if __name__ == '__main__':
-    usage = """python mvapi_epo_assign_tag.py -H <HOSTNAME> -T <TAG NAME> -A <TYPE>"""
+    usage = """python mvapi_epo_assign_tag.py -H <HOSTNAME> -T <TAG NAME> -A <TYPE>
+       python mvapi_epo_assign_tag.py -F <HOST FILE | CSV | -> -T <TAG NAME> -A <TYPE> [-B <BATCH SIZE>] [-W <WORKERS>]"""
     title = 'MVISION API - EPO Tag Assignment'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
-    parser.add_argument('--host', '-H',
-                        required=True, type=str,
-                        help='Hostname')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--host', '-H',
+                       type=str,
+                       help='Hostname')
+
+    group.add_argument('--file', '-F',
+                       type=str,
+                       help='File or CSV with one hostname per line (use - for stdin)')
 
     parser.add_argument('--tag', '-T',
                         required=True, type=str,
@@ -137,5 +282,21 @@ if __name__ == '__main__':
                         choices=['assign', 'unassign'],
                         help='Should tag be assigned or unassigned?')
 
+    parser.add_argument('--batch-size', '-B',
+                        required=False, type=int,
+                        default=100, help='Hostnames per device lookup for --file, 1 if filter[name][in] is ignored (default: 100)')
+
+    parser.add_argument('--workers', '-W',
+                        required=False, type=int,
+                        default=16, help='Concurrent requests for --file (default: 16)')
+
+    parser.add_argument('--no-index',
+                        action='store_true',
+                        help='Do not resolve hostnames from the local device index')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
+
     args = parser.parse_args()
-    MVAPI().main()
+    MVAPI(args.profile).main()
@@ -2,89 +2,229 @@
 # Script to get system details from MVISION EPO
 
 import sys
-import requests
+import csv
 import json
-import logging
 
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from mvapi_client import MVAPIClient, MVAPIError
+from mvapi_device_index import INDEX_FNAME, DeviceIndex
 
-class MVAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
 
-        self.host = args.host
-
-        self.api_key = ''
-        client_id = ''
-        client_token = ''
-
-        auth = (client_id, client_token)
-
-        self.logging()
-        self.auth(auth)
-
-    def logging(self):
-        self.logger = logging.getLogger('logs')
-        self.logger.setLevel('DEBUG')
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
-
-    def auth(self, auth):
-        iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
-
-        headers = {
-            'x-api-key': self.api_key,
-            'Content-Type': 'application/vnd.api+json'
-        }
-
-        payload = {
-            "grant_type": "client_credentials",
-            "scope": "epo.device.r"
-        }
+class MVAPI(MVAPIClient):
+    scope = 'epo.device.r'
 
-        res = self.session.post(iam_url, headers=headers, auth=auth, data=payload)
+    def __init__(self, profile=None):
+        # authentication is deferred so --cached lookups answered by the device index need no token
+        super().__init__(profile=profile)
+        self.index_fname = self.profile.path(INDEX_FNAME)
 
-        if res.status_code != 200:
-            self.logger.error("Could not authenticate to get the IAM token: {0} - {1}".format(res.status_code, res.text))
-            sys.exit()
-        else:
-            self.logger.info('Successful authenticated.')
-            access_token = res.json()['access_token']
-            headers['Authorization'] = 'Bearer ' + access_token
-            self.session.headers = headers
+        self.host = args.host
 
     def get_device(self):
+        self.connect()
         param = {
             'filter[name][eq]': self.host
         }
 
-        res = self.session.get(self.base_url + '/epo/v2/devices'.format(type), params=param)
+        res = self.session.get(self.base_url + '/epo/v2/devices', params=param)
 
         if res.ok:
             if len(res.json()['data']) == 0:
                 self.logger.error('Could not find system with the hostname {0} in MVISION EPO.'.format(self.host))
             else:
+                DeviceIndex(self.index_fname).add(res.json()['data'])
                 self.logger.info(json.dumps(res.json(), indent=2))
         else:
             self.logger.error('Error in get_ids. {0} - {1}'.format(res.status_code, res.text))
             sys.exit()
 
+    def get_cached_device(self):
+        devices = DeviceIndex(self.index_fname).get(self.host)
+        if len(devices) == 0:
+            self.logger.debug('{0} not in the device index. Querying MVISION EPO.'.format(self.host))
+            self.get_device()
+        else:
+            self.logger.info(json.dumps(devices, indent=2))
+
+    def sync_index(self, full):
+        self.connect()
+        try:
+            DeviceIndex(self.index_fname).sync(self.session, self.base_url, full=full, logger=self.logger)
+        except Exception as error:
+            self.logger.error(str(error))
+            sys.exit()
+
+    def iter_devices(self, fields=None):
+        """Page through all of /epo/v2/devices via links.next and yield flattened device records per page."""
+        params = {'page[limit]': 1000}
+        if fields:
+            params['fields[devices]'] = ','.join(field for field in fields if field != 'id')
+
+        try:
+            for res in self.paginate('/epo/v2/devices', params):
+                page = []
+                for device in res['data']:
+                    record = device.get('attributes', {})
+                    record['id'] = device['id']
+                    if fields:
+                        record = {field: record.get(field) for field in fields}
+                    page.append(record)
+                yield page
+        except MVAPIError as error:
+            self.logger.error('Error in iter_devices. {0}'.format(str(error)))
+            sys.exit()
+
+    def export_devices(self, output, format, fields=None):
+        """
+        Stream the full device inventory to output ('-' for stdout) as NDJSON, CSV or Parquet.
+        Only one page is held in memory; Parquet is written as one row group per page.
+        CSV and Parquet columns are those of the first page (or --fields); columns that are null on
+        the whole first page are written as strings and attributes that only show up later are reported.
+        """
+        self.connect()
+
+        if format == 'parquet':
+            # pyarrow is only imported for Parquet exports, it is slow to load
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                self.logger.error('Parquet export requires the pyarrow package.')
+                sys.exit()
+            if output == '-':
+                self.logger.error('Parquet export needs an output file.')
+                sys.exit()
+
+        if format == 'parquet':
+            fh = None
+        elif output == '-':
+            fh = sys.stdout
+        else:
+            fh = open(output, 'w', newline='')
+
+        writer = None
+        columns = None
+        widened = set()
+        dropped = set()
+        count = 0
+        try:
+            for page in self.iter_devices(fields):
+                if not page:
+                    continue
+
+                if format != 'ndjson':
+                    if columns is None:
+                        columns = fields or list(dict.fromkeys(key for record in page for key in record))
+                        known = set(columns)
+                    for record in page:
+                        dropped.update(record.keys() - known)
+
+                if format == 'ndjson':
+                    fh.write(''.join(json.dumps(record) + '\n' for record in page))
+                elif format == 'csv':
+                    if writer is None:
+                        writer = csv.DictWriter(fh, fieldnames=columns, extrasaction='ignore')
+                        writer.writeheader()
+                    writer.writerows({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                                      for key, value in record.items()} for record in page)
+                else:
+                    if writer is None:
+                        schema, widened = self.parquet_schema(page, columns)
+                        writer = pyarrow.parquet.ParquetWriter(output, schema)
+                    writer.write_table(self.parquet_table(page, writer.schema, widened))
+
+                count += len(page)
+                self.logger.debug('Exported {0} devices.'.format(count))
+        finally:
+            if format == 'parquet' and writer is not None:
+                writer.close()
+            if fh is not None and fh is not sys.stdout:
+                fh.close()
+
+        if dropped:
+            self.logger.warning('Attributes missing from the first page were not exported: {0}. '
+                                'Select them with --fields.'.format(', '.join(sorted(dropped))))
+        self.logger.info('Exported {0} devices to {1}.'.format(count, output))
+        return count
+
+    @staticmethod
+    def parquet_schema(page, columns):
+        """Schema inferred from the first page, columns without any value there become strings."""
+        import pyarrow
+
+        inferred = pyarrow.Table.from_pydict({column: [record.get(column) for record in page]
+                                              for column in columns}).schema
+        widened = {field.name for field in inferred if pyarrow.types.is_null(field.type)}
+        schema = pyarrow.schema([pyarrow.field(field.name, pyarrow.string()) if field.name in widened else field
+                                 for field in inferred])
+        return schema, widened
+
+    @staticmethod
+    def parquet_table(page, schema, widened):
+        import pyarrow
+
+        def text(value):
+            if value is None or isinstance(value, str):
+                return value
+            return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+        data = {}
+        for column in schema.names:
+            values = [record.get(column) for record in page]
+            data[column] = [text(value) for value in values] if column in widened else values
+        return pyarrow.Table.from_pydict(data, schema=schema)
+
     def main(self):
-        self.get_device()
+        if args.export:
+            self.export_devices(args.export, args.format, args.fields.split(',') if args.fields else None)
+        elif args.sync_index:
+            self.sync_index(args.full)
+        elif args.cached:
+            self.get_cached_device()
+        else:
+            self.get_device()
 
 
 if __name__ == '__main__':
-    usage = """python mvapi_epo_get_devices.py -H <HOSTNAME>"""
+    usage = """python mvapi_epo_get_devices.py -H <HOSTNAME> [--cached]
+       python mvapi_epo_get_devices.py --sync-index [--full]
+       python mvapi_epo_get_devices.py -E <OUTPUT FILE | -> [-f <ndjson | csv | parquet>] [--fields <FIELD,FIELD>]"""
     title = 'MVISION API - EPO Get Devices'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
-    parser.add_argument('--host', '-H',
-                        required=True, type=str,
-                        help='Hostname')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--host', '-H',
+                       type=str,
+                       help='Hostname')
+
+    group.add_argument('--sync-index',
+                       action='store_true',
+                       help='Refresh the local device index (incremental unless --full)')
+
+    group.add_argument('--export', '-E',
+                       type=str,
+                       help='Export all devices to a file (use - for stdout)')
+
+    parser.add_argument('--format', '-f',
+                        required=False, type=str,
+                        default='ndjson', choices=['ndjson', 'csv', 'parquet'],
+                        help='Output format for --export (default: ndjson)')
+
+    parser.add_argument('--fields',
+                        required=False, type=str,
+                        default=None, help='Comma separated list of device fields to export')
+
+    parser.add_argument('--full',
+                        action='store_true',
+                        help='Rebuild the device index from all devices with --sync-index')
+
+    parser.add_argument('--cached',
+                        action='store_true',
+                        help='Answer from the local device index, query MVISION EPO only on a miss')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
 
     args = parser.parse_args()
-    MVAPI().main()
+    MVAPI(args.profile).main()
@@ -4,142 +4,736 @@
 
 import os
 import sys
-import logging
-import requests
 import json
+import queue
+import logging
+import signal
+import threading
 
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from argparse import ArgumentParser, RawTextHelpFormatter
 
+from mvapi_client import MVAPIClient, MVAPIError
+from mvapi_config import profiles
+from mvapi_json import dumps, dumps_lines
+from mvapi_metrics import metrics
+from mvapi_sinks import SinkError, open_sink
+
+# pages a running --backfill slice buffers ahead of the writer
+SLICE_PAGES = 2
+
+
+class Checkpoint():
+    """
+    Durable event cursor stored as JSON: the newest delivered timestamp plus the ids of the
+    events delivered at exactly that timestamp. Writes go to a temp file which is fsynced and
+    atomically renamed over the old checkpoint, so a crash leaves either the old or the new cursor.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.timestamp = None
+        self.ids = set()
+        self.legacy = False
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.fname):
+            return
+
+        with open(self.fname, 'r') as cache:
+            content = cache.read().strip()
+
+        if not content:
+            return
+
+        try:
+            state = json.loads(content)
+            self.timestamp = state['timestamp']
+            self.ids = set(state.get('ids', []))
+        except (ValueError, TypeError, KeyError):
+            # cache.log written by older versions only holds the plain timestamp
+            self.timestamp = content
+            self.legacy = True
+
+    def seen(self, event):
+        return event['timestamp'] == self.timestamp and event['id'] in self.ids
+
+    def advance(self, events):
+        for event in events:
+            if event['timestamp'] != self.timestamp:
+                self.timestamp = event['timestamp']
+                self.ids = set()
+            self.ids.add(event['id'])
+
+    def commit(self):
+        tmp_fname = self.fname + '.tmp'
+        with open(tmp_fname, 'w') as cache:
+            json.dump({'timestamp': self.timestamp, 'ids': sorted(self.ids)}, cache)
+            cache.flush()
+            os.fsync(cache.fileno())
+        os.replace(tmp_fname, self.fname)
+        self.legacy = False
+
 
-class MVAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
+def flatten(event):
+    # reuses the decoded attributes dict instead of copying it
+    mvepo_event = event['attributes']
+    mvepo_event['id'] = event['id']
+    mvepo_event['type'] = event['type']
+    mvepo_event['url'] = event['links']['self']
+    return mvepo_event
 
-        # MVAPI Keys
-        self.api_key = ''
-        client_id = ''
-        client_token = ''
 
-        auth = (client_id, client_token)
+class MVAPI(MVAPIClient):
+    scope = 'epo.evt.r'
 
-        self.cache_fname = os.path.dirname(os.path.abspath(__file__)) + '/cache.log'
-        if os.path.isfile(self.cache_fname):
-            cache = open(self.cache_fname, 'r')
-            self.pull_time = cache.read()
-            cache.close()
+    def __init__(self, profile=None):
+        # credentials and endpoints come from the profile, see mvapi_config
+        super().__init__(level='INFO', profile=profile)
+
+        # every profile keeps its own checkpoint
+        self.cache_fname = self.profile.path(os.path.dirname(os.path.abspath(__file__)) + '/cache.log')
+        os.makedirs(os.path.dirname(self.cache_fname), exist_ok=True)
+        self.checkpoint = Checkpoint(self.cache_fname)
+        if self.checkpoint.timestamp:
+            self.pull_time = self.checkpoint.timestamp
         else:
             self.pull_time = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
 
-        self.logging()
-        self.auth(auth)
+        # optional Insights enrichment of every page, see mvapi_enrich
+        self.enricher = None
 
-    def logging(self):
-        self.logger = logging.getLogger('logs')
-        self.logger.setLevel('INFO')
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.connect()
+
+    def enrich(self, pages):
+        return self.enricher.enrich(pages) if self.enricher else pages
+
+    def fetch_pages(self):
+        # GE plus the boundary ids of the checkpoint: events sharing the last timestamp are not lost
+        operator = 'GT' if self.checkpoint.legacy else 'GE'
+        params = {
+            'filter[timestamp][{0}]'.format(operator): self.checkpoint.timestamp or self.pull_time,
+            'sort': 'timestamp',
+            'page[limit]': 1000
+        }
+
+        for res in self.paginate('/epo/v2/events', params):
+            if len(res['data']) == 0:
+                self.logger.debug('No new MVISION EPO Events identified.')
+                break
+
+            seen = self.checkpoint.seen
+            page = [event for event in map(flatten, res['data']) if not seen(event)]
+
+            if page:
+                metrics.inc('mvapi_events_total', len(page), stage='fetched', tenant=self.profile.name)
+                yield page
 
-    def auth(self, auth):
+    def poll_pages(self, commit=True):
+        """
+        Yield the flattened events of every /epo/v2/events page as soon as the page arrives.
+        Pages are requested oldest first and the checkpoint is committed once the consumer asks
+        for the next page, i.e. only after the previous page has been delivered. With commit=False
+        the consumer commits itself, e.g. when a sink acknowledges the page.
+        """
+        for page in self.enrich(self.fetch_pages()):
+            yield page
+            metrics.inc('mvapi_events_total', len(page), stage='delivered', tenant=self.profile.name)
+
+            if commit:
+                self.checkpoint.advance(page)
+                self.checkpoint.commit()
+
+    def iter_pages(self, commit=True):
         try:
-            iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
+            for page in self.poll_pages(commit):
+                yield page
 
-            headers = {
-                'x-api-key': self.api_key,
-                'Content-Type': 'application/vnd.api+json'
-            }
+        except MVAPIError as error:
+            self.logger.error('Error in epo.get_events(). Error: {0} - {1}'.format(str(error.status_code), error.text))
+            sys.exit()
 
-            payload = {
-                "grant_type": "client_credentials",
-                "scope": "epo.evt.r"
-            }
+        except Exception as error:
+            self.logger.error('Error in epo.get_events(). Error: {}'.format(str(error)))
+            sys.exit()
 
-            res = self.session.post(iam_url, headers=headers, auth=auth, data=payload)
+    def fetch_slice(self, index, total, start, end, pages, stop):
+        """
+        Fetch the events with start <= timestamp < end page by page into the bounded queue pages, ending
+        with None or the error of the slice. Gives up once stop is set; slices share the pooled session.
+        """
+        params = {
+            'filter[timestamp][GE]': start,
+            'filter[timestamp][LT]': end,
+            'sort': 'timestamp',
+            'page[limit]': 1000
+        }
 
-            if res.ok:
-                access_token = res.json()['access_token']
-                headers['Authorization'] = 'Bearer ' + access_token
-                self.session.headers = headers
-                self.logger.debug('Debug epo.auth() - {0} - {1}'.format(res.status_code, res.text))
+        count = 0
+        number = 0
+        try:
+            for res in self.paginate('/epo/v2/events', params):
+                number += 1
+                page = [flatten(event) for event in res['data']]
+                count += len(page)
+                if not self.offer(pages, page, stop):
+                    return
 
-            if res.status_code != 200:
-                self.logger.error('Error in epo.auth(). Error: {} - {}'.format(str(res.status_code), res.text))
-                sys.exit()
+                self.logger.info('Backfill slice {0}/{1} ({2} - {3}): page {4}, {5} events.'
+                                 .format(index, total, start, end, number, count))
+        except MVAPIError as error:
+            self.offer(pages, Exception('Slice {0}/{1} failed. HTTP {2}'.format(index, total, str(error))), stop)
+        except Exception as error:
+            self.offer(pages, Exception('Slice {0}/{1} failed. {2}'.format(index, total, str(error))), stop)
+        else:
+            self.offer(pages, None, stop)
+
+    @staticmethod
+    def offer(pages, item, stop):
+        """Put item on the queue, blocking while it is full; False once stop is set."""
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def iter_backfill_pages(self, slices=8, workers=4, commit=True):
+        """
+        Split the window between the checkpoint and now into time slices and fetch them
+        concurrently on a bounded worker pool. Slices cover disjoint windows, so yielding their
+        pages in slice order is a timestamp-ordered merge. Every running slice buffers at most
+        SLICE_PAGES pages, so no more than workers x SLICE_PAGES pages are held however long the
+        window is. Events are de-duplicated by id and the checkpoint is committed after every page.
+        """
+        try:
+            for page in self.enrich(self.fetch_slices(slices, workers)):
+                yield page
+                metrics.inc('mvapi_events_total', len(page), stage='delivered', tenant=self.profile.name)
+
+                if commit:
+                    self.checkpoint.advance(page)
+                    self.checkpoint.commit()
 
         except Exception as error:
-            self.logger.error('Error in epo.auth(). Error: {}'.format(str(error)))
+            self.logger.error('Error in epo.iter_backfill_pages(). Error: {}'.format(str(error)))
             sys.exit()
 
-    def get_events(self):
+    def fetch_slices(self, slices, workers):
+        fmt = '%Y-%m-%dT%H:%M:%S.%f'
+        start = datetime.fromisoformat(self.pull_time.replace('Z', '+00:00'))
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        end = datetime.now(timezone.utc)
+        step = (end - start) / slices
+
+        bounds = [start + step * i for i in range(slices)] + [end]
+        bounds = [bound.strftime(fmt)[:-3] + 'Z' for bound in bounds]
+        bounds[0] = self.pull_time
+
+        self.pool(workers)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            index = 0
+            try:
+                while index < slices or pending:
+                    while index < slices and len(pending) < workers:
+                        pages = queue.Queue(maxsize=SLICE_PAGES)
+                        pool.submit(self.fetch_slice, index + 1, slices, bounds[index], bounds[index + 1], pages, stop)
+                        pending.append(pages)
+                        index += 1
+
+                    # the boundary of a slice spans its pages, which arrive sorted by timestamp
+                    boundary_ts = None
+                    boundary_ids = set()
+                    pages = pending.popleft()
+                    while True:
+                        events = pages.get()
+                        if events is None:
+                            break
+                        if isinstance(events, Exception):
+                            raise events
+
+                        page = []
+                        for event in events:
+                            if self.checkpoint.seen(event):
+                                continue
+                            if event['timestamp'] != boundary_ts:
+                                boundary_ts = event['timestamp']
+                                boundary_ids = set()
+                            elif event['id'] in boundary_ids:
+                                continue
+                            boundary_ids.add(event['id'])
+                            page.append(event)
+
+                        if page:
+                            metrics.inc('mvapi_events_total', len(page), stage='fetched', tenant=self.profile.name)
+                            yield page
+            finally:
+                # slices still fetching stop at their next page
+                stop.set()
+
+    def iter_events(self):
+        """Yield MVISION EPO events one by one without buffering more than a single page."""
+        for page in self.iter_pages():
+            for event in page:
+                yield event
+
+    def log_events(self, pages=None):
+        """Log every event page by page without keeping them, returns the number of events."""
+        count = 0
+        for page in pages or self.iter_pages():
+            for event in page:
+                self.logger.info(dumps(event).decode())
+            count += len(page)
+        return count
+
+    def get_events(self, pages=None):
+        """Return the list of all events, for library callers; the CLI uses log_events()."""
+        mvepo_events_dict = []
+
+        for page in pages or self.iter_pages():
+            for event in page:
+                self.logger.info(dumps(event).decode())
+            mvepo_events_dict.extend(page)
+        return mvepo_events_dict
+
+    def stream_events(self, output, pages=None):
+        """Write events as NDJSON to output ('-' for stdout) page by page."""
+        if output == '-':
+            fh = sys.stdout.buffer
+        else:
+            fh = open(output, 'ab')
+
+        count = 0
         try:
-            params = {
-                'filter[timestamp][GT]': self.pull_time,
-                'sort': '-timestamp',
-                'page[limit]': 1000
-            }
-
-            nextItem = None
-            nextFlag = True
-            mvepo_events_dict = []
-            cacheFlag = False
-
-            while (nextFlag):
-                if nextItem:
-                    url = self.base_url + nextItem
-                    res = self.session.get(url)
-                else:
-                    url = self.base_url + '/epo/v2/events'
-                    res = self.session.get(url, params=params)
-
-                if res.ok:
-                    self.logger.debug('Debug epo.get_events() - {0} - {1}'.format(res.status_code, res.text))
-                    res = res.json()
-                    if len(res['data']) > 0:
-                        if cacheFlag is False:
-                            cache = open(self.cache_fname, 'w')
-                            cache.write(res['data'][0]['attributes']['timestamp'])
-                            cache.close()
-                            cacheFlag = True
-
-                        for event in res['data']:
-                            mvepo_event = event['attributes']
-                            mvepo_event['id'] = event['id']
-                            mvepo_event['type'] = event['type']
-                            mvepo_event['url'] = event['links']['self']
-
-                            mvepo_events_dict.append(dict(mvepo_event))
-
-                        if res and res.get("links") and res.get("links").get("next"):
-                            nextItem = res["links"]["next"]
-                            nextFlag = True
+            for page in pages or self.iter_pages():
+                with metrics.stage('write'):
+                    fh.write(dumps_lines(page))
+                    fh.flush()
+                count += len(page)
+                self.logger.debug('Wrote {0} MVISION EPO Events to {1}.'.format(len(page), output))
+        finally:
+            if fh is not sys.stdout.buffer:
+                fh.close()
+
+        self.logger.info('Streamed {0} MVISION EPO Events to {1}.'.format(count, output))
+        return count
+
+    def commit_acked(self, acked, block=False):
+        """
+        Advance the checkpoint over all pages the sink has acknowledged so far and commit once.
+        With block=True wait up to a second for the first acknowledgement. Returns the number of pages.
+        """
+        pages = 0
+        while True:
+            try:
+                page = acked.get(timeout=1) if block and not pages else acked.get_nowait()
+            except queue.Empty:
+                break
+            self.checkpoint.advance(page)
+            pages += 1
+
+        if pages:
+            self.checkpoint.commit()
+        return pages
+
+    def sink_events(self, sink, pages=None):
+        """
+        Hand pages to a batching sink (see mvapi_sinks). Submitting blocks while the sink queue is
+        full and the checkpoint only moves over pages the sink has acknowledged as delivered.
+        """
+        acked = queue.Queue()
+        count = 0
+        try:
+            for page in pages or self.iter_pages(commit=False):
+                with metrics.stage('sink_submit'):
+                    sink.submit(page, acked.put)
+                count += len(page)
+                self.commit_acked(acked)
+            sink.close()
+
+        except SinkError as error:
+            self.logger.error('Error in epo.sink_events(). Error: {}'.format(str(error)))
+            sys.exit()
+
+        finally:
+            self.commit_acked(acked)
+
+        self.logger.info('Delivered {0} MVISION EPO Events to {1}.'.format(sink.delivered, type(sink).__name__))
+        return count
+
+    def follow(self, output=None, min_interval=5, max_interval=120, sink=None, reopen=None):
+        """
+        Keep the authenticated session open and poll for new events until SIGINT/SIGTERM.
+        The poll interval halves (down to min_interval) whenever events arrive and doubles
+        (up to max_interval) while the stream is idle; errors back off to max_interval.
+        The checkpoint is committed after every delivered page as in a single run; with a sink
+        each poll waits for the sink to acknowledge its pages before the next poll starts.
+        A sink that gives up is replaced by reopen() after max_interval and the pages it did not
+        deliver are polled again; without reopen the process exits with status 1.
+        """
+        acked = queue.Queue()
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+        fh = None
+        if output:
+            fh = sys.stdout.buffer if output == '-' else open(output, 'ab')
+
+        sinking = sink is not None
+        failed = False
+        interval = min_interval
+        self.logger.info('Following MVISION EPO Events from {0}.'.format(self.checkpoint.timestamp or self.pull_time))
+        try:
+            while not stop.is_set():
+                count = 0
+                try:
+                    if sinking and sink is None:
+                        sink = reopen()
+                        self.logger.info('Reopened {0}.'.format(type(sink).__name__))
+                    self.renew_token()
+                    # commits here: a stop breaks out of poll_pages() before it would commit the last page
+                    for page in self.poll_pages(commit=False):
+                        if sink:
+                            with metrics.stage('sink_submit'):
+                                sink.submit(page, acked.put)
+                            self.commit_acked(acked)
                         else:
-                            nextFlag = False
+                            if fh:
+                                fh.write(dumps_lines(page))
+                                fh.flush()
+                            else:
+                                for event in page:
+                                    self.logger.info(dumps(event).decode())
+                            self.checkpoint.advance(page)
+                            self.checkpoint.commit()
+                        count += len(page)
+                        if stop.is_set():
+                            break
+
+                    if sink:
+                        sink.flush()
+                        self.commit_acked(acked)
 
+                    if count:
+                        interval = max(min_interval, interval / 2)
+                        self.logger.debug('Delivered {0} MVISION EPO Events. Next poll in {1:.1f}s.'
+                                          .format(count, interval))
                     else:
-                        self.logger.debug('No new MVISION EPO Events identified. Exiting. {0}'.format(json.dumps(res)))
-                        sys.exit()
+                        interval = min(max_interval, interval * 2)
+
+                except SinkError as error:
+                    # a failed sink rejects every later page, the checkpoint is still at the last acknowledged one
+                    interval = max_interval
+                    self.commit_acked(acked)
+                    self.close_sink(sink)
+                    sink = None
+                    if reopen is None:
+                        self.logger.error('Error in epo.follow(). Error: {0}.'.format(str(error)))
+                        failed = True
+                        break
+                    self.logger.error('Error in epo.follow(). Error: {0}. Reopening the sink in {1}s.'
+                                      .format(str(error), interval))
 
+                except Exception as error:
+                    interval = max_interval
+                    self.logger.error('Error in epo.follow(). Error: {0}. Retrying in {1}s.'
+                                      .format(str(error), interval))
+
+                stop.wait(interval)
+        finally:
+            if fh and fh is not sys.stdout.buffer:
+                fh.close()
+            if sink:
+                try:
+                    sink.close()
+                except SinkError as error:
+                    self.logger.error('Error in epo.follow(). Error: {}'.format(str(error)))
+                self.commit_acked(acked)
+
+        self.logger.info('Stopped following MVISION EPO Events.')
+        if failed:
+            sys.exit(1)
+
+    @staticmethod
+    def close_sink(sink):
+        try:
+            sink.close()
+        except SinkError:
+            # the error that ended the sink was logged already
+            pass
+
+
+class Collector():
+    """
+    Collect the events of several tenant profiles in one process. Every tenant runs its own pipeline
+    in a thread with its own token, checkpoint and rate limits and hands pages to a bounded
+    per-tenant queue, so a tenant with a large backlog only fills its own queue. One writer drains
+    the queues with deficit round robin: every round each tenant gets up to `quantum` events
+    delivered. A tenant's checkpoint only moves over pages the writer or the sink has delivered.
+    """
+    def __init__(self, profiles, queue_size=4, quantum=1000):
+        self.profiles = profiles
+        self.quantum = quantum
+        self.queues = {profile: queue.Queue(maxsize=queue_size) for profile in profiles}
+        self.counts = {profile: 0 for profile in profiles}
+        self.ready = threading.Event()
+        self.stop = threading.Event()
+        self.error = None
+        self.logger = logging.getLogger('logs')
+
+    def put(self, profile, page, acked):
+        """Queue a page, blocking while the tenant queue is full; False once the writer failed."""
+        while self.error is None:
+            try:
+                self.queues[profile].put((page, acked), timeout=1)
+            except queue.Full:
+                continue
+            metrics.set('mvapi_queue_depth', self.queues[profile].qsize(), queue='collector', tenant=profile)
+            self.ready.set()
+            return True
+        return False
+
+    def produce(self, profile, follow=False, min_interval=5, max_interval=120):
+        # authentication or config errors are logged by MVAPIClient and only end this tenant
+        tenant = MVAPI(profile)
+        acked = queue.Queue()
+        pending = 0
+        interval = min_interval
+
+        while not self.stop.is_set() and self.error is None:
+            count = 0
+            try:
+                tenant.renew_token()
+                for page in tenant.poll_pages(commit=False):
+                    for event in page:
+                        event['tenant'] = profile
+                    if not self.put(profile, page, acked):
+                        break
+                    pending += 1
+                    count += len(page)
+                    pending -= tenant.commit_acked(acked)
+                    if self.stop.is_set():
+                        break
+
+                if count:
+                    interval = max(min_interval, interval / 2)
                 else:
-                    self.logger.error('Error in epo.get_events(). Error: {0} - {1}'.format(str(res.status_code), res.text))
-                    sys.exit()
+                    interval = min(max_interval, interval * 2)
 
-            for event in mvepo_events_dict:
-                self.logger.info(json.dumps(event))
-            return mvepo_events_dict
+            except Exception as error:
+                interval = max_interval
+                self.logger.error('Error in collector for tenant {0}. Error: {1}'.format(profile, str(error)))
 
-        except Exception as error:
-            self.logger.error('Error in epo.get_events(). Error: {}'.format(str(error)))
-            sys.exit()
+            # the next poll has to start from the checkpoint of everything delivered so far
+            while pending and self.error is None:
+                pending -= tenant.commit_acked(acked, block=True)
+
+            if not follow:
+                break
+            self.stop.wait(interval)
+
+    def deliver(self, page, acked, fh=None, sink=None):
+        if sink:
+            sink.submit(page, acked.put)
+            return
+
+        if fh:
+            fh.write(dumps_lines(page))
+            fh.flush()
+        else:
+            for event in page:
+                self.logger.info(dumps(event).decode())
+        acked.put(page)
+
+    def run(self, output=None, sink=None, follow=False, min_interval=5, max_interval=120):
+        if follow:
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop.set())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop.set())
+
+        fh = None
+        if output:
+            fh = sys.stdout.buffer if output == '-' else open(output, 'ab')
+
+        threads = [threading.Thread(target=self.produce, args=(profile, follow, min_interval, max_interval),
+                                    daemon=True) for profile in self.profiles]
+        deficit = {profile: 0 for profile in self.profiles}
+        try:
+            for thread in threads:
+                thread.start()
+
+            while any(thread.is_alive() for thread in threads) or any(not q.empty() for q in self.queues.values()):
+                # a sink that gave up fails in its sender thread, the producers stop once self.error is set
+                if sink and sink.error:
+                    raise sink.error
+                self.ready.clear()
+                served = False
+                for profile in self.profiles:
+                    deficit[profile] += self.quantum
+                    while deficit[profile] > 0:
+                        try:
+                            page, acked = self.queues[profile].get_nowait()
+                        except queue.Empty:
+                            # an idle tenant does not save up credit for later rounds
+                            deficit[profile] = 0
+                            break
+                        with metrics.stage('deliver', tenant=profile):
+                            self.deliver(page, acked, fh, sink)
+                        metrics.set('mvapi_queue_depth', self.queues[profile].qsize(), queue='collector', tenant=profile)
+                        deficit[profile] -= len(page)
+                        self.counts[profile] += len(page)
+                        served = True
+
+                if not served:
+                    self.ready.wait(0.5)
+
+        except SinkError as error:
+            self.error = error
+            self.logger.error('Error in epo.collector(). Error: {}'.format(str(error)))
+
+        finally:
+            if fh and fh is not sys.stdout.buffer:
+                fh.close()
+            if sink:
+                try:
+                    sink.close()
+                except SinkError as error:
+                    # close() raises the error of a sink that gave up once more
+                    if error is not self.error:
+                        self.error = self.error or error
+                        self.logger.error('Error in epo.collector(). Error: {}'.format(str(error)))
+            for thread in threads:
+                thread.join(timeout=5)
+
+        for profile in self.profiles:
+            self.logger.info('Collected {0} MVISION EPO Events for tenant {1}.'.format(self.counts[profile], profile))
+        return self.counts
 
 
 if __name__ == '__main__':
-    usage = """python mvapi_epo_get_events.py"""
+    usage = """python mvapi_epo_get_events.py [-O <OUTPUT FILE | ->] [-B -S <SLICES> -W <WORKERS>]
+       python mvapi_epo_get_events.py --follow [-O <OUTPUT FILE | ->] [--min-interval <SECONDS>] [--max-interval <SECONDS>]
+       python mvapi_epo_get_events.py --sink <SINK> [--sink-token <TOKEN>] [--sink-batch <EVENTS>] [--follow]
+       python mvapi_epo_get_events.py --tenants <PROFILE,PROFILE | all> [-O <OUTPUT FILE | -> | --sink <SINK>] [--follow]
+       python mvapi_epo_get_events.py --enrich [--enrich-delay <SECONDS>] [--enrich-window <HASHES>] [...]
+
+SINK examples:
+  file:///var/log/mvepo.ndjson?rotate=104857600&backups=5
+  syslog://siem:514, syslog+tls://siem:6514
+  hec+https://splunk:8088/services/collector
+  elastic+https://elastic:9200/_bulk?index=mvepo-events
+  kafka+http://restproxy:8082/topics/mvepo-events"""
     title = 'MVISION API - MVISION EPO Events'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
+    parser.add_argument('--output', '-O',
+                        required=False, type=str,
+                        default=None, help='Stream events as NDJSON to a file (use - for stdout)')
+
+    parser.add_argument('--backfill', '-B',
+                        action='store_true',
+                        help='Fetch the window since the last checkpoint as parallel time slices')
+
+    parser.add_argument('--slices', '-S',
+                        required=False, type=int,
+                        default=8, help='Number of time slices for --backfill (default: 8)')
+
+    parser.add_argument('--workers', '-W',
+                        required=False, type=int,
+                        default=4, help='Maximum concurrent slice requests for --backfill, each buffers up to {0} pages (default: 4)'.format(SLICE_PAGES))
+
+    parser.add_argument('--follow', '-F',
+                        action='store_true',
+                        help='Keep running and poll for new events on an adaptive interval')
+
+    parser.add_argument('--min-interval',
+                        required=False, type=float,
+                        default=5, help='Shortest poll interval in seconds for --follow (default: 5)')
+
+    parser.add_argument('--max-interval',
+                        required=False, type=float,
+                        default=120, help='Longest poll interval in seconds for --follow (default: 120)')
+
+    parser.add_argument('--sink',
+                        required=False, type=str,
+                        default=None, help='Deliver events in batches to a file, syslog, HTTP bulk or Kafka REST sink')
+
+    parser.add_argument('--sink-token',
+                        required=False, type=str,
+                        default=os.environ.get('MVAPI_SINK_TOKEN'),
+                        help='Token for HEC, Elasticsearch or Kafka REST sinks (default: $MVAPI_SINK_TOKEN)')
+
+    parser.add_argument('--sink-batch',
+                        required=False, type=int,
+                        default=500, help='Events per sink batch (default: 500)')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
+
+    parser.add_argument('--tenants',
+                        required=False, type=str,
+                        default=None, help='Collect several tenant profiles in parallel (comma separated or all)')
+
+    parser.add_argument('--enrich',
+                        action='store_true',
+                        help='Add MVISION Insights verdicts for the file hashes of every event')
+
+    parser.add_argument('--enrich-delay',
+                        required=False, type=float,
+                        default=2.0, help='Longest time in seconds a page waits for Insights lookups (default: 2)')
+
+    parser.add_argument('--enrich-window',
+                        required=False, type=int,
+                        default=10000, help='Number of recent hash verdicts kept in memory (default: 10000)')
+
+    parser.add_argument('--enrich-batch',
+                        required=False, type=int,
+                        default=10, help='Hashes per multi-value Insights request (default: 10)')
+
     args = parser.parse_args()
 
-    MVAPI().get_events()
+    if args.tenants:
+        if args.backfill or args.profile or args.enrich:
+            parser.error('--tenants cannot be combined with --backfill, --profile or --enrich')
+        tenants = profiles() if args.tenants == 'all' else [name.strip() for name in args.tenants.split(',')]
+        sink = open_sink(args.sink, token=args.sink_token, batch_size=args.sink_batch) if args.sink else None
+        collector = Collector(tenants)
+        collector.run(args.output, sink, args.follow, args.min_interval, args.max_interval)
+        sys.exit(1 if collector.error else None)
+
+    mvapi = MVAPI(args.profile)
+    if args.enrich:
+        # the Insights client and the IOC cache are only loaded when enrichment is asked for
+        from mvapi_enrich import Enricher
+        from mvapi_insights_search import MVAPI as InsightsAPI
+        mvapi.enricher = Enricher(InsightsAPI(profile=args.profile, level='INFO'), window=args.enrich_window,
+                                  batch_size=args.enrich_batch, max_delay=args.enrich_delay)
+    sink = open_sink(args.sink, token=args.sink_token, batch_size=args.sink_batch) if args.sink else None
+    pages = mvapi.iter_backfill_pages(args.slices, args.workers, commit=sink is None) if args.backfill else None
+
+    if args.follow:
+        if pages and sink:
+            mvapi.sink_events(sink, pages)
+            sink = open_sink(args.sink, token=args.sink_token, batch_size=args.sink_batch)
+        elif pages and args.output:
+            mvapi.stream_events(args.output, pages)
+        elif pages:
+            mvapi.log_events(pages)
+        reopen = (lambda: open_sink(args.sink, token=args.sink_token, batch_size=args.sink_batch)) if sink else None
+        mvapi.follow(args.output, args.min_interval, args.max_interval, sink, reopen)
+    elif sink:
+        mvapi.sink_events(sink, pages)
+    elif args.output:
+        mvapi.stream_events(args.output, pages)
+    else:
+        mvapi.log_events(pages)
+
+    if mvapi.enricher:
+        mvapi.enricher.close()
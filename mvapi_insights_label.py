@@ -1,90 +1,263 @@
 # Written by mohlcyber - 04.04.2022
 # Script to pull Campaings with a specific label
 
-import requests
+import sys
 import json
+import queue
 import logging
+import threading
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+from mvapi_campaign_store import CampaignStore, FULL_SYNC_AGE, MAX_AGE
+from mvapi_client import MVAPIClient, MVAPIError
+from mvapi_ioc_export import FORMATS, FingerprintSet, open_writer
 
 logger = logging.getLogger('logs')
-logger.setLevel('DEBUG')
-handler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-
-
-class MVAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
-
-        # MVAPI Keys
-        api_key = ''
-        client_id = ''
-        client_token = ''
-
-        self.headers = {
-            'x-api-key': api_key,
-            'Content-Type': 'application/vnd.api+json'
-        }
 
-        auth = (client_id, client_token)
 
-        self.auth(auth)
+class MVAPI(MVAPIClient):
+    scope = 'ins.user'
 
-    def auth(self, auth):
-        iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
+    def __init__(self, profile=None):
+        # authentication is deferred until the campaign snapshot has to be downloaded
+        super().__init__(profile=profile)
 
-        payload = {
-            "grant_type": "client_credentials",
-            "scope": "ins.user"
+    def iter_campaigns(self, limit=2000, sort=None):
+        """Yield pages of /insights/v2/campaigns, following links.next or offsets until the last page."""
+        filters = {
+            'fields': 'id,name,threat_level_id,coverage,is_coat,description,kb_article_link,external_analysis,'
+                      'created_on,prevalence,is_profile,threat_profile_type,related_campaigns,categories',
+            'limit': limit,
+            'offset': 0
         }
+        if sort:
+            filters['sort'] = sort
 
-        res = self.session.post(iam_url, headers=self.headers, auth=auth, data=payload)
-        if res.ok:
-            access_token = res.json()['access_token']
-            self.headers['Authorization'] = 'Bearer ' + access_token
-            self.session.headers.update(self.headers)
-            logger.info('Successfull authenticated.')
-        else:
-            logger.error('Error in mvapi.auth. HTTP: {0} - {1}'.format(res.status_code, res.text))
+        try:
+            for page in self.iter_pages('/insights/v2/campaigns', filters):
+                yield page
+        except MVAPIError as error:
+            logger.error('Error in mvapi.get_campaigns. HTTP: {0} - {1}'.format(error.status_code, error.text))
             exit()
 
-    def get_campaigns(self, category):
+    def iter_pages(self, path, filters):
+        """
+        Yield every page of path, following links.next or the offset after a full page. Only the ids of the
+        previous page are kept: a page with the same ids ends the loop, e.g. if the server ignores offset.
+        """
+        previous = set()
+        res = self.session.get(self.base_url + path, params=filters)
+        while True:
+            if not res.ok:
+                raise MVAPIError(res.status_code, res.text)
+
+            res = res.json()
+            ids = set(record['id'] for record in res['data'])
+            if ids and ids <= previous:
+                logger.warning('{0} returned the same records again, stopping at offset {1}.'
+                               .format(path, filters['offset']))
+                break
+            previous = ids
+            yield res['data']
+            filters['offset'] += len(res['data'])
+
+            if res.get('links') and res['links'].get('next'):
+                res = self.session.get(self.base_url + res['links']['next'])
+            elif len(res['data']) == filters['limit']:
+                res = self.session.get(self.base_url + path, params=filters)
+            else:
+                break
+
+    def sync(self, store, full_sync_age=FULL_SYNC_AGE):
+        """
+        Bring the local snapshot up to date and return the new and changed campaigns. Usually only the
+        newest campaigns are requested, in small pages sorted by created_on, until a page brings nothing
+        new; a full download runs once the last one is older than full_sync_age seconds.
+        """
+        self.connect()
+        full = store.age('full_sync_at') > full_sync_age
+        if full:
+            changes = store.merge(self.iter_campaigns(), full=True)
+        else:
+            changes = store.merge(self.iter_campaigns(limit=100, sort='-created_on'))
+
+        logger.info('{0} sync of the campaign snapshot. New: {1}, changed: {2}, removed: {3}.'
+                    .format('Full' if full else 'Incremental', sum(1 for change in changes if change[0] == 'new'),
+                            sum(1 for change in changes if change[0] == 'changed'), store.removed))
+        return changes
+
+    def get_campaigns(self, category, max_age=MAX_AGE, refresh=False, changes_only=False):
+        """
+        Answer a label expression ('A AND B OR C') from the local campaign snapshot. The snapshot
+        is synced if it is older than max_age seconds or refresh is set. With changes_only the
+        snapshot is always synced and only the new and changed campaigns of this sync are reported.
+        """
+        store = CampaignStore()
+        changes = None
+        if refresh or changes_only or store.age() > max_age:
+            changes = dict((str(campaign['id']), status) for status, campaign in self.sync(store))
+
         count = 0
+        for campaign in store.query(category, within=changes if changes_only else None):
+            if changes_only:
+                logger.info(json.dumps({'status': changes[str(campaign['id'])], 'campaign': campaign},
+                                       separators=(',', ':')))
+            else:
+                logger.info(json.dumps(campaign))
+            count += 1
+
+        logger.info('Found {0} {1}campaigns with the label {2}'.format(count, 'new or changed ' if changes_only
+                                                                       else '', category))
+        store.close()
+
+    def iter_campaign_iocs(self, campaign_id, limit=1000):
+        """Yield pages of the IOCs of one campaign from /insights/v2/iocs, following links.next or offsets."""
         filters = {
-            'fields': 'id,name,threat_level_id,coverage,is_coat,description,kb_article_link,external_analysis,'
-                      'created_on,prevalence,is_profile,threat_profile_type,related_campaigns,categories',
-            'limit': 2000
+            'filter[campaign_id]': campaign_id,
+            'fields': 'id,type,value,category',
+            'limit': limit,
+            'offset': 0
         }
 
-        res = self.session.get(self.base_url + '/insights/v2/campaigns', params=filters)
-        if res.ok:
-            for campaign in res.json()['data']:
-                if category in campaign['attributes']['categories']:
-                    logger.info(json.dumps(campaign))
-                    count += 1
+        return self.iter_pages('/insights/v2/iocs', filters)
 
-            logger.info('Found {0} campaigns with the label {1}'.format(count, category))
-        else:
-            logger.error('Error in mvapi.get_campaigns. HTTP: {0} - {1}'.format(res.status_code, res.text))
-            exit()
+    def export_iocs(self, category, output, format='plain', workers=8, types=None, max_age=MAX_AGE, refresh=False):
+        """
+        Export the IOCs of every campaign matching a label expression to output ('-' for stdout).
+        Campaigns are downloaded concurrently page by page into a bounded queue, so at most
+        2 x workers pages are held in memory; IOCs shared by several campaigns are written once.
+        """
+        store = CampaignStore()
+        if refresh or store.age() > max_age:
+            self.sync(store)
+        campaign_ids = [str(campaign['id']) for campaign in store.query(category)]
+        store.close()
+        logger.info('Exporting the IOCs of {0} campaigns with the label {1}.'.format(len(campaign_ids), category))
+
+        self.connect()
+        self.pool(workers)
+        pages = queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # gives up once the writer has stopped, e.g. on a closed output pipe
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch(campaign_id):
+            try:
+                for page in self.iter_campaign_iocs(campaign_id):
+                    if not put((campaign_id, page)):
+                        return
+            except Exception as error:
+                logger.error('Could not export the IOCs of campaign {0}. Error: {1}'.format(campaign_id, str(error)))
+                put((campaign_id, None))
+            finally:
+                put((campaign_id, done))
+
+        fh = sys.stdout if output == '-' else open(output, 'w', newline='')
+        writer = open_writer(format, fh)
+        seen = FingerprintSet()
+        counts = {'written': 0, 'duplicates': 0, 'failed': 0}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for campaign_id in campaign_ids:
+                    pool.submit(fetch, campaign_id)
+                self.drain(pages, done, writer, seen, counts, len(campaign_ids), types, stop)
+            writer.close()
+        finally:
+            if fh is not sys.stdout:
+                fh.close()
+
+        logger.info('Exported {0} IOCs ({1} duplicates skipped, {2} campaigns failed, {3} KiB dedup table).'
+                    .format(counts['written'], counts['duplicates'], counts['failed'], seen.nbytes() // 1024))
+        return counts
+
+    @staticmethod
+    def drain(pages, done, writer, seen, counts, remaining, types, stop):
+        try:
+            while remaining:
+                campaign_id, page = pages.get()
+                if page is done:
+                    remaining -= 1
+                    continue
+                if page is None:
+                    counts['failed'] += 1
+                    continue
+
+                for ioc in page:
+                    attributes = ioc['attributes']
+                    type = (attributes.get('type') or '').lower()
+                    if types and type not in types:
+                        continue
+                    if not seen.add('{0}:{1}'.format(type, attributes['value'].lower())):
+                        counts['duplicates'] += 1
+                        continue
+                    writer.write(ioc, campaign_id)
+                    counts['written'] += 1
+        finally:
+            stop.set()
 
     def main(self):
-        self.get_campaigns(args.label)
+        if args.export_iocs:
+            types = [type.strip().lower() for type in args.types.split(',')] if args.types else None
+            self.export_iocs(args.label, args.export_iocs, args.format, args.workers, types, args.max_age,
+                             args.refresh)
+        else:
+            self.get_campaigns(args.label, args.max_age, args.refresh, args.changes)
 
 
 if __name__ == '__main__':
-    usage = """python mvapi_insights_label.py -L <LABEL>"""
+    usage = """python mvapi_insights_label.py -L <LABEL | "LABEL AND LABEL OR LABEL"> [--refresh | --changes] [--max-age <SECONDS>]
+       python mvapi_insights_label.py -L <LABEL> --export-iocs <OUTPUT FILE | -> [--format <plain | csv | stix>]
+       [--types <TYPE,TYPE>] [-W <WORKERS>]"""
     title = 'MVISION API - MVISION Insights search for label'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
     parser.add_argument('--label', '-L',
                         required=True, type=str,
-                        help='MVISION Insights Label')
+                        help='MVISION Insights Label or label expression with AND/OR')
+
+    parser.add_argument('--refresh',
+                        action='store_true',
+                        help='Sync the campaign snapshot even if it is still fresh')
+
+    parser.add_argument('--changes',
+                        action='store_true',
+                        help='Sync and only report campaigns that are new or changed since the last sync')
+
+    parser.add_argument('--export-iocs',
+                        required=False, type=str,
+                        default=None, help='Export the IOCs of the matching campaigns as a block list (use - for stdout)')
+
+    parser.add_argument('--format',
+                        required=False, type=str, choices=FORMATS,
+                        default='plain', help='Format of --export-iocs: plain, csv or stix (default: plain)')
+
+    parser.add_argument('--types',
+                        required=False, type=str,
+                        default=None, help='Only export these IOC types, e.g. md5,sha256 (default: all)')
+
+    parser.add_argument('--workers', '-W',
+                        required=False, type=int,
+                        default=8, help='Campaigns downloaded concurrently for --export-iocs (default: 8)')
+
+    parser.add_argument('--max-age',
+                        required=False, type=int,
+                        default=MAX_AGE, help='Maximum age of the campaign snapshot in seconds (default: 3600)')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
 
     args = parser.parse_args()
 
-    MVAPI().main()
+    MVAPI(args.profile).main()
@@ -2,89 +2,318 @@
 # Sample script to search hashes in MVISION Insights via MVISION API
 
 import sys
-import requests
-import logging
+import json
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from mvapi_client import MVAPIClient, MVAPIError, load_aiohttp
+from mvapi_ioc_cache import IOCCache
 
-class MVAPI():
-    def __init__(self):
-        self.base_url = 'https://api.mvision.mcafee.com'
-        self.session = requests.Session()
+HASH_TYPES = {32: 'md5', 40: 'sha1', 64: 'sha256'}
+IOC_FIELDS = 'id, type, value, coverage, uid, is_coat, is_sdb_dirty, category, comment, campaigns, threat, prevalence'
 
-        # MVAPI Keys
-        self.api_key = ''
-        client_id = ''
-        client_token = ''
 
-        auth = (client_id, client_token)
+def ioc_filters(type, values):
+    """Query for one or several hashes of the same type; several hashes use a multi-value filter."""
+    filters = {
+        'filter[type][eq]': type,
+        'fields': IOC_FIELDS,
+        'limit': len(values)
+    }
+    if len(values) == 1:
+        filters['filter[value]'] = values[0]
+    else:
+        filters['filter[value][in]'] = ','.join(values)
+    return filters
 
-        self.logging()
-        self.auth(auth)
 
-    def logging(self):
-        self.logger = logging.getLogger('logs')
-        self.logger.setLevel('DEBUG')
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s;%(levelname)s;%(message)s")
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+def match_iocs(values, data):
+    """IOCs by hash; None if an IOC outside values shows up, i.e. the tenant ignores filter[value][in]."""
+    if len(values) == 1:
+        return {values[0]: ioc for ioc in data[:1]}
 
-    def auth(self, auth):
-        iam_url = "https://iam.mcafee-cloud.com/iam/v1.1/token"
+    iocs = {ioc['attributes']['value'].lower(): ioc for ioc in data}
+    if any(value not in values for value in iocs):
+        return None
+    return iocs
 
-        headers = {
-            'x-api-key': self.api_key,
-            'Content-Type': 'application/vnd.api+json'
-        }
 
-        payload = {
-            "grant_type": "client_credentials",
-            "scope": "ins.user ins.suser ins.ms.r"
-        }
+def batch_records(type, values, iocs=None, error=None):
+    if error is not None:
+        return [{'hash': value, 'type': type, 'found': False, 'error': str(error)} for value in values]
 
-        res = self.session.post(iam_url, headers=headers, auth=auth, data=payload)
-
-        if res.status_code != 200:
-            self.logger.error('Could not authenticate to get the IAM token: {0} - {1}'.format(res.status_code, res.text))
-            sys.exit()
+    records = []
+    for value in values:
+        if value in iocs:
+            records.append({'hash': value, 'type': type, 'found': True, 'ioc': iocs[value]})
         else:
-            self.logger.info('Successful authenticated.')
-            access_token = res.json()['access_token']
-            headers['Authorization'] = 'Bearer ' + access_token
-            self.session.headers = headers
+            records.append({'hash': value, 'type': type, 'found': False})
+    return records
+
+
+class MVAPI(MVAPIClient):
+    scope = 'ins.user ins.suser ins.ms.r'
+
+    def __init__(self, use_cache=True, refresh=False, profile=None, level='DEBUG'):
+        # authentication is deferred until the first lookup that is not answered from the cache
+        super().__init__(level=level, profile=profile)
+
+        self.cache = IOCCache() if use_cache else None
+        self.refresh = refresh
+        # cleared once a response shows that the tenant ignores filter[value][in]
+        self.in_filter = True
+
+    def lookup_iocs(self, type, values):
+        """
+        Query /insights/v2/iocs for one or several hashes of the same type, matched back by value.
+        A tenant that ignores filter[value][in] answers with IOCs outside the batch; the batch is then
+        looked up hash by hash and so are all later batches.
+        """
+        if len(values) > 1 and self.in_filter:
+            iocs = match_iocs(values, self.get_iocs(type, values))
+            if iocs is not None:
+                return iocs
+            self.ignore_in_filter()
+
+        iocs = {}
+        for value in values:
+            iocs.update(match_iocs([value], self.get_iocs(type, [value])))
+        return iocs
+
+    def get_iocs(self, type, values):
+        res = self.session.get(self.base_url + '/insights/v2/iocs', params=ioc_filters(type, values))
+        if not res.ok:
+            raise MVAPIError(res.status_code, res.text)
+        return res.json()['data']
+
+    async def lookup_iocs_async(self, client, type, values):
+        if len(values) > 1 and self.in_filter:
+            res = await client.get_json('/insights/v2/iocs', ioc_filters(type, values))
+            iocs = match_iocs(values, res['data'])
+            if iocs is not None:
+                return iocs
+            self.ignore_in_filter()
+
+        iocs = {}
+        for value in values:
+            res = await client.get_json('/insights/v2/iocs', ioc_filters(type, [value]))
+            iocs.update(match_iocs([value], res['data']))
+        return iocs
+
+    def ignore_in_filter(self):
+        if self.in_filter:
+            self.in_filter = False
+            self.logger.warning('The tenant ignores filter[value][in], looking up hashes one by one.')
+
+    def cached(self, value):
+        if self.cache is None or self.refresh:
+            return None
+        return self.cache.get(value)
 
     def search_ioc(self):
-        filters = {
-            'filter[type][eq]': 'md5',
-            'filter[value]': args.hash,
-            'fields': 'id, type, value, coverage, uid, is_coat, is_sdb_dirty, category, comment, campaigns, threat, prevalence',
-            'limit': 1
-        }
-        res = self.session.get(self.base_url + '/insights/v2/iocs', params=filters)
-
-        if res.ok:
-            if len(res.json()['data']) == 0:
-                self.logger.info('No Hash details in MVISION Insights found.')
-            else:
-                self.logger.info(res.text)
+        value = args.hash.lower()
+        type = HASH_TYPES.get(len(value), 'md5')
+
+        cached = self.cached(value)
+        if cached:
+            ioc = cached[1]
+        else:
+            self.connect()
+            try:
+                ioc = self.lookup_iocs(type, [value]).get(value)
+            except Exception as error:
+                self.logger.error('Error in search_ioc. {0}'.format(str(error)))
+                sys.exit()
+
+            if self.cache is not None:
+                self.cache.put(value, type, ioc)
+
+        if ioc is None:
+            self.logger.info('No Hash details in MVISION Insights found.')
         else:
-            self.logger.error('Error in search_ioc. HTTP {0} - {1}'.format(str(res.status_code), res.text))
-            sys.exit()
+            self.logger.info(json.dumps({'data': [ioc]}))
+
+        self.close()
+
+    def close(self):
+        if self.cache is not None:
+            self.logger.info(self.cache.stats())
+            self.cache.close()
+
+    def search_batch(self, type, values):
+        try:
+            return batch_records(type, values, self.lookup_iocs(type, values))
+        except Exception as error:
+            return batch_records(type, values, error=error)
+
+    async def search_batch_async(self, client, type, values):
+        try:
+            return batch_records(type, values, await self.lookup_iocs_async(client, type, values))
+        except Exception as error:
+            return batch_records(type, values, error=error)
+
+    def search_bulk(self, source, output, batch_size=1, workers=8):
+        """
+        Look up every MD5/SHA1/SHA256 hash read from source (file or '-' for stdin) and write one
+        NDJSON record per hash to output, including not-found and error records. Hashes are grouped
+        by type into batches which run concurrently; at most 2 x workers batches are in flight.
+        With aiohttp installed the batches run on the asyncio client, otherwise on a thread pool.
+        """
+        self.pool(workers)
+
+        fin = sys.stdin if source == '-' else open(source, 'r')
+        fout = sys.stdout if output == '-' else open(output, 'w')
+
+        def batches():
+            seen = set()
+            pending = {}
+            for line in fin:
+                value = line.strip().lower()
+                if not value or value in seen:
+                    continue
+                seen.add(value)
+
+                type = HASH_TYPES.get(len(value))
+                if type is None or any(c not in '0123456789abcdef' for c in value):
+                    yield None, [{'hash': value, 'found': False, 'error': 'Unsupported hash format'}]
+                    continue
+
+                cached = self.cached(value)
+                if cached:
+                    record = {'hash': value, 'type': type, 'found': cached[0], 'cached': True}
+                    if cached[0]:
+                        record['ioc'] = cached[1]
+                    yield None, [record]
+                    continue
+
+                pending.setdefault(type, []).append(value)
+                if len(pending[type]) >= batch_size:
+                    yield type, pending.pop(type)
+
+            for type, values in pending.items():
+                yield type, values
+
+        counts = {'found': 0, 'not_found': 0, 'error': 0}
+        try:
+            if load_aiohttp() is not None:
+                import asyncio
+                asyncio.run(self.search_bulk_async(batches(), fout, counts, workers))
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    inflight = deque()
+                    for type, batch in batches():
+                        if type is None:
+                            inflight.append(batch)
+                        else:
+                            self.connect()
+                            inflight.append(pool.submit(self.search_batch, type, batch))
+
+                        while len(inflight) > workers * 2 or (inflight and isinstance(inflight[0], list)):
+                            batch = inflight.popleft()
+                            self.write_records(batch if isinstance(batch, list) else batch.result(), fout, counts)
+
+                    while inflight:
+                        batch = inflight.popleft()
+                        self.write_records(batch if isinstance(batch, list) else batch.result(), fout, counts)
+        finally:
+            if fin is not sys.stdin:
+                fin.close()
+            if fout is not sys.stdout:
+                fout.close()
+
+        self.logger.info('Bulk search finished. Found: {0}, not found: {1}, errors: {2}.'
+                         .format(counts['found'], counts['not_found'], counts['error']))
+        self.close()
+
+    async def search_bulk_async(self, batches, fout, counts, workers):
+        import asyncio
+
+        inflight = deque()
+        client = None
+        try:
+            for type, batch in batches:
+                if type is None:
+                    inflight.append(batch)
+                else:
+                    if client is None:
+                        client = await self.async_client(workers).__aenter__()
+                    inflight.append(asyncio.ensure_future(self.search_batch_async(client, type, batch)))
+
+                while len(inflight) > workers * 2 or (inflight and isinstance(inflight[0], list)):
+                    batch = inflight.popleft()
+                    self.write_records(batch if isinstance(batch, list) else await batch, fout, counts)
+
+            while inflight:
+                batch = inflight.popleft()
+                self.write_records(batch if isinstance(batch, list) else await batch, fout, counts)
+        finally:
+            if client is not None:
+                await client.__aexit__(None, None, None)
+
+    def write_records(self, records, fout, counts):
+        for record in records:
+            if 'error' in record:
+                counts['error'] += 1
+            else:
+                if record['found']:
+                    counts['found'] += 1
+                else:
+                    counts['not_found'] += 1
+
+                if self.cache is not None and 'cached' not in record:
+                    self.cache.put(record['hash'], record['type'], record.get('ioc'))
+            fout.write(json.dumps(record) + '\n')
+        fout.flush()
 
     def main(self):
-        self.search_ioc()
+        if args.file:
+            self.search_bulk(args.file, args.output, args.batch_size, args.workers)
+        else:
+            self.search_ioc()
 
 
 if __name__ == '__main__':
-    usage = """python mvapi_insights_search.py -H <MD5 Hash>"""
+    usage = """python mvapi_insights_search.py -H <MD5 | SHA1 | SHA256 Hash>
+       python mvapi_insights_search.py -F <HASH FILE | -> [-O <OUTPUT FILE | ->] [-B <BATCH SIZE>] [-W <WORKERS>]
+       [--no-cache | --refresh]"""
     title = 'MVISION API - MVISION Insights Search for Hash'
     parser = ArgumentParser(description=title, usage=usage, formatter_class=RawTextHelpFormatter)
 
-    parser.add_argument('--hash', '-H',
-                        required=True, type=str,
-                        help='MD5 Hash to search for')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--hash', '-H',
+                       type=str,
+                       help='MD5, SHA1 or SHA256 Hash to search for')
+
+    group.add_argument('--file', '-F',
+                       type=str,
+                       help='File with one hash per line to search for (use - for stdin)')
+
+    parser.add_argument('--output', '-O',
+                        required=False, type=str,
+                        default='-', help='NDJSON output for --file (default: stdout)')
+
+    parser.add_argument('--batch-size', '-B',
+                        required=False, type=int,
+                        default=1, help='Hashes per multi-value request for --file (default: 1)')
+
+    parser.add_argument('--workers', '-W',
+                        required=False, type=int,
+                        default=8, help='Concurrent requests for --file (default: 8)')
+
+    cache = parser.add_mutually_exclusive_group()
+    cache.add_argument('--no-cache',
+                       action='store_true',
+                       help='Do not read or write the local IOC cache')
+
+    cache.add_argument('--refresh',
+                       action='store_true',
+                       help='Ignore cached results but store the fresh ones')
+
+    parser.add_argument('--profile',
+                        required=False, type=str,
+                        default=None, help='Tenant profile from the mvapi config file (default: $MVAPI_PROFILE or default)')
 
     args = parser.parse_args()
-    MVAPI().main()
+    MVAPI(use_cache=not args.no_cache, refresh=args.refresh, profile=args.profile).main()
@@ -0,0 +1,108 @@
+# Local SQLite cache for MVISION Insights IOC lookups
+# Found and not-found results are kept with separate TTLs, the least recently used entries are evicted.
+# New entries and access times are written in short batched transactions, so concurrent runs sharing the
+# cache never wait on a write lock held between two lookups.
+
+import os
+import json
+import time
+import sqlite3
+
+CACHE_FNAME = os.environ.get('MVAPI_IOC_CACHE', os.path.join(os.path.expanduser('~'), '.mvapi', 'iocs.sqlite'))
+
+POSITIVE_TTL = 24 * 3600
+NEGATIVE_TTL = 3600
+MAX_ENTRIES = 100000
+
+# buffered writes are flushed once there are this many or the oldest is this many seconds old
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 5.0
+
+
+class IOCCache():
+    def __init__(self, fname=CACHE_FNAME, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_entries=MAX_ENTRIES):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+
+        # rows of put() and access times of cache hits not written yet
+        self.pending = {}
+        self.touched = {}
+        self.buffered_at = None
+
+        if fname != ':memory:':
+            os.makedirs(os.path.dirname(fname) or '.', mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(fname, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS iocs ('
+                        'hash TEXT PRIMARY KEY, type TEXT, found INTEGER, ioc TEXT, '
+                        'expires_at REAL, accessed_at REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS iocs_accessed_at ON iocs (accessed_at)')
+        self.db.commit()
+
+    def get(self, hash):
+        """Return (found, ioc) for a cached hash or None if it is unknown or expired."""
+        now = time.time()
+        if hash in self.pending:
+            row = self.pending[hash][2:5]
+        else:
+            row = self.db.execute('SELECT found, ioc, expires_at FROM iocs WHERE hash = ?', (hash,)).fetchone()
+        if row is None or row[2] < now:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.touched[hash] = now
+        self.buffer(now)
+        return bool(row[0]), json.loads(row[1]) if row[1] else None
+
+    def put(self, hash, type, ioc):
+        now = time.time()
+        ttl = self.positive_ttl if ioc is not None else self.negative_ttl
+        self.pending[hash] = (hash, type, int(ioc is not None), json.dumps(ioc) if ioc is not None else None,
+                              now + ttl, now)
+        self.touched.pop(hash, None)
+        self.writes += 1
+        self.buffer(now)
+
+    def buffer(self, now):
+        if self.buffered_at is None:
+            self.buffered_at = now
+        if len(self.pending) + len(self.touched) >= FLUSH_SIZE or now - self.buffered_at >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered entries and access times in one transaction."""
+        if self.pending or self.touched:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO iocs VALUES (?, ?, ?, ?, ?, ?)', self.pending.values())
+                self.db.executemany('UPDATE iocs SET accessed_at = ? WHERE hash = ?',
+                                    [(accessed_at, hash) for hash, accessed_at in self.touched.items()])
+                if self.writes - self.evicted >= 1000:
+                    self.evict()
+        self.pending.clear()
+        self.touched.clear()
+        self.buffered_at = None
+
+    def evict(self):
+        count = self.db.execute('SELECT COUNT(*) FROM iocs').fetchone()[0]
+        if count > self.max_entries:
+            self.db.execute('DELETE FROM iocs WHERE hash IN '
+                            '(SELECT hash FROM iocs ORDER BY accessed_at LIMIT ?)', (count - self.max_entries,))
+        self.evicted = self.writes
+
+    def close(self):
+        self.flush()
+        with self.db:
+            self.evict()
+        self.db.close()
+
+    def stats(self):
+        return 'Cache hits: {0}, misses: {1}'.format(self.hits, self.misses)
@@ -0,0 +1,147 @@
+# Streaming export of MVISION Insights IOCs as block lists
+# IOCs are de-duplicated with a set of 64-bit fingerprints in a flat array (16 to 32 bytes per IOC) and
+# written as soon as they arrive, so exports of millions of IOCs do not keep the IOCs themselves in memory.
+
+import csv
+import json
+import uuid
+
+from array import array
+from datetime import datetime, timezone
+
+FORMATS = ['plain', 'csv', 'stix']
+
+# STIX 2.1 patterns per Insights IOC type
+PATTERNS = {
+    'md5': "[file:hashes.'MD5' = '{0}']",
+    'sha1': "[file:hashes.'SHA-1' = '{0}']",
+    'sha256': "[file:hashes.'SHA-256' = '{0}']",
+    'ip': "[ipv4-addr:value = '{0}']",
+    'ipv4': "[ipv4-addr:value = '{0}']",
+    'ipv6': "[ipv6-addr:value = '{0}']",
+    'domain': "[domain-name:value = '{0}']",
+    'url': "[url:value = '{0}']"
+}
+
+# namespace of the deterministic STIX indicator ids, the same IOC always gets the same id
+STIX_NAMESPACE = uuid.UUID('6b3c2a4e-8f53-4d1e-9a4c-2f0b7d1c5e90')
+
+
+class FingerprintSet():
+    """
+    Set of strings kept as 64-bit fingerprints in an open addressing table. The table doubles at 50% load,
+    so it holds between 25% and 50% of its 8 byte slots, i.e. 16 to 32 bytes per fingerprint.
+    Two different IOCs share a fingerprint with a probability of about n^2 / 2^65, i.e. practically never.
+    """
+    def __init__(self, capacity=1 << 16):
+        self.slots = array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.count = 0
+
+    @staticmethod
+    def fingerprint(value):
+        # the 64-bit SipHash of str, only compared within one process; 0 marks an empty slot
+        return hash(value) & 0xFFFFFFFFFFFFFFFF or 1
+
+    def insert(self, fingerprint):
+        slots = self.slots
+        mask = self.mask
+        i = fingerprint & mask
+        while slots[i]:
+            if slots[i] == fingerprint:
+                return False
+            i = (i + 1) & mask
+        slots[i] = fingerprint
+        return True
+
+    def add(self, value):
+        """Add value and return True, or False if it was already in the set."""
+        if not self.insert(self.fingerprint(value)):
+            return False
+
+        self.count += 1
+        if self.count * 2 > len(self.slots):
+            old = self.slots
+            self.slots = array('Q', bytes(16 * len(old)))
+            self.mask = len(self.slots) - 1
+            for fingerprint in old:
+                if fingerprint:
+                    self.insert(fingerprint)
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        return self.slots.itemsize * len(self.slots)
+
+
+class PlainWriter():
+    def __init__(self, fh):
+        self.fh = fh
+
+    def write(self, ioc, campaign_id):
+        self.fh.write(ioc['attributes']['value'] + '\n')
+
+    def close(self):
+        self.fh.flush()
+
+
+class CSVWriter():
+    def __init__(self, fh):
+        self.fh = fh
+        self.writer = csv.writer(fh)
+        self.writer.writerow(['type', 'value', 'category', 'campaign_id'])
+
+    def write(self, ioc, campaign_id):
+        attributes = ioc['attributes']
+        self.writer.writerow([attributes.get('type'), attributes['value'], attributes.get('category'), campaign_id])
+
+    def close(self):
+        self.fh.flush()
+
+
+class STIXWriter():
+    """STIX 2.1 bundle of indicators, written object by object."""
+    def __init__(self, fh):
+        self.fh = fh
+        self.now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        self.first = True
+        self.fh.write('{{"type": "bundle", "id": "bundle--{0}", "objects": [\n'.format(uuid.uuid4()))
+
+    def write(self, ioc, campaign_id):
+        attributes = ioc['attributes']
+        type = (attributes.get('type') or '').lower()
+        value = attributes['value']
+        pattern = PATTERNS.get(type, "[x-mvision-ioc:value = '{0}']").format(value.replace("'", "\\'"))
+
+        indicator = {
+            'type': 'indicator',
+            'spec_version': '2.1',
+            'id': 'indicator--{0}'.format(uuid.uuid5(STIX_NAMESPACE, '{0}:{1}'.format(type, value))),
+            'created': self.now,
+            'modified': self.now,
+            'name': value,
+            'indicator_types': ['malicious-activity'],
+            'pattern': pattern,
+            'pattern_type': 'stix',
+            'valid_from': self.now,
+            'labels': [label for label in (attributes.get('category'), 'campaign-{0}'.format(campaign_id)) if label]
+        }
+        self.fh.write(('' if self.first else ',\n') + json.dumps(indicator))
+        self.first = False
+
+    def close(self):
+        self.fh.write('\n]}\n')
+        self.fh.flush()
+
+
+WRITERS = {
+    'plain': PlainWriter,
+    'csv': CSVWriter,
+    'stix': STIXWriter
+}
+
+
+def open_writer(format, fh):
+    return WRITERS[format](fh)
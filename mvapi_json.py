@@ -0,0 +1,35 @@
+# JSON encoding helpers for the mvapi_* scripts
+# Uses orjson when it is installed (set MVAPI_JSON=stdlib to force the standard library).
+# dumps() always returns UTF-8 bytes so encoded records can be written to files and sockets as is.
+
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if os.environ.get('MVAPI_JSON') == 'stdlib':
+    orjson = None
+
+FAST = orjson is not None
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def dumps_lines(records):
+    """Encode records as one NDJSON bytes block."""
+    if orjson is not None:
+        return b''.join(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE) for record in records)
+    return ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records).encode()
@@ -0,0 +1,292 @@
+# Metrics and profiling for the mvapi_* scripts
+# Every API request, retry and pipeline stage is recorded in one in-process registry: counters, gauges
+# and latency histograms per endpoint. The registry can be served as Prometheus text, appended to a file
+# as periodic JSON snapshots and a single run can be captured with cProfile, all set up from the environment:
+#   MVAPI_METRICS_PORT=9464          serve /metrics (Prometheus text) and /metrics.json on 127.0.0.1
+#   MVAPI_METRICS_FILE=metrics.json  append a JSON snapshot every MVAPI_METRICS_INTERVAL seconds (default 60)
+#   MVAPI_CPROFILE=run.prof          profile the main thread and log the top functions at exit
+
+import os
+import re
+import json
+import time
+import atexit
+import logging
+import threading
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    'mvapi_http_requests_total': ('counter', 'API requests by endpoint and HTTP status (0: connection error)'),
+    'mvapi_http_request_seconds': ('histogram', 'API request latency including the response body'),
+    'mvapi_http_sent_bytes_total': ('counter', 'Request body bytes sent'),
+    'mvapi_http_received_bytes_total': ('counter', 'Response body bytes received'),
+    'mvapi_http_retries_total': ('counter', 'Retried API requests by endpoint and HTTP status'),
+    'mvapi_events_total': ('counter', 'MVISION EPO events per pipeline stage'),
+    'mvapi_stage_seconds_total': ('counter', 'Time spent per pipeline stage'),
+    'mvapi_queue_depth': ('gauge', 'Items waiting in a pipeline queue'),
+    'mvapi_sink_records_total': ('counter', 'Records delivered by output sinks'),
+    'mvapi_sink_failures_total': ('counter', 'Failed sink deliveries, including retried ones')
+}
+
+# path segments that are resource ids rather than part of the endpoint
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F-]{16,}|[0-9a-fA-F]{8}-[0-9a-fA-F-]+)$')
+
+_started = False
+_lock = threading.Lock()
+
+
+def endpoint(url):
+    """Endpoint of a request URL with ids replaced, e.g. /epo/v2/devices/{id}/assignedTags."""
+    return template(url.split('?', 1)[0].split('//', 1)[-1].partition('/')[2])
+
+
+@lru_cache(maxsize=1024)
+def template(path):
+    return '/' + '/'.join('{id}' if ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.record(key, value)
+
+    def record(self, key, value):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            # one count per bucket plus +Inf, then sum and count
+            histogram = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """Add the time spent in the block to mvapi_stage_seconds_total{stage=name}."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.inc('mvapi_stage_seconds_total', time.perf_counter() - start, stage=name, **labels)
+
+    def request(self, family, method, url, status, seconds, sent=0, received=0):
+        # called for every request: label tuples are built in sorted order and updated under one lock
+        labels = (('endpoint', endpoint(url)), ('family', family))
+        counters = self.counters
+        with self.lock:
+            key = ('mvapi_http_requests_total', labels + (('method', method), ('status', str(status))))
+            counters[key] = counters.get(key, 0) + 1
+            self.record(('mvapi_http_request_seconds', labels), seconds)
+            if sent:
+                key = ('mvapi_http_sent_bytes_total', labels)
+                counters[key] = counters.get(key, 0) + sent
+            if received:
+                key = ('mvapi_http_received_bytes_total', labels)
+                counters[key] = counters.get(key, 0) + received
+
+    def retry(self, family, url, status):
+        self.inc('mvapi_http_retries_total', family=family, endpoint=endpoint(url), status=str(status))
+
+    def prometheus(self):
+        """Render the registry in the Prometheus text exposition format."""
+        def render(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, value in labels) + '}'
+
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+
+        series = {}
+        for (name, labels), value in sorted(counters.items()):
+            series.setdefault(name, []).append('{0}{1} {2}'.format(name, render(labels), value))
+        for (name, labels), value in sorted(gauges.items()):
+            series.setdefault(name, []).append('{0}{1} {2}'.format(name, render(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(name, render(labels, (('le', bound),)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(name, render(labels), histogram[-2]))
+            lines.append('{0}_count{1} {2}'.format(name, render(labels), histogram[-1]))
+
+        out = []
+        for name in sorted(series):
+            type, help = HELP.get(name, ('untyped', name))
+            out.append('# HELP {0} {1}'.format(name, help))
+            out.append('# TYPE {0} {1}'.format(name, type))
+            out.extend(series[name])
+        return '\n'.join(out) + '\n'
+
+    def snapshot(self):
+        """JSON-friendly view: counters, gauges, latency percentiles and events/sec since the start."""
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+
+        uptime = time.time() - self.started
+
+        def entries(items):
+            return [dict(labels, name=name, value=value) for (name, labels), value in sorted(items.items())]
+
+        latency = []
+        for (name, labels), histogram in sorted(histograms.items()):
+            entry = dict(labels, name=name, count=histogram[-1],
+                         mean=histogram[-2] / histogram[-1] if histogram[-1] else 0.0)
+            for pct in (50, 90, 99):
+                entry['p{0}'.format(pct)] = quantile(histogram, pct / 100.0)
+            latency.append(entry)
+
+        rates = {}
+        for (name, labels), value in counters.items():
+            if name == 'mvapi_events_total' and uptime:
+                stage = '/'.join(str(label) for key, label in labels)
+                rates[stage] = rates.get(stage, 0) + value / uptime
+
+        return {
+            'timestamp': time.time(),
+            'uptime_seconds': uptime,
+            'counters': entries(counters),
+            'gauges': entries(gauges),
+            'latency': latency,
+            'events_per_sec': rates
+        }
+
+
+def quantile(histogram, q):
+    """Estimate a quantile from the bucket counts, interpolating linearly inside the bucket."""
+    total = histogram[-1]
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    lower = 0.0
+    for bound, count in zip(BUCKETS, histogram):
+        if seen + count >= rank and count:
+            return lower + (bound - lower) * (rank - seen) / count
+        seen += count
+        lower = bound
+    return BUCKETS[-1]
+
+
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = metrics.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] == '/metrics.json':
+            body = json.dumps(metrics.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve /metrics and /metrics.json from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_snapshot(fname):
+    with open(fname, 'a') as fh:
+        fh.write(json.dumps(metrics.snapshot()) + '\n')
+
+
+def report(fname, interval=60):
+    """Append a JSON snapshot to fname every interval seconds and once more at exit."""
+    def run():
+        while True:
+            time.sleep(interval)
+            write_snapshot(fname)
+
+    threading.Thread(target=run, daemon=True).start()
+    atexit.register(write_snapshot, fname)
+
+
+def profile(fname, top=20):
+    """Profile the calling thread until the process exits, then save the stats and log the top functions."""
+    import io
+    import pstats
+    import cProfile
+
+    profiler = cProfile.Profile()
+
+    def stop():
+        profiler.disable()
+        profiler.dump_stats(fname)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        logging.getLogger('logs').info('cProfile stats saved to {0}.\n{1}'.format(fname, out.getvalue()))
+
+    atexit.register(stop)
+    profiler.enable()
+
+
+def start():
+    """Start the exporters configured in the environment, once per process."""
+    global _started
+    with _lock:
+        if _started:
+            return
+        _started = True
+
+    logger = logging.getLogger('logs')
+    if os.environ.get('MVAPI_METRICS_PORT'):
+        try:
+            serve(int(os.environ['MVAPI_METRICS_PORT']))
+        except (OSError, ValueError) as error:
+            logger.error('Could not serve metrics on port {0}: {1}'.format(os.environ['MVAPI_METRICS_PORT'], error))
+
+    if os.environ.get('MVAPI_METRICS_FILE'):
+        report(os.environ['MVAPI_METRICS_FILE'], float(os.environ.get('MVAPI_METRICS_INTERVAL') or 60))
+
+    if os.environ.get('MVAPI_CPROFILE'):
+        profile(os.environ['MVAPI_CPROFILE'])
@@ -0,0 +1,228 @@
+# Rate-limit-aware request scheduling for the MVISION API
+# One token bucket and one adaptive (AIMD) concurrency limit per endpoint family (epo, insights, iam).
+# The bucket rate grows additively with successful responses up to a ceiling and halves on throttling.
+# 429 and 5xx responses are retried with Retry-After or jittered exponential backoff.
+
+import time
+import random
+import threading
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# initial requests per second, burst size, maximum concurrency and ceiling of the request rate per endpoint
+# family; <family>_rate and <family>_max_rate of a profile (or MVAPI_<FAMILY>_RATE / _MAX_RATE) override them
+LIMITS = {
+    'iam': (2, 5, 4, 2),
+    'epo': (20, 40, 32, 200),
+    'insights': (20, 40, 32, 200)
+}
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+
+def family(url):
+    parsed = urlparse(url)
+    if parsed.hostname and parsed.hostname.startswith('iam.') or parsed.path.startswith('/iam/'):
+        return 'iam'
+    if parsed.path.startswith('/insights/'):
+        return 'insights'
+    return 'epo'
+
+
+def retry_after(headers, attempt):
+    """Seconds to wait before the next attempt: Retry-After / rate-limit reset headers or jittered backoff."""
+    value = headers.get('Retry-After')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    reset = headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset')
+    if reset:
+        try:
+            reset = float(reset)
+            # epoch timestamp or delta seconds
+            return max(0.0, reset - time.time() if reset > 1e9 else reset)
+        except ValueError:
+            pass
+
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def limits(overrides=None):
+    """LIMITS with the (rate, max_rate) overrides of a profile, either may be None."""
+    merged = dict(LIMITS)
+    for name, (rate, max_rate) in (overrides or {}).items():
+        default_rate, burst, concurrency, default_max = LIMITS[name]
+        rate = rate or default_rate
+        max_rate = max_rate or max(default_max, rate)
+        merged[name] = (min(rate, max_rate), burst, concurrency, max_rate)
+    return merged
+
+
+class TokenBucket():
+    """
+    Token bucket whose rate grows by the initial rate per second of successful requests up to max_rate,
+    halves when the API throttles and never drops below one request per second (or the initial rate).
+    """
+    def __init__(self, rate, burst, max_rate=None):
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.configure(rate, max_rate)
+
+    def configure(self, rate, max_rate=None):
+        with self.lock:
+            self.initial = self.rate = float(rate)
+            self.max_rate = float(max(max_rate or rate, rate))
+            self.min_rate = min(1.0, self.initial)
+
+    def grow(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.initial / self.rate)
+
+    def shrink(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def reserve(self):
+        """Take one token and return how long the caller has to wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AIMDLimiter():
+    """Concurrency limit that grows by one per window of successes and halves on throttling."""
+    def __init__(self, maximum, initial=4):
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+
+    def try_acquire(self):
+        with self.cond:
+            if self.inflight >= int(self.limit):
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.inflight -= 1
+            if throttled:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+
+class Scheduler():
+    def __init__(self, limits=None):
+        limits = limits or LIMITS
+        self.buckets = {name: TokenBucket(rate, burst, max_rate)
+                        for name, (rate, burst, _, max_rate) in limits.items()}
+        self.limiters = {name: AIMDLimiter(concurrency) for name, (_, _, concurrency, _) in limits.items()}
+        self.retries = 0
+        self.overrides = {}
+
+    def configure(self, overrides):
+        """Apply the rate overrides of a profile; the adapted rates are kept while they stay the same."""
+        if not overrides or overrides == self.overrides:
+            return
+        for name, (rate, burst, _, max_rate) in limits(overrides).items():
+            if name in overrides:
+                self.buckets[name].configure(rate, max_rate)
+        self.overrides = dict(overrides)
+
+    def acquire(self, name):
+        self.limiters[name].acquire()
+        wait = self.buckets[name].reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, name):
+        # only the asyncio client gets here, asyncio stays out of the CLI start-up
+        import asyncio
+
+        while not self.limiters[name].try_acquire():
+            await asyncio.sleep(0.01)
+        wait = self.buckets[name].reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def release(self, name, status, headers):
+        # 0 stands for a connection error
+        self.limiters[name].release(throttled=status in (0, 429, 503))
+
+        exhausted = headers.get('X-RateLimit-Remaining') == '0' or headers.get('RateLimit-Remaining') == '0'
+        if exhausted:
+            self.buckets[name].pause(retry_after(headers, 0))
+        if exhausted or status in (429, 503):
+            self.buckets[name].shrink()
+        elif 200 <= status < 400:
+            self.buckets[name].grow()
+
+    def should_retry(self, method, url, status, attempt):
+        if attempt >= MAX_RETRIES or status not in RETRY_STATUS + (0,):
+            return False
+        # a 5xx on a POST may have been applied, only repeat it for the token endpoint
+        return status == 429 or method in IDEMPOTENT_METHODS or family(url) == 'iam'
+
+    def backoff(self, name, status, headers, attempt):
+        """Return the delay before the next attempt; a 429 holds back the whole endpoint family."""
+        delay = retry_after(headers, attempt)
+        if status == 429:
+            self.buckets[name].pause(delay)
+        self.retries += 1
+        return delay
+
+
+# process wide scheduler shared by all clients, so parallel workers respect the same limits
+scheduler = Scheduler()
+
+# further tenants get their own limits, a busy tenant does not use up the budget of another
+_schedulers = {}
+_lock = threading.Lock()
+
+
+def for_profile(name, overrides=None):
+    """
+    Return the scheduler of a tenant profile with its rate overrides applied; the default profile
+    uses the module scheduler.
+    """
+    with _lock:
+        if name == 'default':
+            selected = scheduler
+        else:
+            if name not in _schedulers:
+                _schedulers[name] = Scheduler(limits(overrides))
+            selected = _schedulers[name]
+        selected.configure(overrides)
+        return selected
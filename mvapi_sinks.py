@@ -0,0 +1,279 @@
+# Batched output sinks for MVISION EPO events
+# Every sink owns a bounded queue and a sender thread. Producers block when the queue is full
+# (backpressure), records are sent in batches and each submitted page is acknowledged only after
+# the batch holding it has been delivered, so the event checkpoint never runs ahead of the output.
+
+import os
+import ssl
+import gzip
+import time
+import queue
+import socket
+import logging
+import threading
+import requests
+
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+
+from mvapi_json import dumps, dumps_lines
+from mvapi_metrics import metrics
+
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+QUEUE_SIZE = 8
+MAX_RETRIES = 5
+
+
+class SinkError(Exception):
+    pass
+
+
+class Sink():
+    def __init__(self, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.logger = logging.getLogger('logs')
+        self.error = None
+        self.delivered = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, records, ack=None):
+        """Queue records for delivery, blocking while the queue is full; ack(records) runs once delivered."""
+        if self.error:
+            raise self.error
+        self.queue.put((records, ack))
+        metrics.set('mvapi_queue_depth', self.queue.qsize(), queue=type(self).__name__)
+
+    def flush(self):
+        """Block until everything submitted so far has been delivered or failed."""
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.shutdown()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        batch = []
+        acks = []
+        deadline = None
+        while True:
+            try:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # flush interval of a partial batch expired
+                item = False
+
+            if item:
+                batch.extend(item[0])
+                acks.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (not item or len(batch) >= self.batch_size):
+                self.deliver(batch, acks)
+                # pages are marked done only once their batch is out, so flush() waits for delivery
+                for _ in acks:
+                    self.queue.task_done()
+                batch = []
+                acks = []
+                deadline = None
+
+            if item is None:
+                self.queue.task_done()
+                return
+
+    def deliver(self, batch, acks):
+        if self.error:
+            return
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                with metrics.stage('sink_send', sink=type(self).__name__):
+                    self.send(batch)
+                break
+            except Exception as error:
+                metrics.inc('mvapi_sink_failures_total', sink=type(self).__name__)
+                if attempt == MAX_RETRIES:
+                    self.error = SinkError('{0} failed to deliver {1} records: {2}'
+                                           .format(type(self).__name__, len(batch), str(error)))
+                    self.logger.error(str(self.error))
+                    return
+                delay = min(30, 0.5 * 2 ** attempt)
+                self.logger.warning('{0} delivery failed: {1}. Retry {2} in {3:.1f}s.'
+                                    .format(type(self).__name__, str(error), attempt + 1, delay))
+                time.sleep(delay)
+
+        self.delivered += len(batch)
+        metrics.inc('mvapi_sink_records_total', len(batch), sink=type(self).__name__)
+        metrics.set('mvapi_queue_depth', self.queue.qsize(), queue=type(self).__name__)
+        for records, ack in acks:
+            if ack:
+                ack(records)
+
+    def send(self, batch):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class FileSink(Sink):
+    """NDJSON file, rotated at rotate_bytes into path.1.gz ... path.<backups>.gz."""
+    def __init__(self, path, rotate_bytes=100 * 1024 * 1024, backups=5, **kwargs):
+        self.path = path
+        self.rotate_bytes = rotate_bytes
+        self.backups = backups
+        self.fh = open(path, 'ab')
+        super().__init__(**kwargs)
+
+    def send(self, batch):
+        self.fh.write(dumps_lines(batch))
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        if self.rotate_bytes and self.fh.tell() >= self.rotate_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.fh.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists('{0}.{1}.gz'.format(self.path, index)):
+                os.replace('{0}.{1}.gz'.format(self.path, index), '{0}.{1}.gz'.format(self.path, index + 1))
+        with open(self.path, 'rb') as src, gzip.open(self.path + '.1.gz', 'wb') as dst:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        self.fh = open(self.path, 'wb')
+
+    def shutdown(self):
+        self.fh.close()
+
+
+class SyslogSink(Sink):
+    """RFC 5424 messages over TCP or TLS with RFC 6587 octet-counting framing."""
+    def __init__(self, host, port=514, tls=False, app_name='mvapi', verify=True, **kwargs):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.verify = verify
+        self.app_name = app_name
+        self.hostname = socket.gethostname()
+        self.sock = None
+        super().__init__(**kwargs)
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=30)
+        if self.tls:
+            context = ssl.create_default_context()
+            if not self.verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock, server_hostname=self.host)
+        self.sock = sock
+
+    def frame(self, record):
+        # facility local0, severity informational
+        timestamp = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        message = '<134>1 {0} {1} {2} - - - '.format(timestamp, self.hostname, self.app_name).encode() + dumps(record)
+        return str(len(message)).encode() + b' ' + message
+
+    def send(self, batch):
+        if self.sock is None:
+            self.connect()
+        try:
+            self.sock.sendall(b''.join(self.frame(record) for record in batch))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def shutdown(self):
+        if self.sock:
+            self.sock.close()
+
+
+class HTTPSink(Sink):
+    """
+    gzip compressed bulk POST. format 'hec' sends Splunk HEC event objects, 'elastic' an Elasticsearch
+    _bulk body for index, 'kafka' a Kafka REST proxy (Confluent / Redpanda) produce request for a topic.
+    """
+    def __init__(self, url, format='hec', token=None, index=None, verify=True, **kwargs):
+        self.url = url
+        self.format = format
+        self.index = index
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers['Content-Encoding'] = 'gzip'
+
+        if format == 'hec':
+            self.session.headers['Content-Type'] = 'application/json'
+            if token:
+                self.session.headers['Authorization'] = 'Splunk ' + token
+        elif format == 'elastic':
+            self.session.headers['Content-Type'] = 'application/x-ndjson'
+            if token:
+                self.session.headers['Authorization'] = 'ApiKey ' + token
+        else:
+            self.session.headers['Content-Type'] = 'application/vnd.kafka.json.v2+json'
+            if token:
+                self.session.headers['Authorization'] = 'Bearer ' + token
+        super().__init__(**kwargs)
+
+    def body(self, batch):
+        if self.format == 'hec':
+            return b''.join(dumps({'event': record, 'sourcetype': 'mvision:epo:event'}) for record in batch)
+        if self.format == 'elastic':
+            action = dumps({'index': {'_index': self.index}} if self.index else {'index': {}}) + b'\n'
+            return b''.join(action + dumps(record) + b'\n' for record in batch)
+        return dumps({'records': [{'key': record.get('id'), 'value': record} for record in batch]})
+
+    def send(self, batch):
+        res = self.session.post(self.url, data=gzip.compress(self.body(batch), compresslevel=5),
+                                timeout=60)
+        if not res.ok:
+            raise SinkError('HTTP {0} - {1}'.format(res.status_code, res.text[:200]))
+        if self.format == 'elastic' and res.json().get('errors'):
+            raise SinkError('Elasticsearch bulk request reported item errors.')
+
+    def shutdown(self):
+        self.session.close()
+
+
+def open_sink(spec, token=None, **kwargs):
+    """
+    Create a sink from a URL style spec:
+      file:///var/log/epo.ndjson?rotate=104857600&backups=5
+      syslog://host:514, syslog+tls://host:6514
+      hec+https://splunk:8088/services/collector
+      elastic+https://elastic:9200/_bulk?index=epo-events
+      kafka+http://restproxy:8082/topics/epo-events
+    """
+    url = urlparse(spec)
+    options = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    scheme = url.scheme.split('+')
+
+    if url.scheme == 'file' or not url.scheme:
+        return FileSink(url.path or spec, rotate_bytes=int(options.get('rotate', 100 * 1024 * 1024)),
+                        backups=int(options.get('backups', 5)), **kwargs)
+
+    if scheme[0] == 'syslog':
+        return SyslogSink(url.hostname, url.port or (6514 if 'tls' in scheme else 514), tls='tls' in scheme,
+                          verify=options.get('verify', 'true') != 'false', **kwargs)
+
+    if scheme[0] in ('hec', 'elastic', 'kafka') and len(scheme) == 2:
+        target = '{0}://{1}{2}'.format(scheme[1], url.netloc, url.path)
+        return HTTPSink(target, format=scheme[0], token=token, index=options.get('index'),
+                        verify=options.get('verify', 'true') != 'false', **kwargs)
+
+    raise SinkError('Unsupported sink: {0}'.format(spec))
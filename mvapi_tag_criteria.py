@@ -0,0 +1,235 @@
+# Local dry run of MVISION EPO tag criteria
+# Parses the criteria expression of a tag, e.g. ( where ( eq EPOComputerProperties.OSPlatform "Server" ) ),
+# and evaluates it column by column over the device index. Every predicate yields a bitmask with one bit
+# per device, so and / or / not are single integer operations however many devices are indexed.
+
+import re
+
+TOKENS = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+BITS = bytes.maketrans(b'\x00\x01', b'01')
+
+# ePO properties whose device attribute is not simply the property name
+ALIASES = {
+    'EPOLeafNode.NodeName': 'name',
+    'EPOLeafNode.Tags': 'tags',
+    'EPOLeafNode.LastUpdate': 'lastUpdate',
+    'EPOLeafNode.AgentGUID': 'agentGuid',
+    'EPOLeafNode.AgentVersion': 'agentVersion'
+}
+
+COMPARE = {
+    'eq': (lambda a, b: a == b, '{0} = {1}'),
+    'ne': (lambda a, b: a != b, '{0} <> {1}'),
+    'gt': (lambda a, b: a > b, '{0} > {1}'),
+    'ge': (lambda a, b: a >= b, '{0} >= {1}'),
+    'lt': (lambda a, b: a < b, '{0} < {1}'),
+    'le': (lambda a, b: a <= b, '{0} <= {1}'),
+    'contains': (lambda a, b: b in a, "{0} LIKE '%{2}%'"),
+    'doesNotContain': (lambda a, b: b not in a, "{0} NOT LIKE '%{2}%'"),
+    'startsWith': (lambda a, b: a.startswith(b), "{0} LIKE '{2}%'"),
+    'endsWith': (lambda a, b: a.endswith(b), "{0} LIKE '%{2}'")
+}
+
+BLANK = {
+    'isBlank': (True, "( {0} IS NULL OR {0} = '' )"),
+    'isNotBlank': (False, "( {0} IS NOT NULL AND {0} <> '' )")
+}
+
+
+class CriteriaError(Exception):
+    pass
+
+
+class Field(str):
+    """Property reference such as EPOComputerProperties.OSPlatform, as opposed to a literal."""
+    pass
+
+
+def parse(criteria):
+    """Parse a criteria expression into nested lists: ['where', ['eq', Field(...), 'Server']]."""
+    stack = [[]]
+    for token in TOKENS.findall(criteria):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                raise CriteriaError('Unbalanced ) in criteria: {0}'.format(criteria))
+            node = stack.pop()
+            stack[-1].append(node)
+        elif token.startswith('"'):
+            stack[-1].append(re.sub(r'\\(.)', r'\1', token[1:-1]))
+        elif '.' in token and not re.match(r'^-?\d+(\.\d+)?$', token):
+            stack[-1].append(Field(token))
+        else:
+            stack[-1].append(token)
+
+    if len(stack) != 1 or len(stack[0]) != 1 or not isinstance(stack[0][0], list):
+        raise CriteriaError('Criteria must be a single parenthesized expression: {0}'.format(criteria))
+
+    tree = stack[0][0]
+    if tree and tree[0] == 'where':
+        if len(tree) != 2:
+            raise CriteriaError('where takes exactly one condition: {0}'.format(criteria))
+        tree = tree[1]
+    check(tree)
+    return tree
+
+
+def check(node):
+    if not isinstance(node, list) or not node:
+        raise CriteriaError('Expected a condition, got {0}'.format(node))
+
+    op = node[0]
+    if op in ('and', 'or'):
+        if len(node) < 2:
+            raise CriteriaError('{0} needs at least one condition'.format(op))
+        for child in node[1:]:
+            check(child)
+    elif op == 'not':
+        if len(node) != 2:
+            raise CriteriaError('not takes exactly one condition')
+        check(node[1])
+    elif op in COMPARE:
+        if len(node) != 3 or not isinstance(node[1], Field) or isinstance(node[2], (list, Field)):
+            raise CriteriaError('{0} takes a property and a value'.format(op))
+    elif op in BLANK:
+        if len(node) != 2 or not isinstance(node[1], Field):
+            raise CriteriaError('{0} takes a property'.format(op))
+    else:
+        raise CriteriaError('Unsupported operator {0}'.format(op))
+
+
+def fields(node):
+    """All properties referenced by a parsed expression."""
+    if isinstance(node, Field):
+        return {str(node)}
+    if isinstance(node, list):
+        return set().union(*(fields(child) for child in node[1:])) if len(node) > 1 else set()
+    return set()
+
+
+def resolve(field, keys):
+    """Map an ePO property to a device attribute: alias table, then the property name ignoring case."""
+    if field in ALIASES:
+        return ALIASES[field]
+    lookup = {key.lower(): key for key in keys}
+    name = field.split('.')[-1].lower()
+    if name not in lookup:
+        raise CriteriaError('Unknown device property {0}. Indexed attributes: {1}'
+                            .format(field, ', '.join(sorted(keys))))
+    return lookup[name]
+
+
+def where_clause(node):
+    """Render a parsed expression as the whereClause stored with the tag."""
+    def render(node):
+        op = node[0]
+        if op in ('and', 'or'):
+            return '( {0} )'.format(' {0} '.format(op).join(render(child) for child in node[1:]))
+        if op == 'not':
+            return 'not {0}'.format(render(node[1]))
+
+        column = '[{0}].[{1}]'.format(*node[1].rsplit('.', 1))
+        if op in BLANK:
+            return BLANK[op][1].format(column)
+
+        value = node[2]
+        literal = value if re.match(r'^-?\d+(\.\d+)?$', value) else "'{0}'".format(value.replace("'", "''"))
+        return COMPARE[op][1].format(column, literal, value.replace("'", "''"))
+
+    if node[0] in ('and', 'or'):
+        return 'where ( {0} )'.format(' {0} '.format(node[0]).join(render(child) for child in node[1:]))
+    return 'where ( {0} )'.format(render(node))
+
+
+def mask(flags):
+    """Pack one bool per device into an integer, bit i standing for device i."""
+    flags = bytes(flags)
+    return int(flags[::-1].translate(BITS), 2) if flags else 0
+
+
+def rows(bits):
+    return [i for i, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+
+class Evaluator():
+    """
+    Evaluate parsed criteria over device columns: ids plus one list of values per attribute.
+    String comparisons ignore case like ePO, numeric literals compare numerically and missing
+    values never match a comparison.
+    """
+    def __init__(self, ids, columns):
+        self.ids = ids
+        self.columns = columns
+        self.count = len(ids)
+        self.all = (1 << self.count) - 1
+        self.prepared = {}
+
+    def column(self, key, numeric):
+        if (key, numeric) not in self.prepared:
+            values = self.columns[key]
+            if numeric:
+                self.prepared[key, numeric] = [to_number(value) for value in values]
+            else:
+                self.prepared[key, numeric] = [None if value is None else str(value).lower() for value in values]
+        return self.prepared[key, numeric]
+
+    def evaluate(self, node, keys):
+        op = node[0]
+        if op == 'and':
+            bits = self.all
+            for child in node[1:]:
+                bits &= self.evaluate(child, keys)
+            return bits
+        if op == 'or':
+            bits = 0
+            for child in node[1:]:
+                bits |= self.evaluate(child, keys)
+            return bits
+        if op == 'not':
+            return self.all ^ self.evaluate(node[1], keys)
+
+        key = keys[node[1]]
+        if op in BLANK:
+            blank = BLANK[op][0]
+            return mask((value is None or value == '') == blank for value in self.columns[key])
+
+        compare = COMPARE[op][0]
+        number = to_number(node[2]) if op in ('eq', 'ne', 'gt', 'ge', 'lt', 'le') else None
+        if number is not None:
+            return mask(value is not None and compare(value, number) for value in self.column(key, True))
+
+        literal = node[2].lower()
+        return mask(value is not None and compare(value, literal) for value in self.column(key, False))
+
+    def matches(self, tree, keys):
+        """Return the indexes of the matching devices."""
+        return rows(self.evaluate(tree, keys))
+
+
+def to_number(value):
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def dry_run(index, criteria):
+    """
+    Evaluate criteria against a DeviceIndex. Returns the matching devices as (id, name) tuples,
+    the number of indexed devices and the attribute each property was resolved to.
+    """
+    tree = parse(criteria)
+    available = index.keys()
+    if not available:
+        return [], 0, {}
+    keys = {field: resolve(field, available) for field in fields(tree)}
+
+    ids, names, columns = index.columns(sorted(set(keys.values())))
+    evaluator = Evaluator(ids, columns)
+    matches = [(ids[i], names[i]) for i in evaluator.matches(tree, keys)]
+    return matches, len(ids), keys
@@ -0,0 +1,139 @@
+# Shared IAM token cache for the MVISION API sample scripts
+# Tokens are stored per (client_id, scope set, IAM endpoint) in a file that is shared by all mvapi_* processes.
+
+import os
+import json
+import time
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from mvapi_config import IAM_URL
+
+CACHE_FNAME = os.environ.get('MVAPI_TOKEN_CACHE', os.path.join(os.path.expanduser('~'), '.mvapi', 'tokens.json'))
+
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 300
+
+
+class AuthError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__('{0} - {1}'.format(status_code, text))
+        self.status_code = status_code
+        self.text = text
+
+
+class TokenCache():
+    def __init__(self, fname=CACHE_FNAME, refresh_margin=REFRESH_MARGIN):
+        self.fname = fname
+        self.refresh_margin = refresh_margin
+
+    @staticmethod
+    def key(client_id, scope, iam_url=IAM_URL):
+        scopes = ' '.join(sorted(set(scope.split())))
+        return hashlib.sha256('{0}|{1}|{2}'.format(client_id, scopes, iam_url).encode()).hexdigest()
+
+    def _lock(self):
+        os.makedirs(os.path.dirname(self.fname) or '.', mode=0o700, exist_ok=True)
+        lock = open(self.fname + '.lock', 'a')
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _read(self):
+        try:
+            with open(self.fname, 'r') as cache:
+                return json.load(cache)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, tokens):
+        tmp_fname = self.fname + '.tmp'
+        fd = os.open(tmp_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache:
+            json.dump(tokens, cache)
+        os.replace(tmp_fname, self.fname)
+
+    def get_token(self, session, api_key, auth, scope, stale=None, iam_url=IAM_URL):
+        """
+        Return a valid access token for the credentials and scope, requesting a new one from IAM
+        only if there is no cached token, it expires within refresh_margin seconds or it is the
+        stale token that was just rejected. The file lock makes concurrent processes wait for a
+        single IAM round trip.
+        """
+        key = self.key(auth[0], scope, iam_url)
+        lock = self._lock()
+        try:
+            tokens = self._read()
+            token = tokens.get(key)
+            if token and token['access_token'] != stale and token['expires_at'] - self.refresh_margin > time.time():
+                return token['access_token']
+
+            headers = {
+                'x-api-key': api_key,
+                'Content-Type': 'application/vnd.api+json'
+            }
+
+            payload = {
+                "grant_type": "client_credentials",
+                "scope": scope
+            }
+
+            res = session.post(iam_url, headers=headers, auth=auth, data=payload)
+            if res.status_code != 200:
+                raise AuthError(res.status_code, res.text)
+
+            access_token = res.json()['access_token']
+            expires_in = int(res.json().get('expires_in', 3600))
+
+            now = time.time()
+            tokens = {k: v for k, v in tokens.items() if v['expires_at'] > now}
+            tokens[key] = {'access_token': access_token, 'expires_at': now + expires_in}
+            self._write(tokens)
+
+            return access_token
+        finally:
+            lock.close()
+
+
+def authenticate(session, api_key, auth, scope, cache=None, iam_url=IAM_URL):
+    """
+    Set the session headers with a cached or fresh bearer token and install a response hook that
+    refreshes the token in session.headers and replays the request once if the API answers with 401.
+    The hook is installed once per session, authenticating a reused session again only updates the
+    credentials it refreshes the token with.
+    """
+    cache = cache or TokenCache()
+    access_token = cache.get_token(session, api_key, auth, scope, iam_url=iam_url)
+
+    session.headers = {
+        'x-api-key': api_key,
+        'Content-Type': 'application/vnd.api+json',
+        'Authorization': 'Bearer ' + access_token
+    }
+    session.mvapi_credentials = (api_key, auth, scope, cache, iam_url)
+
+    def retry_on_401(res, **kwargs):
+        api_key, auth, scope, cache, iam_url = session.mvapi_credentials
+        if res.status_code != 401 or res.request.url.startswith(iam_url) \
+                or getattr(res.request, 'mvapi_retried', False):
+            return res
+
+        stale = session.headers['Authorization'][len('Bearer '):]
+        session.headers['Authorization'] = 'Bearer ' + cache.get_token(session, api_key, auth, scope, stale=stale,
+                                                                           iam_url=iam_url)
+
+        request = res.request.copy()
+        request.headers['Authorization'] = session.headers['Authorization']
+        request.mvapi_retried = True
+        res.content  # drain the 401 so the connection can be reused
+        res.close()
+        return res.connection.send(request, **kwargs)
+
+    if not getattr(session, 'mvapi_retry_on_401', None):
+        session.mvapi_retry_on_401 = retry_on_401
+        session.hooks['response'].append(retry_on_401)
+    return access_token
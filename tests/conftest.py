@@ -0,0 +1,33 @@
+# Shared fixtures: the scripts run against the offline mock server of bench/ with every local file in a temp dir
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TESTS_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'bench'))
+
+# read when the mvapi_* modules are imported
+STATE_DIR = tempfile.mkdtemp(prefix='mvapi-tests-')
+os.environ['MVAPI_CONFIG'] = os.path.join(STATE_DIR, 'config.ini')
+os.environ['MVAPI_TOKEN_CACHE'] = os.path.join(STATE_DIR, 'tokens.json')
+os.environ.pop('MVAPI_PROFILE', None)
+
+from mock_server import Dataset, MockServer
+
+
+@pytest.fixture(scope='session')
+def server():
+    """
+    Mock API with 2500 events in pages of 1000; events 999 to 1001 share a timestamp across a page boundary.
+    One server for the session: the profiles and sessions of the scripts keep the first base URL.
+    """
+    server = MockServer(dataset=Dataset(events=2500, devices=10, iocs=10, campaigns=10), page_size=1000).start()
+    os.environ['MVAPI_BASE_URL'] = server.url
+    os.environ['MVAPI_IAM_URL'] = server.url + '/iam/v1.1/token'
+    yield server
+    server.stop()
@@ -0,0 +1,161 @@
+# Checkpoint of mvapi_epo_get_events.py: GE plus boundary ids, legacy GT files and resuming after a stop
+
+import os
+import json
+import signal
+import threading
+
+from mvapi_epo_get_events import MVAPI, Checkpoint
+
+
+def event(id, timestamp):
+    return {'id': id, 'timestamp': timestamp}
+
+
+def collector(fname):
+    api = MVAPI()
+    api.checkpoint = Checkpoint(fname)
+    api.pull_time = '2000-01-01T00:00:00.000Z'
+    return api
+
+
+def ids(pages):
+    return [event['id'] for page in pages for event in page]
+
+
+def all_ids(server):
+    return [event['id'] for event in server.dataset.events]
+
+
+def test_missing_or_empty_file(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'cache.log'))
+    assert checkpoint.timestamp is None and checkpoint.ids == set() and not checkpoint.legacy
+
+    (tmp_path / 'cache.log').write_text('\n')
+    checkpoint = Checkpoint(str(tmp_path / 'cache.log'))
+    assert checkpoint.timestamp is None and not checkpoint.legacy
+
+
+def test_advance_keeps_the_ids_of_the_last_timestamp(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'cache.log'))
+    checkpoint.advance([event('a', 't1'), event('b', 't2'), event('c', 't2')])
+    assert checkpoint.timestamp == 't2' and checkpoint.ids == {'b', 'c'}
+
+    checkpoint.advance([event('d', 't2')])
+    assert checkpoint.ids == {'b', 'c', 'd'}
+
+    checkpoint.advance([event('e', 't3')])
+    assert checkpoint.timestamp == 't3' and checkpoint.ids == {'e'}
+
+
+def test_seen_only_matches_the_boundary(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'cache.log'))
+    checkpoint.advance([event('a', 't1'), event('b', 't1')])
+    assert checkpoint.seen(event('a', 't1'))
+    assert not checkpoint.seen(event('c', 't1'))
+    assert not checkpoint.seen(event('a', 't2'))
+
+
+def test_commit_is_not_visible_before_it_runs(tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    checkpoint = Checkpoint(fname)
+    checkpoint.advance([event('a', 't1'), event('b', 't1')])
+    assert not os.path.exists(fname)
+
+    checkpoint.commit()
+    assert json.loads(open(fname).read()) == {'timestamp': 't1', 'ids': ['a', 'b']}
+    assert not os.path.exists(fname + '.tmp')
+
+    loaded = Checkpoint(fname)
+    assert loaded.timestamp == 't1' and loaded.ids == {'a', 'b'} and not loaded.legacy
+
+
+def test_legacy_file_is_read_and_rewritten(tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    with open(fname, 'w') as cache:
+        cache.write('2022-01-01T00:00:00.000Z\n')
+
+    checkpoint = Checkpoint(fname)
+    assert checkpoint.legacy and checkpoint.timestamp == '2022-01-01T00:00:00.000Z' and checkpoint.ids == set()
+
+    checkpoint.advance([event('a', '2022-01-02T00:00:00.000Z')])
+    checkpoint.commit()
+    assert not checkpoint.legacy
+    assert json.loads(open(fname).read())['ids'] == ['a']
+
+
+def test_poll_pages_commits_after_each_delivered_page(server, tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    pages = collector(fname).poll_pages()
+
+    first = next(pages)
+    # the page is not checkpointed before the consumer asks for the next one
+    assert not os.path.exists(fname)
+
+    next(pages)
+    pages.close()
+    state = json.loads(open(fname).read())
+    assert state['timestamp'] == first[-1]['timestamp']
+    assert set(state['ids']) == set(event['id'] for event in first if event['timestamp'] == state['timestamp'])
+
+
+def test_resume_delivers_events_sharing_the_boundary_timestamp(server, tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    pages = collector(fname).poll_pages()
+    first = next(pages)
+    next(pages)
+    pages.close()
+
+    # events 999 to 1001 share a timestamp; only 999 was on the first page
+    events = server.dataset.events
+    assert events[999]['attributes']['timestamp'] == events[1001]['attributes']['timestamp']
+    assert first[-1]['id'] == events[999]['id']
+
+    rest = ids(collector(fname).poll_pages())
+    assert ids([first]) + rest == all_ids(server)
+
+
+def test_legacy_file_resumes_after_its_timestamp(server, tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    events = server.dataset.events
+    with open(fname, 'w') as cache:
+        cache.write(events[1499]['attributes']['timestamp'])
+
+    # GT: the events sharing the legacy timestamp were delivered by the old version
+    assert ids(collector(fname).poll_pages()) == all_ids(server)[1500:]
+
+
+def test_commit_false_leaves_the_checkpoint_to_the_consumer(server, tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    pages = collector(fname).poll_pages(commit=False)
+    next(pages)
+    next(pages)
+    pages.close()
+    assert not os.path.exists(fname)
+
+
+def test_follow_checkpoints_the_last_page_before_it_stops(server, tmp_path):
+    fname = str(tmp_path / 'cache.log')
+    output = str(tmp_path / 'events.ndjson')
+    server.latency = 0.05
+
+    def stop():
+        while not os.path.exists(output) or os.path.getsize(output) == 0:
+            threading.Event().wait(0.01)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    threading.Thread(target=stop, daemon=True).start()
+    try:
+        collector(fname).follow(output, min_interval=0.1)
+    finally:
+        server.latency = 0
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    written = [json.loads(line) for line in open(output)]
+    state = json.loads(open(fname).read())
+    assert state['timestamp'] == written[-1]['timestamp']
+    assert written[-1]['id'] in state['ids']
+
+    rest = ids(collector(fname).poll_pages())
+    assert [event['id'] for event in written] + rest == all_ids(server)